@@ -0,0 +1,143 @@
+"""Size analysis of packed environments, per package, file class and kernel"""
+
+import json
+from pathlib import Path, PurePosixPath
+import tarfile
+
+from .constants import EMPACK_ENV_META
+
+# The first matching class is used, in this order
+FILE_CLASSES = ["metadata", "tests", "docs", "headers", "bytecode", "python", "binaries", "data"]
+
+TEST_DIRS = {"test", "tests", "testing"}
+DOC_DIRS = {"doc", "docs", "man", "examples"}
+BINARY_SUFFIXES = {".so", ".a", ".wasm", ".js"}
+
+
+def classify(path):
+    """Return the class of a file packed in an environment, from its path"""
+    path = PurePosixPath(path)
+    parts = set(path.parts[:-1])
+
+    if path.parts[:1] == ("conda-meta",):
+        return "metadata"
+    if parts & TEST_DIRS or path.name.startswith("test_"):
+        return "tests"
+    if parts & DOC_DIRS or path.suffix in {".md", ".rst"}:
+        return "docs"
+    if path.parts[:1] == ("include",) or path.suffix in {".h", ".hpp"}:
+        return "headers"
+    if path.suffix == ".pyc" or "__pycache__" in parts:
+        return "bytecode"
+    if path.suffix == ".py":
+        return "python"
+    if path.suffix in BINARY_SUFFIXES or ".so." in path.name:
+        return "binaries"
+    return "data"
+
+
+def analyze_tarball(path):
+    """Return the compressed and uncompressed sizes of a tarball, per file class"""
+    classes = dict.fromkeys(FILE_CLASSES, 0)
+    uncompressed = 0
+    n_files = 0
+    with tarfile.open(path, "r") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            classes[classify(member.name)] += member.size
+            uncompressed += member.size
+            n_files += 1
+
+    return dict(
+        compressed=Path(path).stat().st_size,
+        uncompressed=uncompressed,
+        files=n_files,
+        classes=classes,
+    )
+
+
+def _installed_size(prefix, filename_stem):
+    """Return the size of the files of a package in the prefix, before empack filtering"""
+    meta_path = Path(prefix) / "conda-meta" / f"{filename_stem}.json"
+    if not meta_path.is_file():
+        return None
+
+    size = 0
+    for _file in json.loads(meta_path.read_text()).get("files", []):
+        path = Path(prefix) / _file
+        if path.is_file() and not path.is_symlink():
+            size += path.stat().st_size
+    return size
+
+
+def analyze_env(packed_dir, prefix, kernels=None):
+    """Analyze the packages and mounts packed in ``packed_dir``, and the ``kernels`` binaries.
+
+    ``kernels`` maps kernel names to their binaries and shared libraries.
+    The ``filtered`` size of a package is the size of its installed files that empack
+    filters left out.
+    """
+    packed_dir = Path(packed_dir)
+    env_meta = json.loads((packed_dir / EMPACK_ENV_META).read_text())
+
+    packages = {}
+    for pkg in env_meta["packages"]:
+        # External packages are not part of the build
+        if not (packed_dir / pkg["filename"]).is_file():
+            continue
+        analysis = analyze_tarball(packed_dir / pkg["filename"])
+        installed = _installed_size(prefix, pkg.get("filename_stem", ""))
+        if installed is not None:
+            packed = analysis["uncompressed"] - analysis["classes"]["metadata"]
+            analysis["filtered"] = max(installed - packed, 0)
+        packages[pkg["name"]] = analysis
+
+    mounts = {
+        mount["filename"]: analyze_tarball(packed_dir / mount["filename"])
+        for mount in env_meta.get("mounts", [])
+    }
+
+    kernel_sizes = {
+        name: sum(Path(path).stat().st_size for path in paths)
+        for name, paths in (kernels or {}).items()
+    }
+
+    classes = dict.fromkeys(FILE_CLASSES, 0)
+    for analysis in [*packages.values(), *mounts.values()]:
+        for file_class, size in analysis["classes"].items():
+            classes[file_class] += size
+
+    return dict(
+        total=sum(a["compressed"] for a in [*packages.values(), *mounts.values()])
+        + sum(kernel_sizes.values()),
+        packages=packages,
+        mounts=mounts,
+        kernels=kernel_sizes,
+        classes=classes,
+    )
+
+
+def summarize(analysis, top=10):
+    """Return a few human readable lines about the largest parts of an environment"""
+    lines = [f"total download size: {analysis['total'] / 1024**2:.1f}MB"]
+
+    largest = sorted(analysis["packages"].items(), key=lambda item: -item[1]["compressed"])
+    for name, package in largest[:top]:
+        lines.append(
+            f"  {name}: {package['compressed'] / 1024**2:.1f}MB "
+            f"({package['uncompressed'] / 1024**2:.1f}MB uncompressed)"
+        )
+    for name, size in analysis["kernels"].items():
+        lines.append(f"  kernel {name}: {size / 1024**2:.1f}MB")
+
+    classes = ", ".join(
+        f"{file_class} {size / 1024**2:.1f}MB"
+        for file_class, size in analysis["classes"].items()
+        if size
+    )
+    lines.append(f"uncompressed size per file class: {classes}")
+
+    filtered = sum(package.get("filtered", 0) for package in analysis["packages"].values())
+    lines.append(f"left out by the empack filters: {filtered / 1024**2:.1f}MB")
+    return lines
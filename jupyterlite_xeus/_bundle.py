@@ -0,0 +1,61 @@
+"""Bundles of small packed packages, so that kernels fetch them with a few requests"""
+
+from ._tiers import dependency_names
+
+
+def dependency_order(packages):
+    """Return ``packages`` sorted so that dependencies come before the packages using them"""
+    by_name = {pkg["name"]: pkg for pkg in packages}
+    ordered = []
+    visited = set()
+
+    def visit(pkg):
+        if pkg["name"] in visited:
+            return
+        visited.add(pkg["name"])
+        for name in dependency_names(pkg):
+            if name in by_name:
+                visit(by_name[name])
+        ordered.append(pkg)
+
+    for pkg in sorted(packages, key=lambda pkg: pkg["name"]):
+        visit(pkg)
+    return ordered
+
+
+def plan_bundles(packages, sizes, bundle_size):
+    """Group ``packages`` into bundles of about ``bundle_size`` bytes.
+
+    Packages loaded together (the same tier) are bundled together, in dependency order.
+    ``sizes`` maps package names to the size of their tarball.
+    """
+    tiers = {}
+    for pkg in packages:
+        tiers.setdefault(pkg.get("tier", "startup"), []).append(pkg)
+
+    bundles = []
+    for tier in sorted(tiers):
+        current = []
+        current_size = 0
+        for pkg in dependency_order(tiers[tier]):
+            if current and current_size + sizes[pkg["name"]] > bundle_size:
+                bundles.append(current)
+                current, current_size = [], 0
+            current.append(pkg)
+            current_size += sizes[pkg["name"]]
+        if current:
+            bundles.append(current)
+    return bundles
+
+
+def write_bundle(paths, dest):
+    """Concatenate the files of ``paths`` into ``dest``, returning their offset and size"""
+    slices = []
+    offset = 0
+    with open(dest, "wb") as bundle:
+        for path in paths:
+            data = path.read_bytes()
+            bundle.write(data)
+            slices.append(dict(offset=offset, size=len(data)))
+            offset += len(data)
+    return slices
@@ -0,0 +1,93 @@
+"""Build-time compilation of the packed Python modules to bytecode"""
+
+import shutil
+from pathlib import Path
+from subprocess import run as subprocess_run
+
+
+class BytecodeCompiler:
+    """Compile Python sources with a host interpreter matching the prefix Python version.
+
+    Bytecode is checked against a hash of the sources, never against their timestamps,
+    which are reset in the packed tarballs. With ``keep_sources=False``, the bytecode is
+    written next to the sources in place of them.
+    """
+
+    def __init__(self, python_version, optimization=0, keep_sources=True, python=None):
+        self.python_version = python_version
+        self.optimization = optimization
+        self.keep_sources = keep_sources
+        self.python = python or shutil.which(f"python{python_version}")
+
+        if self.python is None:
+            raise RuntimeError(
+                f"python{python_version} is needed for compiling the environment to bytecode, "
+                "as bytecode is specific to a Python version. Please install it, or set its "
+                "path with the bytecode_python option"
+            )
+
+        host_version = subprocess_run(
+            [self.python, "-c", "import sys; print('%d.%d' % sys.version_info[:2])"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        if host_version != python_version:
+            raise RuntimeError(
+                f"{self.python} is Python {host_version}, but the environment has Python {python_version}"
+            )
+
+    def describe(self):
+        """Return what changes the compiled files, for cache keys"""
+        return dict(
+            python_version=self.python_version,
+            optimization=self.optimization,
+            keep_sources=self.keep_sources,
+        )
+
+    def compile(self, directory):
+        subprocess_run(
+            [
+                self.python,
+                "-m",
+                "compileall",
+                # Files which can't be compiled, e.g. Python 2 leftovers, are kept as sources
+                "-qq",
+                "-j",
+                "0",
+                "--invalidation-mode",
+                "unchecked-hash",
+                "-o",
+                str(self.optimization),
+                *([] if self.keep_sources else ["-b"]),
+                str(directory),
+            ],
+            check=False,
+        )
+
+    def bytecode_path(self, source):
+        source = Path(source)
+        if not self.keep_sources:
+            return source.with_suffix(".pyc")
+
+        tag = f"cpython-{self.python_version.replace('.', '')}"
+        opt = f".opt-{self.optimization}" if self.optimization else ""
+        return source.parent / "__pycache__" / f"{source.stem}.{tag}{opt}.pyc"
+
+    def packed_files(self, directory, files):
+        """Return the files to pack once ``directory`` is compiled, from its original ``files``"""
+        packed = []
+        for _file in files:
+            if Path(_file).suffix != ".py":
+                packed.append(_file)
+                continue
+
+            bytecode = self.bytecode_path(_file)
+            if not (Path(directory) / bytecode).is_file():
+                packed.append(_file)
+                continue
+
+            if self.keep_sources:
+                packed.append(_file)
+            packed.append(bytecode)
+        return packed
@@ -0,0 +1,130 @@
+"""Precompressed siblings of the build outputs, for static hosts serving them as is"""
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encodings and the suffix of their sidecar files
+PRECOMPRESS_ENCODINGS = {"gzip": ".gz", "br": ".br", "zstd": ".zst"}
+
+# Outputs worth precompressing, package tarballs are already compressed
+PRECOMPRESS_SUFFIXES = [".wasm", ".js", ".data", ".json", ".so"]
+
+# The hash of the original of the siblings, to know whether they are up to date. File
+# timestamps can't tell: copies and links keep the mtime of the environment files,
+# which may be older than the siblings after an upgrade
+PRECOMPRESS_INDEX = ".precompress-index.json"
+
+
+def _compress(data, encoding):
+    if encoding == "gzip":
+        # No timestamp in the header, for reproducible outputs
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return zstandard.ZstdCompressor(level=19).compress(data)
+
+
+def check_encodings(encodings):
+    """Raise if an encoding is unknown or needs a package that is not installed"""
+    for encoding in encodings:
+        if encoding not in PRECOMPRESS_ENCODINGS:
+            raise ValueError(
+                f"Unknown encoding '{encoding}', must be one of {list(PRECOMPRESS_ENCODINGS)}"
+            )
+        if encoding == "br" and brotli is None:
+            raise RuntimeError("The 'brotli' package is needed for precompressing with 'br'")
+        if encoding == "zstd" and zstandard is None:
+            raise RuntimeError("The 'zstandard' package is needed for precompressing with 'zstd'")
+
+
+def precompress_file(path, encodings, max_ratio=0.9, previous=None):
+    """Write a sibling of ``path`` per encoding, e.g. ``kernel.wasm.br``.
+
+    ``previous`` is the result of a previous call for ``path``: its siblings are kept
+    as is if the content of ``path`` did not change since. Siblings which would not be
+    smaller than ``max_ratio`` times the original size are not written, or removed.
+
+    Returns the sha256 of ``path`` and a dict of the sibling sizes per encoding, None
+    for skipped ones.
+    """
+    path = Path(path)
+    data = path.read_bytes()
+    sha256 = hashlib.sha256(data).hexdigest()
+    previous_sizes = previous["sizes"] if previous and previous.get("sha256") == sha256 else {}
+    sizes = {}
+
+    for encoding in encodings:
+        sidecar = path.with_name(path.name + PRECOMPRESS_ENCODINGS[encoding])
+        if encoding in previous_sizes:
+            size = previous_sizes[encoding]
+            if size is None and not sidecar.exists():
+                sizes[encoding] = None
+                continue
+            if size is not None and sidecar.is_file() and sidecar.stat().st_size == size:
+                sizes[encoding] = size
+                continue
+
+        compressed = _compress(data, encoding)
+
+        if len(compressed) > max_ratio * len(data):
+            sidecar.unlink(missing_ok=True)
+            sizes[encoding] = None
+            continue
+
+        tmp = sidecar.with_name(f".{sidecar.name}.tmp")
+        tmp.write_bytes(compressed)
+        os.replace(tmp, sidecar)
+        sizes[encoding] = len(compressed)
+
+    return dict(sha256=sha256, sizes=sizes)
+
+
+def precompress_directory(directory, encodings, max_ratio=0.9, workers=None):
+    """Precompress all the outputs under ``directory`` in parallel.
+
+    Returns a dict of the sibling sizes per encoding, per path.
+    """
+    check_encodings(encodings)
+
+    directory = Path(directory)
+    index_path = directory / PRECOMPRESS_INDEX
+    try:
+        index = json.loads(index_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        index = {}
+
+    paths = sorted(
+        path
+        for path in directory.rglob("*")
+        if path.suffix in PRECOMPRESS_SUFFIXES and path.is_file() and path != index_path
+    )
+    names = [path.relative_to(directory).as_posix() for path in paths]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(
+                lambda path, name: precompress_file(path, encodings, max_ratio, index.get(name)),
+                paths,
+                names,
+            )
+        )
+
+    tmp = index_path.with_name(f".{index_path.name}.tmp")
+    tmp.write_text(json.dumps(dict(zip(names, results)), indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, index_path)
+
+    return {path: result["sizes"] for path, result in zip(paths, results)}
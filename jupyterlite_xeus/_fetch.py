@@ -0,0 +1,74 @@
+"""Fetching of remote build inputs, cached on disk and revalidated with ETag / Last-Modified"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import requests
+
+
+def _write_atomic(path, data):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def fetch_cached(url, cache_dir, timeout=30, retries=2, offline=False, log=None):
+    """Return the content of ``url``, from ``cache_dir`` if it did not change on the server.
+
+    In ``offline`` mode, or when the server can't be reached, the cached copy is used as is.
+    """
+    cache_dir = Path(cache_dir)
+    name = hashlib.sha256(url.encode()).hexdigest()[:16]
+    content_path = cache_dir / f"{name}.data"
+    meta_path = cache_dir / f"{name}.json"
+
+    meta = None
+    if content_path.is_file() and meta_path.is_file():
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+
+    if offline:
+        if meta is None:
+            raise RuntimeError(f"{url} was never fetched, it can't be used offline")
+        return content_path.read_bytes()
+
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    error = None
+    for _ in range(retries + 1):
+        try:
+            response = requests.get(url, headers=headers, timeout=timeout)
+            break
+        except requests.RequestException as e:
+            error = e
+    else:
+        if meta is None:
+            raise RuntimeError(f"Failed to fetch {url}: {error}") from error
+        if log is not None:
+            log.warning(f"[xeus] failed to fetch {url}, using the cached copy: {error}")
+        return content_path.read_bytes()
+
+    if response.status_code == 304 and meta is not None:
+        return content_path.read_bytes()
+
+    response.raise_for_status()
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    _write_atomic(content_path, response.content)
+    _write_atomic(
+        meta_path,
+        json.dumps(
+            dict(
+                url=url,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+        ).encode(),
+    )
+    return response.content
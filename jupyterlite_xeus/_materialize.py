@@ -0,0 +1,52 @@
+"""Materialization of build artifacts in the output directory, without copying when possible"""
+
+import errno
+import os
+import shutil
+import sys
+from pathlib import Path
+
+MATERIALIZATION_MODES = ["copy", "hardlink", "reflink", "symlink"]
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+def _reflink(src, dest):
+    if sys.platform != "linux":
+        raise OSError(errno.ENOTSUP, "reflinks are only supported on Linux")
+
+    import fcntl
+
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+
+
+def materialize(src, dest, mode="copy"):
+    """Make the ``src`` file available at ``dest``, following ``mode``.
+
+    Falls back to a regular copy when ``mode`` is not supported for these paths, e.g. when
+    hardlinking across filesystems or reflinking on a filesystem without copy-on-write.
+
+    Returns the mode that was actually used.
+    """
+    src = Path(src)
+    dest = Path(dest)
+
+    if mode not in MATERIALIZATION_MODES:
+        raise ValueError(f"Unknown materialization mode '{mode}', must be one of {MATERIALIZATION_MODES}")
+
+    if mode != "copy":
+        try:
+            if mode == "hardlink":
+                os.link(src, dest)
+            elif mode == "reflink":
+                _reflink(src, dest)
+            else:
+                os.symlink(src.resolve(), dest)
+            return mode
+        except OSError:
+            dest.unlink(missing_ok=True)
+
+    shutil.copy2(src, dest)
+    return "copy"
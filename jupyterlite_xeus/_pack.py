@@ -0,0 +1,340 @@
+"""Packing of a wasm prefix into empack tarballs, with an optional on-disk cache"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+from pathlib import Path, PurePosixPath
+from tempfile import TemporaryDirectory
+from urllib.parse import urlparse
+
+from empack.filter_env import filter_pkg, iterate_env_pkg_meta
+from empack.pack import filename_base_from_meta
+from empack.tar_utils import ALLOWED_FORMATS
+
+from .constants import EMPACK_ENV_META
+
+# Bump this whenever the content of the packed tarballs changes for a given key
+PACK_CACHE_VERSION = 2
+
+CONDA_ARCHIVE_SUFFIXES = (".conda", ".tar.bz2")
+
+
+def _check_conda_archive_url(pkg_meta, package_url):
+    """Check that an external package is loaded from the conda package its sha256 is of"""
+    name = PurePosixPath(urlparse(package_url).path).name
+    source_url = pkg_meta.get("url")
+    expected = PurePosixPath(urlparse(source_url).path).name if source_url else None
+    if not name.endswith(CONDA_ARCHIVE_SUFFIXES) or (expected and name != expected):
+        raise ValueError(
+            f"External package {pkg_meta['name']} must be loaded from its conda package "
+            f"{expected or 'archive'}, as kernels check it against its sha256, not from {package_url}"
+        )
+
+
+def _reset_tarinfo(tarinfo):
+    tarinfo.mtime = 0
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    return tarinfo
+
+
+def save_as_tarfile(output_filename, filenames, arcnames, compression_format=ALLOWED_FORMATS[0], compresslevel=9):
+    """Same as ``empack.tar_utils.save_as_tarfile``, but reproducible.
+
+    Timestamps and ownership are dropped, so that packing the same files always
+    gives the same bytes, wherever and whenever the package was installed.
+    """
+    if compression_format != "gz":
+        raise RuntimeError(f"Compression format {compression_format} not supported, only gz is supported.")
+
+    with open(output_filename, "wb") as raw, gzip.GzipFile(
+        filename="", mode="wb", fileobj=raw, compresslevel=compresslevel, mtime=0
+    ) as compressed, tarfile.open(fileobj=compressed, mode="w") as tar:
+        for file, arcname in zip(filenames, arcnames):
+            tar.add(file, arcname=arcname, filter=_reset_tarinfo)
+
+
+def describe_file_filters(config, pkg_name):
+    """Return the exclude patterns of an empack file filter config applying to a package.
+
+    As in ``PkgFileFilter``, the packages listed in the config only get their own
+    ``exclude_patterns``, and the others the default ones.
+    """
+    packages = config.get("packages") or {}
+    pkg_filter = packages[pkg_name] if pkg_name in packages else config.get("default")
+    if pkg_filter is None:
+        return None
+    return pkg_filter.get("exclude_patterns") or []
+
+
+def _package_hash(env_prefix, pkg_meta):
+    """Return a hash identifying the content of an installed package"""
+    for field in ("sha256", "md5"):
+        if pkg_meta.get(field):
+            return f"{field}:{pkg_meta[field]}"
+
+    # pip packages do not come with a hash, so we hash their installed files
+    sha = hashlib.sha256()
+    for _file in sorted(pkg_meta.get("files", [])):
+        path = Path(env_prefix) / _file
+        sha.update(str(_file).encode())
+        if path.is_file():
+            sha.update(path.read_bytes())
+    return f"files:{sha.hexdigest()}"
+
+
+def split_tarball(path, chunk_size):
+    """Split ``path`` into siblings of ``chunk_size`` bytes, named ``<name>.part<index>``.
+
+    Returns the chunk entries of the env meta file, in order.
+    """
+    path = Path(path)
+    chunks = []
+    with open(path, "rb") as f:
+        for index, data in enumerate(iter(lambda: f.read(chunk_size), b"")):
+            chunk_path = path.with_name(f"{path.name}.part{index}")
+            chunk_path.write_bytes(data)
+            chunks.append(dict(filename=chunk_path.name, size=len(data)))
+    return chunks
+
+
+def mount_fingerprint(host_path, mount_path):
+    """Return a hash of a mount point, from the size and modification time of its files"""
+    host_path = Path(host_path)
+    if host_path.is_dir():
+        files = []
+        for root, dirs, filenames in os.walk(host_path):
+            dirs.sort()
+            files.extend(Path(root) / filename for filename in sorted(filenames))
+        names = [path.relative_to(host_path) for path in files]
+    else:
+        files = [host_path]
+        names = [host_path.name]
+
+    sha = hashlib.sha256()
+    sha.update(json.dumps([PACK_CACHE_VERSION, str(mount_path), host_path.is_dir()]).encode())
+    for name, path in zip(names, files):
+        stat = path.stat()
+        sha.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return sha.hexdigest()
+
+
+class PackCache:
+    """A content-addressed on-disk cache of packed packages.
+
+    Entries are keyed by the package hash and the part of the empack file filter config
+    applying to that package. The cache is kept under ``max_size`` bytes by evicting
+    the least recently used entries.
+    """
+
+    def __init__(self, cache_dir, max_size=None, log=None):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.log = log
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(
+        self,
+        env_prefix,
+        pkg_meta,
+        filters,
+        relocate_prefix,
+        compression_format,
+        compresslevel,
+        excluded=(),
+        bytecode=None,
+    ):
+        content = {
+            "version": PACK_CACHE_VERSION,
+            "package": filename_base_from_meta(pkg_meta),
+            "hash": _package_hash(env_prefix, pkg_meta),
+            "filters": filters,
+            "relocate_prefix": str(relocate_prefix),
+            "compression": [compression_format, compresslevel],
+            "excluded": sorted(excluded),
+            "bytecode": bytecode,
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key, compression_format):
+        return self.cache_dir / key[:2] / f"{key}.tar.{compression_format}"
+
+    def fetch(self, key, compression_format, dest):
+        """Copy the cached entry to ``dest``, return whether there was a cache hit"""
+        cached = self.path(key, compression_format)
+        if not cached.is_file():
+            return False
+
+        shutil.copyfile(cached, dest)
+        # Mark the entry as recently used
+        os.utime(cached)
+        return True
+
+    def store(self, key, compression_format, src):
+        cached = self.path(key, compression_format)
+        cached.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so that concurrent builds never see partial entries
+        tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, cached)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in ``max_size``"""
+        if self.max_size is None:
+            return
+
+        entries = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry)
+            for entry in self.cache_dir.glob("*/*.tar.*")
+            if not entry.name.endswith(".tmp")
+        ]
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            total_size -= size
+            if self.log is not None:
+                self.log.debug(f"[xeus] evicted {entry.name} from the pack cache")
+
+
+def pack_env(
+    env_prefix,
+    relocate_prefix,
+    file_filters,
+    outdir,
+    cache=None,
+    compression_format=ALLOWED_FORMATS[0],
+    compresslevel=9,
+    package_url_factory=None,
+    exclude=None,
+    bytecode=None,
+    external=False,
+    file_filters_config=None,
+):
+    """Pack all packages of ``env_prefix`` into ``outdir`` and write the empack env meta file.
+
+    This mirrors ``empack.pack.pack_env``, except that packages are only filtered and
+    compressed when they are not found in ``cache``. Files of ``exclude``, relative to
+    ``env_prefix``, are left out on top of the empack filters. With a ``bytecode`` compiler,
+    the Python sources of the packages are packed along with, or replaced by, their bytecode.
+    With ``external``, packages getting a URL from ``package_url_factory`` are not packed:
+    they are loaded from that URL, which must serve their original conda package, and are
+    checked against its ``sha256``.
+
+    The ``cache`` needs ``file_filters_config``, the empack config ``file_filters`` were
+    loaded from, as the filters can't be described from the loaded matchers.
+
+    Returns a dict mapping each packed package tarball name to whether it came from the cache.
+    """
+    if cache is not None and file_filters_config is None:
+        raise ValueError("The pack cache needs the empack config of the file filters")
+
+    outdir = Path(outdir)
+    cache_hits = {}
+    packages_info = []
+    # Filtered packages which were not found in the cache
+    to_pack = []
+
+    with TemporaryDirectory() as tmp_dir:
+        filtered_prefix = Path(tmp_dir) / "filtered_env"
+        filtered_prefix.mkdir()
+
+        for pkg_meta in iterate_env_pkg_meta(env_prefix):
+            matchers = file_filters.get_filters_for_pkg(pkg_name=pkg_meta["name"])
+
+            excluded = []
+            if exclude:
+                excluded = [_file for _file in pkg_meta["files"] if Path(_file).as_posix() in exclude]
+                if excluded:
+                    pkg_meta = dict(
+                        pkg_meta, files=[_file for _file in pkg_meta["files"] if _file not in excluded]
+                    )
+
+            base_fname = filename_base_from_meta(pkg_meta)
+            filename = f"{base_fname}.tar.{compression_format}"
+
+            pkg_dict = dict(
+                name=pkg_meta["name"],
+                version=pkg_meta["version"],
+                build=pkg_meta["build"],
+                filename_stem=base_fname,
+                filename=filename,
+                channel=pkg_meta["channel"],
+                depends=pkg_meta.get("depends", []),
+                subdir=pkg_meta.get("subdir", ""),
+            )
+
+            package_url = None
+            if package_url_factory:
+                package_url = package_url_factory(pkg_dict, source_url=pkg_meta.get("url", None))
+            if package_url is not None:
+                pkg_dict["url"] = package_url
+            packages_info.append(pkg_dict)
+
+            if external and package_url is not None:
+                _check_conda_archive_url(pkg_meta, package_url)
+                pkg_dict["sha256"] = pkg_meta.get("sha256")
+                continue
+
+            key = None
+            used_cache = False
+            if cache is not None:
+                key = cache.key(
+                    env_prefix,
+                    pkg_meta,
+                    describe_file_filters(file_filters_config, pkg_meta["name"]),
+                    relocate_prefix,
+                    compression_format,
+                    compresslevel,
+                    excluded,
+                    bytecode.describe() if bytecode is not None else None,
+                )
+                used_cache = cache.fetch(key, compression_format, outdir / filename)
+
+            if not used_cache:
+                included_files = filter_pkg(
+                    env_prefix=env_prefix,
+                    pkg_meta=pkg_meta,
+                    target_dir=filtered_prefix,
+                    matchers=matchers,
+                )
+                to_pack.append((filename, key, included_files))
+
+            cache_hits[filename] = used_cache
+
+        # Compile all packages at once, which is much faster than one by one
+        if bytecode is not None and to_pack:
+            bytecode.compile(filtered_prefix)
+
+        for filename, key, included_files in to_pack:
+            if bytecode is not None:
+                included_files = bytecode.packed_files(filtered_prefix, included_files)
+
+            save_as_tarfile(
+                output_filename=outdir / filename,
+                filenames=[filtered_prefix / _file for _file in included_files],
+                arcnames=[
+                    os.path.relpath(os.path.join(relocate_prefix, _file), relocate_prefix)
+                    for _file in included_files
+                ],
+                compression_format=compression_format,
+                compresslevel=compresslevel,
+            )
+
+            if cache is not None:
+                cache.store(key, compression_format, outdir / filename)
+
+    env_meta = {
+        "prefix": str(relocate_prefix),
+        "packages": packages_info,
+    }
+    with open(outdir / EMPACK_ENV_META, "w") as f:
+        json.dump(env_meta, f, indent=4)
+
+    return cache_hits
@@ -1,109 +1,259 @@
 import sys
 import shutil
 import os
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import run as subprocess_run
 from tempfile import TemporaryDirectory
 from pathlib import Path
+import base64
 import csv
-import json
-import glob
+import hashlib
+import io
+import re
+import zipfile
+
+from ._prefix_index import load_prefix_index
+
+NON_SUPPORTED_FILES = [".so", ".a", ".dylib", ".lib", ".exe.dll"]
 
 
 def _get_python_version(prefix_path):
-    path = glob.glob(f"{prefix_path}/conda-meta/python-3.*.json")
+    # Only the packages of the index are needed here, not its labextensions
+    python_version = load_prefix_index(prefix_path, lambda path: [])["python_version"]
 
-    if not path:
+    if python_version is None:
         raise RuntimeError("Python needs to be installed for installing pip dependencies")
 
-    version = json.load(open(path[0]))["version"].split(".")
-    return f"{version[0]}.{version[1]}"
+    return python_version
 
 
-def _install_pip_dependencies(prefix_path, dependencies, log=None):
-    # Why is this so damn complicated?
-    # Isn't it easier to download the .whl ourselves? pip is hell
+def _normalize_name(name):
+    # Distribution names as they appear in wheel filenames
+    return re.sub(r"[-_.]+", "_", name).lower()
 
-    if log is not None:
-        log.warning(
-            """
-            Installing pip dependencies. This is very much experimental so use
-            this feature at your own risks.
-            Note that you can only install pure-python packages.
-            pip is being run with the --no-deps option to not pull undesired
-            system-specific dependencies, so please install your package dependencies
-            from emscripten-forge or conda-forge.
-            """
-        )
 
-    # Installing with pip in another prefix that has a different Python version IS NOT POSSIBLE
-    # So we need to do this whole mess "manually"
-    pkg_dir = TemporaryDirectory()
+def _is_pure_wheel(wheel_path, python_version):
+    """Whether the wheel filename tags say it's installable on any platform for this Python"""
+    parts = Path(wheel_path).stem.split("-")
+    if len(parts) < 5:
+        return False
+    python_tags, abi_tag, platform_tag = parts[-3:]
+    major = python_version.split(".")[0]
+    python_tags = python_tags.split(".")
+    return (
+        abi_tag == "none"
+        and platform_tag == "any"
+        and (f"py{major}" in python_tags or f"py{python_version.replace('.', '')}" in python_tags)
+    )
 
-    python_version = _get_python_version(prefix_path)
 
-    subprocess_run(
-        [
-            sys.executable,
-            "-m",
-            "pip",
-            "install",
-            *dependencies,
-            # Install in a tmp directory while we process it
-            "--target",
-            pkg_dir.name,
-            # Specify the right Python version
-            "--python-version",
-            python_version,
-            # No dependency installed
-            "--no-deps",
-            "--no-input",
-            "--verbose",
-        ],
-        check=True,
-    )
+def _find_pinned_wheel(dependency, python_version, wheel_dirs):
+    """Return a local wheel for a ``name==version`` requirement, if there is one"""
+    if not isinstance(dependency, str) or dependency.count("==") != 1:
+        return None
+    name, version = (part.strip() for part in dependency.split("=="))
+    if not re.fullmatch(r"[A-Za-z0-9._-]+", name) or not re.fullmatch(r"[A-Za-z0-9.+!_-]+", version):
+        return None
+
+    for wheel_dir in wheel_dirs:
+        for wheel in sorted(Path(wheel_dir).glob("*.whl")):
+            parts = wheel.stem.split("-")
+            if (
+                _normalize_name(parts[0]) == _normalize_name(name)
+                and parts[1] == version
+                and _is_pure_wheel(wheel, python_version)
+            ):
+                return wheel
+    return None
+
+
+def _get_wheels(dependencies, python_version, download_dir, wheel_cache_dir=None, wheelhouse=None):
+    """Return the wheels for the dependencies, downloading or building them if needed"""
+    wheel_dirs = [d for d in (wheelhouse, wheel_cache_dir) if d is not None and Path(d).is_dir()]
+    find_links_args = []
+    for wheel_dir in wheel_dirs:
+        find_links_args.extend(["--find-links", str(wheel_dir)])
+
+    wheels = []
+    local_packages = []
+    requirements = []
+    for dependency in dependencies:
+        if str(dependency).endswith(".whl") and Path(dependency).is_file():
+            wheels.append(Path(dependency))
+        elif isinstance(dependency, Path) or Path(dependency).is_dir():
+            local_packages.append(str(dependency))
+        elif (wheel := _find_pinned_wheel(dependency, python_version, wheel_dirs)) is not None:
+            wheels.append(wheel)
+        else:
+            requirements.append(dependency)
+
+    local_dir = Path(download_dir) / "local"
+    sources_dir = Path(download_dir) / "sources"
+    download_dir = Path(download_dir) / "downloads"
+    download_dir.mkdir()
+    local_dir.mkdir()
+
+    # pip builds in the source directory, leaving a build/ tree behind: build from a copy
+    local_packages = [
+        str(
+            shutil.copytree(
+                package,
+                sources_dir / f"{index}-{Path(package).name}",
+                ignore=shutil.ignore_patterns("build", "dist", "*.egg-info", ".git", "__pycache__"),
+            )
+        )
+        for index, package in enumerate(local_packages)
+    ]
+
+    if requirements:
+        subprocess_run(
+            [
+                sys.executable,
+                "-m",
+                "pip",
+                "download",
+                *requirements,
+                "--dest",
+                download_dir,
+                *find_links_args,
+                # Specify the right Python version
+                "--python-version",
+                python_version,
+                # No dependency installed
+                "--no-deps",
+                "--no-input",
+            ],
+            check=True,
+        )
+
+    # Source distributions from PyPI and local packages still need to be built
+    for sources, wheel_dir in [
+        ([str(path) for path in download_dir.iterdir() if path.suffix != ".whl"], download_dir),
+        (local_packages, local_dir),
+    ]:
+        if sources:
+            subprocess_run(
+                [
+                    sys.executable,
+                    "-m",
+                    "pip",
+                    "wheel",
+                    *sources,
+                    "--wheel-dir",
+                    wheel_dir,
+                    "--no-deps",
+                    "--no-input",
+                ],
+                check=True,
+            )
 
-    # We need to read the RECORD and try to be smart about what goes
-    # under site-packages and what goes where
-    packages_dist_info = Path(pkg_dir.name).glob("*.dist-info")
+    downloaded = sorted(download_dir.glob("*.whl"))
+    # Wheels built from local directories change with their sources, they are not cached
+    if wheel_cache_dir is not None:
+        Path(wheel_cache_dir).mkdir(parents=True, exist_ok=True)
+        for wheel in downloaded:
+            if not (Path(wheel_cache_dir) / wheel.name).exists():
+                shutil.copy2(wheel, wheel_cache_dir)
 
-    for package_dist_info in packages_dist_info:
-        with open(package_dist_info / "RECORD") as record:
-            record_content = record.read()
-            record_csv = csv.reader(record_content.splitlines())
-            all_files = [_file[0] for _file in record_csv]
+    return wheels + downloaded + sorted(local_dir.glob("*.whl"))
 
-            # List of tuples: (path: str, inside_site_packages: bool)
-            files = [(_file, not _file.startswith("../../")) for _file in all_files]
 
-            # Why?
-            fixed_record_data = record_content.replace("../../", "../../../")
+def _record_hash(data):
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b"=")
+    return f"sha256={digest.decode()}"
 
-        # OVERWRITE RECORD file
-        with open(package_dist_info / "RECORD", "w") as record:
-            record.write(fixed_record_data)
 
-        non_supported_files = [".so", ".a", ".dylib", ".lib", ".exe.dll"]
+def _install_wheel(wheel_path, prefix_path, python_version):
+    """Unpack a pure Python wheel into the prefix, following the wheel data scheme"""
+    site_packages = Path("lib") / f"python{python_version}" / "site-packages"
 
-        # COPY files under `prefix_path`
-        for _file, inside_site_packages in files:
-            path = Path(_file)
+    with zipfile.ZipFile(wheel_path) as wheel:
+        members = [info for info in wheel.infolist() if not info.is_dir()]
 
-            # FAIL if .so / .a / .dylib / .lib / .exe / .dll
-            if path.suffix in non_supported_files:
+        # FAIL if .so / .a / .dylib / .lib / .exe / .dll, before writing anything
+        for info in members:
+            if Path(info.filename).suffix in NON_SUPPORTED_FILES:
                 raise RuntimeError(
                     "Cannot install binary PyPI package, only pure Python packages are supported"
                 )
 
-            file_path = _file[6:] if not inside_site_packages else _file
-            install_path = (
-                prefix_path
-                if not inside_site_packages
-                else prefix_path / "lib" / f"python{python_version}" / "site-packages"
-            )
+        dist_info = next(
+            info.filename.split("/")[0]
+            for info in members
+            if info.filename.split("/")[0].endswith(".dist-info")
+        )
+        data_dir = dist_info.removesuffix(".dist-info") + ".data"
+        schemes = dict(
+            purelib=site_packages,
+            platlib=site_packages,
+            scripts=Path("bin"),
+            data=Path("."),
+            headers=Path("include") / f"python{python_version}" / dist_info.split("-")[0],
+        )
 
-            src_path = Path(pkg_dir.name) / file_path
-            dest_path = install_path / file_path
+        records = []
+        for info in members:
+            parts = info.filename.split("/")
+            if parts[0] == dist_info and parts[-1] in ("RECORD", "INSTALLER"):
+                continue
 
+            if parts[0] == data_dir:
+                install_path = schemes[parts[1]] / Path(*parts[2:])
+            else:
+                install_path = site_packages / info.filename
+
+            data = wheel.read(info)
+            dest_path = prefix_path / install_path
             os.makedirs(dest_path.parent, exist_ok=True)
+            dest_path.write_bytes(data)
+
+            # Paths in RECORD are relative to site-packages
+            record_path = os.path.relpath(install_path, site_packages).replace(os.sep, "/")
+            records.append((record_path, _record_hash(data), len(data)))
+
+    installed_dist_info = prefix_path / site_packages / dist_info
+    (installed_dist_info / "INSTALLER").write_text("pip\n")
+    records.append((f"{dist_info}/INSTALLER", _record_hash(b"pip\n"), 4))
+    records.append((f"{dist_info}/RECORD", "", ""))
+
+    record = io.StringIO()
+    csv.writer(record, lineterminator="\n").writerows(records)
+    (installed_dist_info / "RECORD").write_text(record.getvalue())
 
-            shutil.copy(src_path, dest_path)
+
+def _install_pip_dependencies(
+    prefix_path, dependencies, log=None, wheel_cache_dir=None, wheelhouse=None, workers=None
+):
+    if log is not None:
+        log.warning(
+            """
+            Installing pip dependencies. This is very much experimental so use
+            this feature at your own risks.
+            Note that you can only install pure-python packages.
+            pip is being run with the --no-deps option to not pull undesired
+            system-specific dependencies, so please install your package dependencies
+            from emscripten-forge or conda-forge.
+            """
+        )
+
+    # Installing with pip in another prefix that has a different Python version IS NOT POSSIBLE
+    # So we only use pip for getting the wheels, and unpack them ourselves
+    prefix_path = Path(prefix_path)
+    python_version = _get_python_version(prefix_path)
+
+    with TemporaryDirectory() as download_dir:
+        wheels = _get_wheels(
+            dependencies,
+            python_version,
+            download_dir,
+            wheel_cache_dir=wheel_cache_dir,
+            wheelhouse=wheelhouse,
+        )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Consume the results so that errors are raised
+            list(
+                executor.map(
+                    lambda wheel: _install_wheel(wheel, prefix_path, python_version), wheels
+                )
+            )
@@ -0,0 +1,205 @@
+"""An index of what the build needs to know about a prefix, computed once per prefix.
+
+The index is cached on disk, and reused as long as the installed packages did not change.
+Conda packages have their metadata in ``conda-meta``, but pip packages only come with a
+``.dist-info`` directory in ``site-packages``, and may install labextensions: these are
+part of the cache key as well.
+"""
+
+import ast
+import hashlib
+import json
+import os
+from pathlib import Path
+import shlex
+
+from jupyterlite_core.constants import SHARE_LABEXTENSIONS
+
+PREFIX_INDEX_VERSION = 2
+
+
+def _stat_entry(path, prefix):
+    stat = path.stat()
+    return (path.relative_to(prefix).as_posix(), stat.st_mtime_ns, stat.st_size)
+
+
+def installed_packages_key(prefix):
+    """Return a key changing whenever a package is installed in or removed from the prefix.
+
+    It covers the files of ``conda-meta``, the ``.dist-info`` directories of pip packages,
+    the ``package.json`` of the labextensions and the ``kernel.json`` of the kernels, whose
+    metadata is part of the index.
+    """
+    prefix = Path(prefix)
+    entries = []
+
+    conda_meta = prefix / "conda-meta"
+    if conda_meta.is_dir():
+        entries.extend(_stat_entry(path, prefix) for path in conda_meta.iterdir())
+
+    for dist_info in prefix.glob("lib/python3*/site-packages/*.dist-info"):
+        entries.append(_stat_entry(dist_info, prefix))
+
+    labextensions = prefix / SHARE_LABEXTENSIONS
+    for pkg_json in [*labextensions.glob("*/package.json"), *labextensions.glob("@*/*/package.json")]:
+        entries.append(_stat_entry(pkg_json, prefix))
+
+    for kernel_json in prefix.glob("share/jupyter/kernels/*/kernel.json"):
+        entries.append(_stat_entry(kernel_json, prefix))
+
+    payload = json.dumps([PREFIX_INDEX_VERSION, str(prefix.resolve()), sorted(entries)])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def parse_history(path):
+    """Return the specs and the channels of the commands of a ``conda-meta/history`` file"""
+    specs = []
+    channels = []
+    if not Path(path).is_file():
+        return specs, channels
+
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("# update specs:"):
+                spec_line = line.strip().removeprefix("# update specs:").strip()
+                try:
+                    specs += ast.literal_eval(spec_line)
+                except Exception as e:
+                    print(f"Error parsing line: {spec_line} — {e}")
+            elif line.startswith("# cmd:"):
+                tokens = shlex.split(line.removeprefix("# cmd:"))
+                i = 0
+                while i < len(tokens):
+                    tok = tokens[i]
+
+                    # Handle "-c URL" or "--channel URL"
+                    if tok in ("-c", "--channel"):
+                        if i + 1 < len(tokens):
+                            channels.append(tokens[i + 1])
+                        i += 2
+                        continue
+
+                    # Handle "--channel=URL"
+                    if tok.startswith("--channel="):
+                        channels.append(tok.split("=", 1)[1])
+                        i += 1
+                        continue
+
+                    i += 1
+
+    return specs, channels
+
+
+def kernel_binaries(path):
+    """Return the kernel binaries (js, wasm, and optionally data) of a kernelspec directory,
+    or None and the reason why they can't be found
+    """
+    json_file = Path(path) / "kernel.json"
+    if not json_file.exists():
+        return None, f"kernel.json not found for {Path(path).name}"
+
+    kernel_binary = json.loads(json_file.read_text(encoding="utf-8")).get("argv")[0]
+    kernel_binary_js = Path(kernel_binary + ".js")
+    kernel_binary_wasm = Path(kernel_binary + ".wasm")
+    kernel_binary_data = Path(kernel_binary + ".data")
+
+    if not (kernel_binary_js.exists() and kernel_binary_wasm.exists()):
+        return None, f"kernel binaries not found for {Path(path).name}"
+
+    # .data is None if it doesn't exist, as it might not be necessary for all kernels
+    return (
+        kernel_binary_js,
+        kernel_binary_wasm,
+        kernel_binary_data if kernel_binary_data.exists() else None,
+    ), None
+
+
+def build_prefix_index(prefix, find_extensions):
+    """Return the index of a prefix.
+
+    ``find_extensions`` returns the ``package.json`` of the federated extensions
+    under a directory.
+    """
+    prefix = Path(prefix)
+    conda_meta = prefix / "conda-meta"
+
+    packages = []
+    python_version = None
+    for meta_path in sorted(conda_meta.glob("*.json")):
+        pkg_meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        packages.append(
+            dict(
+                name=pkg_meta["name"],
+                version=pkg_meta["version"],
+                build=pkg_meta["build"],
+                filename_stem=meta_path.stem,
+            )
+        )
+        if pkg_meta["name"] == "python" and pkg_meta["version"].startswith("3."):
+            python_version = ".".join(pkg_meta["version"].split(".")[:2])
+
+    specs, channels = parse_history(conda_meta / "history")
+
+    kernels = None
+    kernel_spec_path = prefix / "share" / "jupyter" / "kernels"
+    if kernel_spec_path.exists():
+        kernels = []
+        for kernel_dir in sorted(kernel_spec_path.iterdir()):
+            binaries, problem = kernel_binaries(kernel_dir)
+            shared = {}
+            if binaries is not None:
+                shared = (
+                    json.loads((kernel_dir / "kernel.json").read_text(encoding="utf-8"))
+                    .get("metadata", {})
+                    .get("shared", {})
+                )
+            kernels.append(
+                dict(
+                    name=kernel_dir.name,
+                    dir=str(kernel_dir),
+                    binaries=[None if path is None else str(path) for path in binaries]
+                    if binaries is not None
+                    else None,
+                    problem=problem,
+                    shared=shared,
+                )
+            )
+
+    return dict(
+        packages=packages,
+        specs=specs,
+        channels=channels,
+        python_version=python_version,
+        kernels=kernels,
+        libxeus=(prefix / "lib" / "libxeus.so").exists(),
+        labextensions=sorted(
+            pkg_json.relative_to(prefix).as_posix()
+            for pkg_json in find_extensions(prefix / SHARE_LABEXTENSIONS)
+        ),
+    )
+
+
+def load_prefix_index(prefix, find_extensions, cache_dir=None):
+    """Return the index of a prefix, from ``cache_dir`` if the prefix did not change"""
+    key = installed_packages_key(prefix)
+    cache_path = None
+    if cache_dir is not None:
+        name = hashlib.sha256(str(Path(prefix).resolve()).encode()).hexdigest()[:16]
+        cache_path = Path(cache_dir) / f"{name}.json"
+        if cache_path.is_file():
+            try:
+                cached = json.loads(cache_path.read_text(encoding="utf-8"))
+            except ValueError:
+                cached = {}
+            if cached.get("key") == key:
+                return cached["index"]
+
+    index = build_prefix_index(prefix, find_extensions)
+
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_name(f".{cache_path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(dict(key=key, index=index)), encoding="utf-8")
+        os.replace(tmp, cache_path)
+
+    return index
@@ -0,0 +1,286 @@
+"""Pruning of the Python modules that user code can never import.
+
+The jupyterlite contents and an allow-list of modules are the roots of a static import
+graph over the prefix ``site-packages``. Modules outside of the closure of these roots
+are left out of the packed environment, with a few conservative rules:
+
+- only ``site-packages`` is pruned, never the standard library
+- top-level packages shipping compiled extensions are kept whole when they are reached,
+  as extensions may import Python modules in ways that can't be seen statically
+- package data (anything which is not Python code) is kept in reached packages
+"""
+
+import ast
+from collections import defaultdict
+import glob
+import json
+import os
+from pathlib import Path
+
+EXTENSION_SUFFIXES = (".so", ".pyd")
+
+
+def _parse(source):
+    try:
+        return ast.parse(source)
+    except (SyntaxError, ValueError):
+        return None
+
+
+def _notebook_sources(path):
+    """Return the code cells of a notebook, without IPython magics and shell commands"""
+    try:
+        notebook = json.loads(Path(path).read_text(encoding="utf-8"))
+    except (ValueError, UnicodeDecodeError):
+        return []
+
+    sources = []
+    for cell in notebook.get("cells", []):
+        if cell.get("cell_type") != "code":
+            continue
+        source = cell.get("source", "")
+        if isinstance(source, list):
+            source = "".join(source)
+        sources.append(
+            "\n".join(
+                "" if line.lstrip().startswith(("%", "!", "?")) else line
+                for line in source.splitlines()
+            )
+        )
+    return sources
+
+
+def _dotted_name(node):
+    """Return ``a.b.c`` for an attribute chain on a name, None otherwise"""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return ".".join(reversed(parts))
+
+
+def _resolve_relative(module, level, package):
+    if level == 0:
+        return module
+    base = package.split(".")
+    if level > 1:
+        base = base[: -(level - 1)]
+    return ".".join(base + ([module] if module else []))
+
+
+def find_imports(tree, package=""):
+    """Return the names of the modules a module may import.
+
+    Besides import statements, this includes the string arguments of ``importlib.import_module``
+    and ``__import__``, and attribute chains on imported modules as they may be submodules,
+    e.g. ``scipy.linalg`` after ``import scipy``.
+    """
+    imports = set()
+    aliases = {}
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.add(alias.name)
+                if alias.asname:
+                    aliases[alias.asname] = alias.name
+                else:
+                    top = alias.name.split(".")[0]
+                    aliases[top] = top
+        elif isinstance(node, ast.ImportFrom):
+            module = _resolve_relative(node.module or "", node.level, package)
+            if not module:
+                continue
+            imports.add(module)
+            for alias in node.names:
+                if alias.name != "*":
+                    imports.add(f"{module}.{alias.name}")
+                    aliases[alias.asname or alias.name] = f"{module}.{alias.name}"
+        elif isinstance(node, ast.Call) and node.args:
+            func = node.func
+            name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+            arg = node.args[0]
+            if name in ("import_module", "__import__") and isinstance(arg, ast.Constant):
+                if isinstance(arg.value, str):
+                    level = len(arg.value) - len(arg.value.lstrip("."))
+                    imports.add(_resolve_relative(arg.value.lstrip("."), level, package))
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute):
+            dotted = _dotted_name(node)
+            if dotted is None:
+                continue
+            root, _, rest = dotted.partition(".")
+            if root in aliases and rest:
+                imports.add(f"{aliases[root]}.{rest}")
+
+    return imports
+
+
+def scan_roots(paths):
+    """Return the modules imported by the notebooks and Python files under ``paths``"""
+    imports = set()
+    for path in paths:
+        path = Path(path)
+        files = [path] if path.is_file() else sorted(path.rglob("*"))
+        for file in files:
+            if file.suffix == ".py":
+                sources = [file.read_text(encoding="utf-8", errors="replace")]
+            elif file.suffix == ".ipynb":
+                sources = _notebook_sources(file)
+            else:
+                continue
+            for source in sources:
+                tree = _parse(source)
+                if tree is not None:
+                    imports |= find_imports(tree)
+    return imports
+
+
+class ModuleIndex:
+    """The Python modules of a ``site-packages`` directory, by name"""
+
+    def __init__(self, site_packages):
+        self.site_packages = Path(site_packages)
+        # module name -> path relative to site-packages
+        self.modules = {}
+        self.compiled = set()
+        # top-level name -> files relative to site-packages
+        self.files = defaultdict(list)
+        self.pth_files = []
+
+        for root, dirs, files in os.walk(self.site_packages):
+            dirs.sort()
+            relative_root = Path(root).relative_to(self.site_packages)
+            top = relative_root.parts[0] if relative_root.parts else None
+            # Metadata, data directories and bytecode of single file modules are kept
+            if top is not None and ("." in top or top == "__pycache__"):
+                continue
+
+            for filename in sorted(files):
+                relative_path = relative_root / filename
+                name = filename.split(".")[0]
+                parts = list(relative_root.parts)
+
+                if top is None:
+                    if filename.endswith(".pth"):
+                        self.pth_files.append(relative_path)
+                    # Single file modules, e.g. six.py
+                    if filename.endswith(".py") or filename.endswith(EXTENSION_SUFFIXES):
+                        self.files[name].append(relative_path)
+                        self.modules[name] = relative_path
+                        if not filename.endswith(".py"):
+                            self.compiled.add(name)
+                    continue
+
+                self.files[top].append(relative_path)
+                if filename.endswith(".py"):
+                    if name != "__init__":
+                        parts.append(name)
+                    self.modules[".".join(parts)] = relative_path
+                elif filename.endswith(EXTENSION_SUFFIXES):
+                    self.modules[".".join(parts + [name])] = relative_path
+                    self.compiled.add(top)
+
+    def imports_of(self, module):
+        path = self.modules[module]
+        if path.suffix != ".py":
+            return set()
+        tree = _parse((self.site_packages / path).read_bytes())
+        if tree is None:
+            return set()
+        package = module if path.name == "__init__.py" else module.rpartition(".")[0]
+        return find_imports(tree, package)
+
+
+def import_closure(roots, index):
+    """Return the modules of ``index`` transitively imported from the ``roots``"""
+    reached = set()
+    queue = list(roots)
+    while queue:
+        name = queue.pop()
+        parts = name.split(".")
+        # Importing a.b.c imports a and a.b first
+        for end in range(1, len(parts) + 1):
+            candidate = ".".join(parts[:end])
+            if candidate in reached or candidate not in index.modules:
+                continue
+            reached.add(candidate)
+            queue.extend(index.imports_of(candidate))
+    return reached
+
+
+def pth_imports(index):
+    """Return the modules imported by the .pth files, which are run at startup"""
+    imports = set()
+    for pth_file in index.pth_files:
+        for line in (index.site_packages / pth_file).read_text(errors="replace").splitlines():
+            if line.startswith(("import ", "import\t")):
+                tree = _parse(line)
+                if tree is not None:
+                    imports |= find_imports(tree)
+    return imports
+
+
+def find_site_packages(prefix):
+    # Like empack, skip the lib/python3.1 compatibility symlink of Python 3.1x prefixes
+    matches = [
+        Path(match)
+        for match in sorted(glob.glob(os.path.join(prefix, "lib", "python3.*", "site-packages")))
+        if Path(match).parent.name != "python3.1" and not Path(match).parent.is_symlink()
+    ]
+    return matches[0] if matches else None
+
+
+def prune_plan(prefix, roots):
+    """Return the prefix-relative paths to leave out of the packed environment, and a summary.
+
+    The summary maps each pruned top-level package to the number of files and bytes removed.
+    """
+    site_packages = find_site_packages(prefix)
+    if site_packages is None:
+        return set(), {}
+
+    index = ModuleIndex(site_packages)
+    reached = import_closure(set(roots) | pth_imports(index), index)
+    reached_tops = {module.split(".")[0] for module in reached}
+    site_packages_prefix = site_packages.relative_to(prefix)
+
+    excluded = set()
+    summary = {}
+    importable_tops = {module.split(".")[0] for module in index.modules}
+    for top, files in index.files.items():
+        if top not in importable_tops:
+            # Not a Python package, e.g. a data directory
+            continue
+        if top not in reached_tops:
+            removed = files
+        elif top in index.compiled:
+            continue
+        else:
+            pruned_modules = {
+                path for module, path in index.modules.items()
+                if module.split(".")[0] == top and module not in reached
+            }
+            pruned_stems = {(path.parent, path.stem) for path in pruned_modules}
+            removed = [
+                path for path in files
+                if path in pruned_modules
+                or (
+                    path.suffix == ".pyc"
+                    and path.parent.name == "__pycache__"
+                    and (path.parent.parent, path.name.split(".")[0]) in pruned_stems
+                )
+            ]
+
+        if removed:
+            summary[top] = dict(
+                files=len(removed),
+                bytes=sum((site_packages / path).stat().st_size for path in removed),
+            )
+            excluded.update((site_packages_prefix / path).as_posix() for path in removed)
+
+    return excluded, summary
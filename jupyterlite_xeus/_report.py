@@ -0,0 +1,102 @@
+"""Timing and size report of the xeus build phases"""
+
+from contextlib import contextmanager, nullcontext
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+
+def path_size(path):
+    """Return the size in bytes of a file, or of all files in a directory"""
+    path = Path(path)
+    if path.is_symlink() or path.is_file():
+        return path.lstat().st_size
+    if not path.is_dir():
+        return 0
+
+    size = 0
+    for root, _dirs, files in os.walk(path):
+        for file in files:
+            size += os.lstat(os.path.join(root, file)).st_size
+    return size
+
+
+def _cpu_time():
+    # Include the CPU time of finished subprocesses, e.g. micromamba or pip
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def phase(report, name, env_name=None, **details):
+    """Record a phase in ``report``, which may be None"""
+    if report is None:
+        return nullcontext({})
+    return report.phase(name, env_name, **details)
+
+
+class BuildReport:
+    """Collect the wall time, CPU time and bytes written by each build phase.
+
+    CPU times are process-wide, so they overlap for phases running concurrently.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, env_name=None, **details):
+        record = dict(phase=name, env_name=env_name, bytes_written=0, **details)
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_time()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = round(time.perf_counter() - start_wall, 6)
+            record["cpu_time"] = round(_cpu_time() - start_cpu, 6)
+            with self._lock:
+                self.records.append(record)
+
+    def timed_action(self, action, name, env_name=None, outputs=(), **details):
+        """Wrap a doit python-action, recording it as a phase"""
+        func, args = action
+
+        def timed(*args):
+            with self.phase(name, env_name, **details) as record:
+                result = func(*args)
+                record["bytes_written"] = sum(path_size(output) for output in outputs)
+            return result
+
+        return (timed, args)
+
+    def totals(self):
+        """Aggregate the records per phase"""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(
+                record["phase"], dict(count=0, wall_time=0, cpu_time=0, bytes_written=0)
+            )
+            total["count"] += 1
+            for key in ["wall_time", "cpu_time", "bytes_written"]:
+                total[key] += record[key]
+        return totals
+
+    def to_dict(self):
+        return dict(phases=self.totals(), records=self.records)
+
+    def write(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(), indent=2), encoding="utf-8")
+
+    def summary(self):
+        """Return a few human readable lines, one per phase"""
+        return [
+            f"{name}: {total['wall_time']:.2f}s wall, {total['cpu_time']:.2f}s cpu, "
+            f"{total['bytes_written'] / 1024**2:.1f}MB written ({total['count']}x)"
+            for name, total in sorted(
+                self.totals().items(), key=lambda item: -item[1]["wall_time"]
+            )
+        ]
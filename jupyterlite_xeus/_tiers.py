@@ -0,0 +1,117 @@
+"""Startup and deferred tiers of the packed packages.
+
+Kernels load the startup packages before they start, and the deferred ones in the
+background once they run. The startup tier is the closure, over the package dependencies, of:
+
+- the packages without Python modules in ``site-packages``, e.g. the interpreter and
+  the shared libraries, as they can't be traced
+- the packages owning the modules statically imported from the boot modules
+- the packages and files of boot traces, recorded from a running kernel
+"""
+
+import json
+import re
+from pathlib import Path, PurePosixPath
+
+from ._prune import EXTENSION_SUFFIXES, ModuleIndex, find_site_packages, import_closure, pth_imports
+
+
+def dependency_names(pkg):
+    """Return the names of the dependencies of a package, without their version constraints"""
+    return [re.split(r"[\s<>=!~]", dependency, maxsplit=1)[0] for dependency in pkg.get("depends", [])]
+
+
+def read_boot_trace(path):
+    """Return the entries of a boot trace: a JSON list of package names and absolute
+    file paths in the kernel file system, or an object with such a ``files`` list
+    """
+    trace = json.loads(Path(path).read_text(encoding="utf-8"))
+    if isinstance(trace, dict):
+        trace = trace.get("files", [])
+    if not isinstance(trace, list) or not all(isinstance(entry, str) for entry in trace):
+        raise ValueError(f"Invalid boot trace {path}, must be a list of package names and file paths")
+    return trace
+
+
+def startup_packages(prefix, packages, modules, traces=()):
+    """Return the names of the startup ``packages``, the entries of the packed environment meta.
+
+    ``modules`` are the modules imported at boot, and ``traces`` are boot trace entries.
+    """
+    prefix = Path(prefix)
+    names = {pkg["name"] for pkg in packages}
+    site_packages = find_site_packages(prefix)
+    site_packages_prefix = (
+        PurePosixPath(site_packages.relative_to(prefix).as_posix()) if site_packages else None
+    )
+
+    # prefix-relative path -> package name
+    owners = {}
+    python_packages = set()
+    for pkg in packages:
+        meta_path = prefix / "conda-meta" / f"{pkg['filename_stem']}.json"
+        if not meta_path.is_file():
+            continue
+        for _file in json.loads(meta_path.read_text(encoding="utf-8")).get("files", []):
+            _file = PurePosixPath(Path(_file).as_posix())
+            owners[_file] = pkg["name"]
+            if (
+                site_packages_prefix in _file.parents
+                and _file.suffix in (".py", *EXTENSION_SUFFIXES)
+            ):
+                python_packages.add(pkg["name"])
+
+    startup = names - python_packages
+
+    if site_packages is not None:
+        index = ModuleIndex(site_packages)
+        for module in import_closure(set(modules) | pth_imports(index), index):
+            owner = owners.get(site_packages_prefix / index.modules[module].as_posix())
+            if owner is not None:
+                startup.add(owner)
+
+    for entry in traces:
+        if entry in names:
+            startup.add(entry)
+        elif (owner := owners.get(PurePosixPath(entry.lstrip("/")))) is not None:
+            startup.add(owner)
+
+    # The dependencies of startup packages are needed at startup as well
+    depends = {pkg["name"]: dependency_names(pkg) for pkg in packages}
+    queue = list(startup)
+    while queue:
+        for name in depends.get(queue.pop(), []):
+            if name in names and name not in startup:
+                startup.add(name)
+                queue.append(name)
+
+    return startup
+
+
+def package_modules(prefix, packages):
+    """Return the names of the top-level modules of ``packages`` in ``site-packages``,
+    per package name
+    """
+    prefix = Path(prefix)
+    site_packages = find_site_packages(prefix)
+    if site_packages is None:
+        return {}
+    site_packages_prefix = PurePosixPath(site_packages.relative_to(prefix).as_posix())
+
+    modules = {}
+    for pkg in packages:
+        meta_path = prefix / "conda-meta" / f"{pkg['filename_stem']}.json"
+        if not meta_path.is_file():
+            continue
+        names = set()
+        for _file in json.loads(meta_path.read_text(encoding="utf-8")).get("files", []):
+            _file = PurePosixPath(Path(_file).as_posix())
+            if site_packages_prefix not in _file.parents:
+                continue
+            parts = _file.relative_to(site_packages_prefix).parts
+            if len(parts) == 1 and _file.suffix in (".py", *EXTENSION_SUFFIXES):
+                names.add(parts[0].split(".")[0])
+            elif len(parts) > 1 and parts[0].isidentifier():
+                names.add(parts[0])
+        modules[pkg["name"]] = sorted(names)
+    return modules
@@ -0,0 +1,25 @@
+"""Small helpers shared across the addon"""
+
+import hashlib
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """Return the hex sha256 digest of a file, without loading it in memory"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hashed_filename(name, digest):
+    """Insert a content digest in a filename, before its extension, e.g. ``a.<digest>.tar.gz``"""
+    if ".tar.gz" in name:
+        stem, _, rest = name.partition(".tar.gz")
+        return f"{stem}.{digest}.tar.gz{rest}"
+    stem, dot, suffix = name.rpartition(".")
+    if not dot:
+        return f"{name}.{digest}"
+    return f"{stem}.{digest}.{suffix}"
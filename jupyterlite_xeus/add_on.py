@@ -1,18 +1,18 @@
 """a JupyterLite addon for creating the env for xeus kernels"""
 
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+import hashlib
 import json
 import os
 from pathlib import Path
 import shutil
-import shlex
 from tempfile import TemporaryDirectory
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 import warnings
-import ast
 
 import yaml
 
-import requests
+from doit.tools import config_changed
 
 from jupyterlite_core.addons.federated_extensions import FederatedExtensionAddon
 from jupyterlite_core.constants import (
@@ -20,56 +20,59 @@ from jupyterlite_core.constants import (
     FEDERATED_EXTENSIONS,
     JUPYTERLITE_JSON,
     LAB_EXTENSIONS,
-    SHARE_LABEXTENSIONS,
     UTF8,
 )
-from traitlets import Bool, Callable, List, Unicode
+from traitlets import Bool, Callable, Dict, Enum, Float, Int, List, Unicode, observe
 
 from .create_conda_env import (
+    FINGERPRINT_FILE,
     create_conda_env_from_env_file,
     create_conda_env_from_specs,
+    get_env_file_fingerprint,
+    is_prefix_up_to_date,
+    write_explicit_lock,
 )
-from .constants import EXTENSION_NAME, DEFAULT_CHANNELS
+from .constants import (
+    ASSET_MANIFEST,
+    EXTENSION_NAME,
+    DEFAULT_CHANNELS,
+    EMPACK_ENV_META,
+    KERNEL_MODULES,
+    LAZY_FILES_INDEX,
+)
+from ._analyze import analyze_env, summarize
+from ._bundle import plan_bundles, write_bundle
+from ._bytecode import BytecodeCompiler
+from ._fetch import fetch_cached
+from ._compress import (
+    PRECOMPRESS_ENCODINGS,
+    PRECOMPRESS_INDEX,
+    check_encodings,
+    precompress_directory,
+)
+from ._materialize import MATERIALIZATION_MODES, materialize
+from ._pack import PackCache, mount_fingerprint, pack_env, split_tarball
+from ._prefix_index import kernel_binaries, load_prefix_index
+from ._prune import prune_plan, scan_roots
+from ._report import BuildReport, path_size, phase
+from ._tiers import package_modules, read_boot_trace, startup_packages
+from ._utils import file_sha256, hashed_filename
 
 from empack.pack import (
     DEFAULT_CONFIG_PATH,
-    pack_env,
     pack_directory,
     pack_file,
     add_tarfile_to_env_meta,
 )
-from empack.file_patterns import PkgFileFilter, pkg_file_filter_from_yaml
-
-EMPACK_ENV_META = "empack_env_meta.json"
+from empack.file_patterns import PkgFileFilter
 
 
 def get_kernel_binaries(path):
     """Return paths to the kernel binaries (js, wasm, and optionally data) if they exist, else None."""
-    json_file = path / "kernel.json"
-    if json_file.exists():
-        kernel_spec = json.loads(json_file.read_text(**UTF8))
-        argv = kernel_spec.get("argv")
-        kernel_binary = argv[0]
-
-        kernel_binary_js = Path(kernel_binary + ".js")
-        kernel_binary_wasm = Path(kernel_binary + ".wasm")
-        kernel_binary_data = Path(kernel_binary + ".data")
-
-        if kernel_binary_js.exists() and kernel_binary_wasm.exists():
-            # Return all three, with None for .data if it doesn't exist
-            # as this might not be neccessary for all kernels.
-            return (
-                kernel_binary_js,
-                kernel_binary_wasm,
-                kernel_binary_data if kernel_binary_data.exists() else None,
-            )
-        else:
-            warnings.warn(f"kernel binaries not found for {path.name}")
-
-    else:
-        warnings.warn(f"kernel.json not found for {path.name}")
-
-    return None
+    binaries, problem = kernel_binaries(path)
+    if problem is not None:
+        warnings.warn(problem)
+    return binaries
 
 
 class ListLike(List):
@@ -87,6 +90,25 @@ class XeusAddon(FederatedExtensionAddon):
         description="The path or URL to the empack config file",
     )
 
+    fetch_cache_dir = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="The directory where remote build inputs, like an empack config URL, are cached between builds. Defaults to xeus/fetch in the JupyterLite cache directory",
+    )
+
+    fetch_timeout = Float(
+        30,
+        config=True,
+        description="The timeout in seconds of the requests fetching remote build inputs",
+    )
+
+    offline = Bool(
+        False,
+        config=True,
+        description="Whether to use the cached copies of remote build inputs without fetching them, e.g. in air-gapped CI",
+    )
+
     environment_file = ListLike(
         [],
         config=True,
@@ -99,6 +121,19 @@ class XeusAddon(FederatedExtensionAddon):
         description="The path to the wasm prefix",
     )
 
+    lock_file = ListLike(
+        [],
+        config=True,
+        description="Lock files to create the environments from without solving, one per environment file and in the same order. Either an explicit lock file (@EXPLICIT), a conda-lock file, or the empack_env_meta.json of a previous build",
+    )
+
+    lock_dir = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="A directory where to write an explicit lock file of each environment, named <env_name>-explicit.txt, which can be passed back with the lock_file option",
+    )
+
     default_channels = ListLike(
         [],
         config=True,
@@ -112,6 +147,19 @@ class XeusAddon(FederatedExtensionAddon):
         description="Whether or not to mount the jupyterlite content into the kernel. This would make the jupyterlite content available under the '/files' directory, and the kernels will automatically be started from there.",
     )
 
+    content_mount = Enum(
+        ["tarball", "lazy", "auto"],
+        "tarball",
+        config=True,
+        description="How the jupyterlite content is mounted under '/files'. 'tarball' packs all files in a tarball that kernels extract before starting, 'lazy' writes an index of the files so that kernels only fetch them on first access, and 'auto' uses 'lazy' when the content is larger than lazy_content_threshold",
+    )
+
+    lazy_content_threshold = Int(
+        50 * 1024**2,
+        config=True,
+        description="The size in bytes of the jupyterlite content above which it is mounted lazily, when content_mount is 'auto'",
+    )
+
     mounts = ListLike(
         [],
         config=True,
@@ -125,13 +173,225 @@ class XeusAddon(FederatedExtensionAddon):
         description="Factory to generate package download URL from package metadata. This is used to load python packages from external host",
     )
 
+    chunk_threshold = Int(
+        None,
+        allow_none=True,
+        config=True,
+        description="The size in bytes above which packed packages are split into chunks, which kernels download concurrently. Packages are not split if not set",
+    )
+
+    chunk_size = Int(
+        8 * 1024**2,
+        config=True,
+        description="The size in bytes of the chunks of the packages larger than chunk_threshold",
+    )
+
+    bundle_threshold = Int(
+        None,
+        allow_none=True,
+        config=True,
+        description="The size in bytes under which packed packages are merged into bundles, so that kernels fetch them with fewer requests. Packages are not bundled if not set",
+    )
+
+    bundle_size = Int(
+        4 * 1024**2,
+        config=True,
+        description="The target size in bytes of the bundles of small packages",
+    )
+
+    external_packages = Bool(
+        False,
+        config=True,
+        description="Whether to leave out of the build the packages which package_url_factory gives a URL for. They are neither packed nor copied, and kernels load them from their URL, along with the sha256 of their conda package",
+    )
+
+    external_packages_mirror = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="A local mirror of the external packages, named after their URL basename. When set, the build checks the external packages against their sha256",
+    )
+
+    pack_cache_dir = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="The directory where packed packages are cached between builds. Packages are only repacked when they, or the empack filters applying to them, change. Caching is disabled if not set",
+    )
+
+    pack_cache_size_limit = Int(
+        5 * 1024**3,
+        allow_none=True,
+        config=True,
+        description="The maximum size in bytes of the pack cache, least recently used packages are evicted above it. Set to None for an unbounded cache",
+    )
+
+    build_cache_dir = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="A directory where environments and intermediate build files are kept between builds. Environments are only re-created when their environment file changes. A temporary directory is used if not set",
+    )
+
+    shared_packages = Bool(
+        False,
+        config=True,
+        description="Whether to store package tarballs once under xeus/packages, named after their content hash, instead of once per environment. Packages common to multiple environments are then only downloaded and cached once by the browser",
+    )
+
+    shared_kernel_binaries = Bool(
+        False,
+        config=True,
+        description="Whether to store the kernel binaries and shared libraries in a pool shared by all environments, under xeus/bin/<content hash>, so that identical binaries are downloaded and cached by the browser only once",
+    )
+
+    hashed_filenames = Bool(
+        False,
+        config=True,
+        description="Whether to name the packages, mounts and kernel binaries after their content hash, and to write an asset manifest. The hashed files never change, so they can be served with an immutable cache policy",
+    )
+
+    materialization = Enum(
+        MATERIALIZATION_MODES,
+        "copy",
+        config=True,
+        description="How kernel binaries, shared libraries and packed packages are put in the output directory: 'copy', 'hardlink', 'reflink' (copy-on-write clone) or 'symlink'. Falls back to a copy when not possible, e.g. across filesystems",
+    )
+
+    wheel_cache_dir = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="The directory where wheels of pip dependencies are cached between builds. Pinned dependencies (name==version) found there are installed without calling pip",
+    )
+
+    wheelhouse = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="A local directory of wheels to install pip dependencies from, before looking at the package index",
+    )
+
+    precompress = List(
+        Enum(list(PRECOMPRESS_ENCODINGS)),
+        [],
+        config=True,
+        description="Encodings among 'gzip', 'br' and 'zstd' to precompress the kernel binaries and metadata with, written next to them as .gz, .br and .zst files for static hosts to serve. 'br' and 'zstd' need the brotli and zstandard packages",
+    )
+
+    precompress_max_ratio = Float(
+        0.9,
+        config=True,
+        description="Precompressed files are only written when their size is at most this ratio of the original size",
+    )
+
+    analyze_bundle = Bool(
+        False,
+        config=True,
+        description="Whether to log the compressed and uncompressed size of each environment per package, per file class (tests, docs, headers, bytecode...) and per kernel. The analysis is also part of the build report",
+    )
+
+    size_budgets = Dict(
+        value_trait=Int(),
+        default_value={},
+        config=True,
+        description="The maximum download size in bytes of each environment, by environment name. The '*' key applies to all other environments",
+    )
+
+    size_budget_action = Enum(
+        ["warn", "error"],
+        "error",
+        config=True,
+        description="Whether to warn or to fail the build when an environment is larger than its size budget",
+    )
+
+    prune_imports = Bool(
+        False,
+        config=True,
+        description="Whether to leave out the Python modules of site-packages that the jupyterlite contents, the mounts and the prune_keep modules never import, directly or not",
+    )
+
+    prune_keep = List(
+        Unicode(),
+        KERNEL_MODULES,
+        config=True,
+        description="Modules to always keep, with their imports, when pruning. Add the modules that are imported dynamically, e.g. from their name as a string",
+    )
+
+    compile_bytecode = Bool(
+        False,
+        config=True,
+        description="Whether to compile the packed Python modules to bytecode at build time, so that kernels don't compile them on every start. This needs a host python matching the environment Python version",
+    )
+
+    bytecode_optimization = Enum(
+        [0, 1, 2],
+        0,
+        config=True,
+        description="The bytecode optimization level: 0 for none, 1 to remove assertions, 2 to also remove docstrings",
+    )
+
+    bytecode_keep_sources = Bool(
+        True,
+        config=True,
+        description="Whether to pack the Python sources along with their bytecode. Without sources, packages are smaller but tracebacks and introspection can't show the code",
+    )
+
+    bytecode_python = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="The host python used for compiling bytecode. Defaults to python3.X from the PATH, X being the environment Python minor version",
+    )
+
+    package_tiers = Bool(
+        False,
+        config=True,
+        description="Whether to split the packages into a startup tier, loaded before the kernel starts, and a deferred tier, loaded in the background once the kernel runs",
+    )
+
+    startup_imports = List(
+        Unicode(),
+        [],
+        config=True,
+        description="Modules to import at startup on top of the kernel ones, e.g. the modules of the first notebook cells. Their packages are in the startup tier",
+    )
+
+    boot_traces = ListLike(
+        [],
+        config=True,
+        description="The paths of boot traces recorded from running kernels: JSON lists of package names and file paths that are used at startup. Their packages are in the startup tier",
+    )
+
+    build_report = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        description="The path of a JSON file where to write the wall time, CPU time and bytes written by each build phase",
+    )
+
+    environment_workers = Int(
+        1,
+        config=True,
+        description="The number of environments to create concurrently when multiple environment files are provided",
+    )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.xeus_output_dir = Path(self.manager.output_dir) / "xeus"
         self.cwd = TemporaryDirectory()
-        # TODO Make this configurable
-        # You can provide another cwd_name if you want
-        self.cwd_name = self.cwd.name
+        self._on_build_cache_dir_change(dict(new=self.build_cache_dir))
+        self.prefix_indexes = {}
+        self.file_filters = None
+        self.file_filters_config = None
+
+    @observe("build_cache_dir")
+    def _on_build_cache_dir_change(self, change):
+        self.cwd_name = str(self.lite_path(change["new"])) if change["new"] else self.cwd.name
+
+    def lite_path(self, path):
+        """Resolve a path option relative to the lite_dir, like the environment files"""
+        return Path(self.manager.lite_dir) / path
 
     def post_build(self, manager):
         if not self.environment_file:
@@ -145,15 +405,35 @@ class XeusAddon(FederatedExtensionAddon):
         if not self.prefix and not self.environment_file:
             raise ValueError("Either prefix or environment_file must be set")
 
+        # Fail before creating environments if a compression package is missing
+        check_encodings(self.precompress)
+
         # create the prefixes if it does not exist
         self.prefixes = {}
         self.specs = {}
         self.channels = {}
+        self.shared_package_hashes = set()
+        self.shared_binary_hashes = set()
+        # Outputs named after their content, which never change
+        self.immutable_assets = set()
+        self.content_index = None
+        self.prefix_indexes = {}
+        self.file_filters = None
+        self.file_filters_config = None
+        self.report = BuildReport()
         if not self.prefix:
-            for environment_file in self.environment_file:
-                env_name, prefix = self.create_prefix(Path(self.manager.lite_dir) / environment_file)
-                if env_name in self.prefixes:
-                    raise ValueError(f"Environment name '{env_name}' used more than once")
+            env_files = [
+                Path(self.manager.lite_dir) / environment_file
+                for environment_file in self.environment_file
+            ]
+            if self.lock_file and len(self.lock_file) != len(env_files):
+                raise ValueError(
+                    f"{len(self.lock_file)} lock files given for {len(env_files)} environment files, there must be one per environment file"
+                )
+            lock_files = [
+                Path(self.manager.lite_dir) / lock_file for lock_file in self.lock_file
+            ] or [None] * len(env_files)
+            for env_name, prefix in self.create_prefixes(env_files, lock_files):
                 self.prefixes[env_name] = prefix
         else:
             for prefix in self.prefix:
@@ -167,6 +447,16 @@ class XeusAddon(FederatedExtensionAddon):
                 self.specs[env_name] = self.get_environment_specs(prefix)
                 self.channels[env_name] = self.get_environment_channels(prefix)
 
+        if self.lock_dir is not None:
+            for env_name, prefix in self.prefixes.items():
+                lock_path = Path(self.manager.lite_dir) / self.lock_dir / f"{env_name}-explicit.txt"
+                yield dict(
+                    name=f"lock:{env_name}",
+                    file_dep=[Path(prefix) / "conda-meta" / "history"],
+                    targets=[lock_path],
+                    actions=[(write_explicit_lock, [prefix, lock_path])],
+                )
+
         all_kernels = []
         for env_name, prefix in self.prefixes.items():
             # copy the kernels from the prefix
@@ -174,61 +464,136 @@ class XeusAddon(FederatedExtensionAddon):
             if kernels is not None:
                 all_kernels.extend(kernels)
 
-            # copy the jupyterlab extensions
-            yield from self.copy_jupyterlab_extensions_from_prefix(prefix)
+        # copy the jupyterlab extensions, once for all the environments shipping them
+        yield from self.copy_jupyterlab_extensions()
+        yield from self.patch_jupyterlab_extensions()
+
+        # copy the index of the lazily mounted jupyterlite content, shared by all environments
+        if self.content_index is not None:
+            yield dict(
+                name=f"copy:{LAZY_FILES_INDEX}",
+                file_dep=[self.content_index],
+                targets=[self.xeus_output_dir / LAZY_FILES_INDEX],
+                actions=[
+                    (self.copy_one, [self.content_index, self.xeus_output_dir / LAZY_FILES_INDEX])
+                ],
+            )
 
         # write the kernels.json file
         kernel_file = Path(self.cwd_name) / "kernels.json"
         kernel_file.write_text(json.dumps(all_kernels), **UTF8)
         yield dict(
             name=f"copy:{kernel_file}",
+            file_dep=[kernel_file],
+            targets=[self.xeus_output_dir / "kernels.json"],
             actions=[
                 (self.copy_one, [kernel_file, self.xeus_output_dir / "kernels.json"])
             ],
         )
 
+        if self.precompress:
+            yield dict(
+                name="precompress",
+                actions=[(self.precompress_outputs, [])],
+            )
+
+        if self.hashed_filenames:
+            yield dict(
+                name=f"write:{ASSET_MANIFEST}",
+                actions=[(self.write_asset_manifest, [])],
+            )
+
+        # Always runs, after all the other tasks
+        yield dict(
+            name="report",
+            actions=[(self.write_report, [])],
+        )
+
+    def instrument(self, task, phase, env_name=None):
+        """Record the actions of a task as a phase of the build report"""
+        actions = task["actions"]
+        task["actions"] = [
+            self.report.timed_action(
+                action,
+                phase,
+                env_name,
+                # Outputs are measured once all actions are done
+                outputs=task.get("targets", []) if index == len(actions) - 1 else [],
+                task=task["name"],
+            )
+            for index, action in enumerate(actions)
+        ]
+        return task
+
+    def write_report(self):
+        for line in self.report.summary():
+            self.log.info(f"[xeus] {line}")
+
+        if self.build_report is not None:
+            self.report.write(Path(self.manager.lite_dir) / self.build_report)
+
+    def precompress_outputs(self):
+        with self.report.phase("precompress") as record:
+            results = precompress_directory(
+                self.xeus_output_dir, self.precompress, self.precompress_max_ratio
+            )
+            record["bytes_written"] = sum(
+                size for sizes in results.values() for size in sizes.values() if size
+            )
+
+        skipped = sum(None in sizes.values() for sizes in results.values())
+        self.log.info(
+            f"[xeus] precompressed {len(results) - skipped} files, {skipped} did not compress well enough"
+        )
+
+    def write_asset_manifest(self):
+        """List the xeus outputs with their hash and size, and whether they are immutable"""
+        manifest_path = self.xeus_output_dir / ASSET_MANIFEST
+        immutable = {path.relative_to(self.manager.output_dir) for path in self.immutable_assets}
+
+        assets = {}
+        with self.report.phase("asset_manifest") as record:
+            for path in sorted(self.xeus_output_dir.rglob("*")):
+                if not path.is_file() or path in (manifest_path, self.xeus_output_dir / PRECOMPRESS_INDEX):
+                    continue
+                relative_path = path.relative_to(self.manager.output_dir)
+                # Precompressed siblings are as immutable as their original
+                is_immutable = relative_path in immutable or (
+                    relative_path.suffix in PRECOMPRESS_ENCODINGS.values()
+                    and relative_path.with_suffix("") in immutable
+                )
+                assets[relative_path.as_posix()] = dict(
+                    sha256=file_sha256(path),
+                    size=path.stat().st_size,
+                    immutable=is_immutable,
+                )
+
+            manifest_path.write_text(json.dumps(dict(assets=assets), indent=2), **UTF8)
+            record["bytes_written"] = path_size(manifest_path)
+
+        self.log.info(
+            f"[xeus] listed {len(assets)} assets in {ASSET_MANIFEST}, "
+            f"{sum(asset['immutable'] for asset in assets.values())} immutable"
+        )
+
+    def prefix_index(self, prefix):
+        """Return the index of a prefix, computed once per build and cached between builds"""
+        key = str(prefix)
+        if key not in self.prefix_indexes:
+            # The report is only set up by post_build
+            with phase(getattr(self, "report", None), "prefix_index", Path(prefix).name):
+                self.prefix_indexes[key] = load_prefix_index(
+                    prefix,
+                    self.env_extensions,
+                    cache_dir=Path(self.cwd_name) / "prefix_index",
+                )
+        return self.prefix_indexes[key]
+
     def get_environment_specs(self, prefix):
-        if isinstance(prefix, str):
-            history_file_path = Path(prefix)
-        path = history_file_path / "conda-meta" / "history"
-        specs = []
-        with open(path, "r") as f:
-            for line in f:
-                if line.startswith("# update specs:"):
-                    spec_line = line.strip().removeprefix("# update specs:").strip()
-                    try:
-                        specs += ast.literal_eval(spec_line)
-                    except Exception as e:
-                        print(f"Error parsing line: {spec_line} — {e}")
-        return specs
+        return self.prefix_index(prefix)["specs"]
 
     def get_environment_channels(self, prefix):
-        if isinstance(prefix, str):
-            history_file_path = Path(prefix)
-        path = history_file_path / "conda-meta" / "history"
-        channels = []
-        with open(path, "r") as f:
-            for line in f:
-                if line.startswith("# cmd:"):
-                    tokens = shlex.split(line.removeprefix("# cmd:"))
-                    i = 0
-                    while i < len(tokens):
-                        tok = tokens[i]
-
-                        # Handle "-c URL" or "--channel URL"
-                        if tok in ("-c", "--channel"):
-                            if i + 1 < len(tokens):
-                                channels.append(tokens[i + 1])
-                            i += 2
-                            continue
-
-                        # Handle "--channel=URL"
-                        if tok.startswith("--channel="):
-                            channels.append(tok.split("=", 1)[1])
-                            i += 1
-                            continue
-
-                        i += 1
+        channels = self.prefix_index(prefix)["channels"]
 
         if len(channels) == 0:
             if len(self.default_channels) == 0:
@@ -238,7 +603,50 @@ class XeusAddon(FederatedExtensionAddon):
 
         return channels
 
-    def create_prefix(self, env_file: Path):
+    def create_prefixes(self, env_files, lock_files=None):
+        """Create the prefixes for all environment files, possibly concurrently"""
+        lock_files = lock_files or [None] * len(env_files)
+
+        # Check environment names up-front, so that we fail before solving anything
+        env_names = set()
+        for env_file in env_files:
+            with open(env_file, "r") as file:
+                env_name = yaml.safe_load(file)["name"]
+            if env_name in env_names:
+                raise ValueError(f"Environment name '{env_name}' used more than once")
+            env_names.add(env_name)
+
+        if self.environment_workers <= 1 or len(env_files) <= 1:
+            return [
+                self.create_prefix(env_file, lock_file)
+                for env_file, lock_file in zip(env_files, lock_files)
+            ]
+
+        # Environments share the package cache of the root prefix, micromamba locks it
+        executor = ThreadPoolExecutor(max_workers=self.environment_workers)
+        try:
+            futures = {
+                executor.submit(self.create_prefix, env_file, lock_file): env_file
+                for env_file, lock_file in zip(env_files, lock_files)
+            }
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+
+            for future in done:
+                if future.exception() is not None:
+                    self.log.error(
+                        f"[xeus] Failed to create the environment from {futures[future]}"
+                    )
+                    raise future.exception()
+        except BaseException:
+            # Fail right away: don't start the pending environments, nor wait for the running
+            # ones. Their prefixes are never reused, as they are only marked as created at the end
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        executor.shutdown()
+        return [future.result() for future in futures]
+
+    def create_prefix(self, env_file: Path, lock_file: Path = None):
         # read the environment file
         root_prefix = Path(self.cwd_name) / "_env"
 
@@ -255,38 +663,72 @@ class XeusAddon(FederatedExtensionAddon):
         self.specs[env_name] = conda_packages
         self.channels[env_name] = yaml_content.get("channels", self.default_channels)
 
-        create_conda_env_from_env_file(root_prefix, yaml_content, env_file.parent)
+        fingerprint = get_env_file_fingerprint(yaml_content, env_file.parent, lock_file)
+        if is_prefix_up_to_date(env_prefix, fingerprint):
+            self.log.info(f"[xeus] {env_name}: {env_file.name} is unchanged, reusing {env_prefix}")
+            return env_name, env_prefix
+
+        # Never reuse a prefix that was not fully created or was created from another file
+        if env_prefix.exists():
+            shutil.rmtree(env_prefix)
+
+        create_conda_env_from_env_file(
+            root_prefix,
+            yaml_content,
+            env_file.parent,
+            report=self.report,
+            wheel_cache_dir=self.wheel_cache_dir and self.lite_path(self.wheel_cache_dir),
+            wheelhouse=self.wheelhouse and self.lite_path(self.wheelhouse),
+            lock_file=lock_file,
+        )
+
+        (env_prefix / FINGERPRINT_FILE).write_text(fingerprint)
 
         return env_name, env_prefix
 
     def copy_kernels_from_prefix(self, env_name, prefix):
-        kernel_spec_path = Path(prefix) / "share" / "jupyter" / "kernels"
+        kernels = self.prefix_index(prefix)["kernels"]
 
-        if not kernel_spec_path.exists():
+        if kernels is None:
             warnings.warn(
                 f"No kernels are installed in the prefix {prefix}. Try adding e.g. xeus-python in your environment.yml file."
             )
             return
 
         all_kernels = []
+        # binaries and shared libs of each kernel, for the bundle analysis
+        kernel_files = {}
         # find all folders in the kernelspec path
-        for kernel_dir in kernel_spec_path.iterdir():
-            kernel_binaries = get_kernel_binaries(kernel_dir)
-            if kernel_binaries:
-                kernel_js, kernel_wasm, kernel_data = kernel_binaries
-                all_kernels.append(dict(kernel=kernel_dir.name, env_name=env_name))
-                # take care of each kernel
-                yield from self.copy_kernel(env_name, prefix, kernel_dir, kernel_wasm, kernel_js, kernel_data)
+        for kernel in kernels:
+            if kernel["binaries"] is None:
+                warnings.warn(kernel["problem"])
+                continue
+
+            kernel_dir = Path(kernel["dir"])
+            kernel_js, kernel_wasm, kernel_data = (
+                None if path is None else Path(path) for path in kernel["binaries"]
+            )
+            all_kernels.append(dict(kernel=kernel_dir.name, env_name=env_name))
+            kernel_files[kernel_dir.name] = [
+                path for path in (kernel_js, kernel_wasm, kernel_data) if path is not None
+            ] + [Path(prefix) / location for location in kernel["shared"].values()]
+            # take care of each kernel
+            for task in self.copy_kernel(env_name, prefix, kernel_dir, kernel_wasm, kernel_js, kernel_data):
+                yield self.instrument(task, "copy_kernels", env_name)
 
         # Copy libxeus shared lib file in the output
         filename = "libxeus.so"
         location = "lib/libxeus.so"
-        if (Path(prefix) / location).exists():
-            yield dict(
+        if self.prefix_index(prefix)["libxeus"] and not (
+            self.shared_kernel_binaries or self.hashed_filenames
+        ):
+            task = dict(
                 name=f"copy:{env_name}:{filename}",
+                file_dep=[Path(prefix) / location],
+                targets=[self.xeus_output_dir / env_name / filename],
                 actions=[
                     (
-                        self.copy_one,
+                        self.materialize_one,
                         [
                             Path(prefix) / location,
                             self.xeus_output_dir / env_name / filename,
@@ -294,12 +736,39 @@ class XeusAddon(FederatedExtensionAddon):
                     ),
                 ],
             )
+            yield self.instrument(task, "copy_kernels", env_name)
 
         # pack prefix packages
-        yield from self.pack_prefix(env_name, prefix)
+        for task in self.pack_prefix(env_name, prefix):
+            yield self.instrument(task, "copy_packages", env_name)
+
+        if self.analyze_bundle or self.size_budgets:
+            self.analyze_packed_env(env_name, prefix, kernel_files)
 
         return all_kernels
 
+    def analyze_packed_env(self, env_name, prefix, kernel_files):
+        """Log the size analysis of a packed environment, and check its size budget"""
+        with self.report.phase("analyze_bundle", env_name) as record:
+            analysis = analyze_env(
+                Path(self.cwd_name) / "packed_env" / env_name, prefix, kernel_files
+            )
+            record["bundle"] = analysis
+
+        if self.analyze_bundle:
+            for line in summarize(analysis):
+                self.log.info(f"[xeus] {env_name}: {line}")
+
+        budget = self.size_budgets.get(env_name, self.size_budgets.get("*"))
+        if budget is not None and analysis["total"] > budget:
+            message = (
+                f"Environment '{env_name}' is {analysis['total']} bytes, "
+                f"over its size budget of {budget} bytes"
+            )
+            if self.size_budget_action == "error":
+                raise RuntimeError(message)
+            self.log.warning(f"[xeus] {message}")
+
     def copy_kernel(self, env_name, prefix, kernel_dir, kernel_wasm, kernel_js, kernel_data):
         kernel_spec = json.loads((kernel_dir / "kernel.json").read_text(**UTF8))
 
@@ -323,9 +792,11 @@ class XeusAddon(FederatedExtensionAddon):
             # copy the logo file
             yield dict(
                 name=f"copy:{env_name}:{kernel_dir.name}:{image.name}",
+                file_dep=[kernel_dir / image.name],
+                targets=[output_image],
                 actions=[
                     (
-                        self.copy_one,
+                        self.materialize_one,
                         [
                             kernel_dir / image.name,
                             output_image,
@@ -334,14 +805,23 @@ class XeusAddon(FederatedExtensionAddon):
                 ],
             )
 
+        if self.shared_kernel_binaries or self.hashed_filenames:
+            yield from self.share_kernel_binaries(
+                prefix, kernel_spec, kernel_js, kernel_wasm, kernel_data
+            )
+            yield from self.write_kernel_json(env_name, kernel_dir, kernel_spec)
+            return
+
         if kernel_spec.get("metadata", {}).get("shared", None) is not None:
             for filename, location in kernel_spec["metadata"]["shared"].items():
                 # Copy shared lib file in the output
                 yield dict(
                     name=f"copy:{env_name}:{kernel_dir.name}:{filename}",
+                    file_dep=[Path(prefix) / location],
+                    targets=[self.xeus_output_dir / env_name / kernel_dir.name / filename],
                     actions=[
                         (
-                            self.copy_one,
+                            self.materialize_one,
                             [
                                 Path(prefix) / location,
                                 self.xeus_output_dir / env_name / kernel_dir.name / filename,
@@ -350,21 +830,21 @@ class XeusAddon(FederatedExtensionAddon):
                     ],
                 )
 
-        # write to temp file
-        kernel_json = Path(self.cwd_name) / env_name / f"{kernel_dir.name}_kernel.json"
-        kernel_json.parent.mkdir(parents=True, exist_ok=True)
-        kernel_json.write_text(json.dumps(kernel_spec), **UTF8)
-
         # copy the kernel binary files to the bin dir
         yield dict(
             name=f"copy:{env_name}:{kernel_dir.name}:binaries",
+            file_dep=[kernel_js, kernel_wasm],
+            targets=[
+                self.xeus_output_dir / env_name / "bin" / kernel_js.name,
+                self.xeus_output_dir / env_name / "bin" / kernel_wasm.name,
+            ],
             actions=[
                 (
-                    self.copy_one,
+                    self.materialize_one,
                     [kernel_js, self.xeus_output_dir / env_name / "bin" / kernel_js.name],
                 ),
                 (
-                    self.copy_one,
+                    self.materialize_one,
                     [kernel_wasm, self.xeus_output_dir / env_name / "bin" / kernel_wasm.name],
                 ),
             ],
@@ -374,17 +854,29 @@ class XeusAddon(FederatedExtensionAddon):
         if kernel_data:
             yield dict(
                 name=f"copy:{env_name}:{kernel_dir.name}:data",
+                file_dep=[kernel_data],
+                targets=[self.xeus_output_dir / env_name / "bin" / kernel_data.name],
                 actions=[
                     (
-                        self.copy_one,
+                        self.materialize_one,
                         [kernel_data, self.xeus_output_dir / env_name / "bin" / kernel_data.name],
                     ),
                 ],
             )
 
+        yield from self.write_kernel_json(env_name, kernel_dir, kernel_spec)
+
+    def write_kernel_json(self, env_name, kernel_dir, kernel_spec):
+        # write to temp file
+        kernel_json = Path(self.cwd_name) / env_name / f"{kernel_dir.name}_kernel.json"
+        kernel_json.parent.mkdir(parents=True, exist_ok=True)
+        kernel_json.write_text(json.dumps(kernel_spec), **UTF8)
+
         # copy the kernel.json file
         yield dict(
             name=f"copy:{env_name}:{kernel_dir.name}:kernel.json",
+            file_dep=[kernel_json],
+            targets=[self.xeus_output_dir / env_name / kernel_dir.name / "kernel.json"],
             actions=[
                 (
                     self.copy_one,
@@ -399,6 +891,240 @@ class XeusAddon(FederatedExtensionAddon):
             ],
         )
 
+    def share_binaries(self, files):
+        """Reference files from the shared binaries pool, under their content hash.
+
+        ``files`` maps output names to their source, and are loaded together, like the
+        .js and .wasm of a kernel: they share a directory named after the hash of all of
+        them. Returns this directory, relative to the output directory, and the tasks
+        copying the files which were not copied yet.
+        """
+        sha = hashlib.sha256()
+        for name, source in sorted(files.items()):
+            sha.update(f"{name}:{file_sha256(source)}\n".encode())
+        digest = sha.hexdigest()
+
+        tasks = []
+        # Identical binaries from other environments are only copied once
+        if digest not in self.shared_binary_hashes:
+            self.shared_binary_hashes.add(digest)
+            for name, source in files.items():
+                dest = self.xeus_output_dir / "bin" / digest / name
+                self.immutable_assets.add(dest)
+                tasks.append(
+                    dict(
+                        name=f"xeus:bin:copy:{digest}:{name}",
+                        file_dep=[source],
+                        targets=[dest],
+                        actions=[(self.materialize_one, [source, dest])],
+                    )
+                )
+
+        return f"xeus/bin/{digest}", tasks
+
+    def share_kernel_binaries(self, prefix, kernel_spec, kernel_js, kernel_wasm, kernel_data):
+        """Point a kernel spec to its binaries and shared libraries in the shared pool"""
+        binaries = {kernel_js.name: kernel_js, kernel_wasm.name: kernel_wasm}
+        if kernel_data:
+            binaries[kernel_data.name] = kernel_data
+        bin_dir, tasks = self.share_binaries(binaries)
+        kernel_spec["argv"][0] = f"{bin_dir}/{kernel_js.name}"
+        yield from tasks
+
+        metadata = kernel_spec.setdefault("metadata", {})
+        shared_urls = {}
+        for filename, location in metadata.get("shared", {}).items():
+            lib_dir, tasks = self.share_binaries({filename: Path(prefix) / location})
+            shared_urls[filename] = f"{lib_dir}/{filename}"
+            yield from tasks
+        if shared_urls:
+            metadata["shared_urls"] = shared_urls
+
+        if self.prefix_index(prefix)["libxeus"]:
+            lib_dir, tasks = self.share_binaries({"libxeus.so": Path(prefix) / "lib" / "libxeus.so"})
+            metadata["libxeus_url"] = f"{lib_dir}/libxeus.so"
+            yield from tasks
+
+    def materialize_one(self, src, dest):
+        """Put one file in the output, following the materialization option.
+
+        Unlike for ``copy_one``, the destination is not timestamped, as it may
+        share its metadata with the source.
+        """
+        if src.is_dir() or self.materialization == "copy":
+            return self.copy_one(src, dest)
+
+        if self.manager.no_sourcemaps and self.is_ignored_sourcemap(src.name):
+            return
+
+        mode = self.materialization
+        # Symlinks to our temporary directory would dangle once the build is over
+        if mode == "symlink" and Path(self.cwd.name).resolve() in src.resolve().parents:
+            mode = "hardlink"
+
+        if dest.is_dir() and not dest.is_symlink():
+            shutil.rmtree(dest)
+        elif dest.exists() or dest.is_symlink():
+            dest.unlink()
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+
+        used_mode = materialize(src, dest, mode)
+        if used_mode != mode:
+            self.log.debug(f"[xeus] could not {mode} {src}, copied it instead")
+
+    def plan_pruning(self, env_name, prefix):
+        """Return the prefix files of the modules which can't be imported from user code"""
+        roots = [self.manager.output_dir / "files"] + [
+            Path(mount.split(":")[0]) for mount in self.mounts
+        ]
+
+        with self.report.phase("prune_imports", env_name) as record:
+            modules = scan_roots([root for root in roots if root.exists()])
+            excluded, summary = prune_plan(prefix, modules | set(self.prune_keep))
+            record["pruned"] = summary
+
+        self.log.info(
+            f"[xeus] {env_name}: pruned {len(excluded)} files "
+            f"({sum(s['bytes'] for s in summary.values()) / 1024**2:.1f}MB) of modules never imported"
+        )
+        for top, pruned in sorted(summary.items(), key=lambda item: -item[1]["bytes"]):
+            self.log.debug(f"[xeus] {env_name}: pruned {pruned['files']} files from {top}")
+
+        return excluded
+
+    def verify_external_packages(self, env_name, out_path):
+        """Check the external packages of an environment against their mirrored copy"""
+        env_meta = json.loads((out_path / EMPACK_ENV_META).read_text(**UTF8))
+        mirror = self.lite_path(self.external_packages_mirror)
+
+        errors = []
+        with self.report.phase("verify_external_packages", env_name) as record:
+            external = [pkg for pkg in env_meta["packages"] if "sha256" in pkg]
+            for pkg in external:
+                mirrored = mirror / Path(urlparse(pkg["url"]).path).name
+                if not mirrored.is_file():
+                    errors.append(f"{pkg['url']} is not in the mirror {mirror}")
+                elif pkg["sha256"] is None:
+                    errors.append(f"{pkg['name']} has no sha256 to check {pkg['url']} against")
+                elif file_sha256(mirrored) != pkg["sha256"]:
+                    errors.append(f"{mirrored} does not match the sha256 of {pkg['name']}")
+            record["verified"] = len(external) - len(errors)
+
+        if errors:
+            raise RuntimeError(
+                f"Environment '{env_name}' has invalid external packages:\n" + "\n".join(errors)
+            )
+        self.log.info(f"[xeus] {env_name}: verified {len(external)} external packages")
+
+    def assign_tiers(self, env_name, prefix, out_path):
+        """Annotate the packed packages with the tier they are loaded in, startup or deferred"""
+        env_meta_file = out_path / EMPACK_ENV_META
+
+        with self.report.phase("package_tiers", env_name) as record:
+            traces = []
+            for boot_trace in self.boot_traces:
+                traces.extend(read_boot_trace(self.lite_path(boot_trace)))
+
+            env_meta = json.loads(env_meta_file.read_text(**UTF8))
+            startup = startup_packages(
+                prefix,
+                env_meta["packages"],
+                set(KERNEL_MODULES) | set(self.startup_imports),
+                traces,
+            )
+            for pkg in env_meta["packages"]:
+                pkg["tier"] = "startup" if pkg["name"] in startup else "deferred"
+            # Kernels only wait for the deferred packages before running code using these
+            modules = package_modules(prefix, env_meta["packages"])
+            env_meta["deferred_modules"] = sorted(
+                {
+                    module
+                    for pkg in env_meta["packages"]
+                    if pkg["tier"] == "deferred"
+                    for module in modules.get(pkg["name"], [])
+                }
+            )
+            env_meta_file.write_text(json.dumps(env_meta, indent=4), **UTF8)
+
+            record["startup"] = sorted(startup)
+            record["deferred"] = sorted(
+                pkg["name"] for pkg in env_meta["packages"] if pkg["name"] not in startup
+            )
+
+        self.log.info(
+            f"[xeus] {env_name}: {len(record['startup'])} packages loaded at startup, "
+            f"{len(record['deferred'])} deferred"
+        )
+
+    def index_content(self, contents_dir):
+        """Write the index of the jupyterlite content files, once per build.
+
+        Kernels create each file from the index, and only fetch it on first access.
+        """
+        if self.content_index is not None:
+            return self.content_index
+
+        files = []
+        for root, dirs, filenames in os.walk(contents_dir):
+            dirs.sort()
+            for filename in sorted(filenames):
+                path = Path(root) / filename
+                relative_path = path.relative_to(contents_dir).as_posix()
+                files.append(
+                    dict(
+                        path=relative_path,
+                        size=path.stat().st_size,
+                        sha256=file_sha256(path),
+                        url=f"files/{quote(relative_path)}",
+                    )
+                )
+
+        self.content_index = Path(self.cwd_name) / LAZY_FILES_INDEX
+        index = json.dumps(dict(mount_path="/files", files=files), indent=2)
+        # Keep the timestamp of an unchanged index, so that it's not copied again
+        if not self.content_index.is_file() or self.content_index.read_text(**UTF8) != index:
+            self.content_index.write_text(index, **UTF8)
+
+        self.log.info(f"[xeus] indexed {len(files)} jupyterlite content files for lazy loading")
+        return self.content_index
+
+    def pack_mount(self, env_name, host_path, mount_path, outname, out_path):
+        """Pack a mount point as ``out_path / outname``.
+
+        The tarball of a previous build is reused if no file of the mount point changed.
+        Returns the cache entry and whether it was reused.
+        """
+        cached = (
+            Path(self.cwd_name)
+            / "mounts"
+            / env_name
+            / f"{mount_fingerprint(host_path, mount_path)}.tar.gz"
+        )
+
+        if cached.is_file():
+            materialize(cached, out_path / outname, "hardlink")
+            return cached, True
+
+        if host_path.is_dir():
+            pack_directory(
+                host_dir=host_path,
+                mount_dir=mount_path,
+                outname=outname,
+                outdir=out_path,
+            )
+        else:
+            pack_file(
+                host_file=host_path,
+                mount_dir=mount_path,
+                outname=outname,
+                outdir=out_path,
+            )
+
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        materialize(out_path / outname, cached, "hardlink")
+        return cached, False
+
     def update_empack_meta(self, file_path, new_data):
         if file_path.exists():
             with open(file_path, "r", encoding="utf-8") as f:
@@ -411,14 +1137,10 @@ class XeusAddon(FederatedExtensionAddon):
         with open(file_path, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=2)
 
-    def pack_prefix(self, env_name, prefix):
-        env_dir = self.xeus_output_dir / env_name
-        packages_dir = env_dir / "kernel_packages"
-
-        out_path = Path(self.cwd_name) / "packed_env" / env_name
-        out_path.mkdir(parents=True, exist_ok=True)
-
-        pack_kwargs = {}
+    def get_file_filters(self):
+        """Return the empack file filters, loaded once per build"""
+        if self.file_filters is not None:
+            return self.file_filters
 
         empack_config = self.empack_config
 
@@ -426,111 +1148,233 @@ class XeusAddon(FederatedExtensionAddon):
         if empack_config:
             empack_config_is_url = urlparse(empack_config).scheme in ("http", "https")
             if empack_config_is_url:
-                empack_config_content = requests.get(empack_config).content
-                pack_kwargs["file_filters"] = PkgFileFilter(
-                    **yaml.safe_load(empack_config_content)
+                empack_config_content = fetch_cached(
+                    empack_config,
+                    self.lite_path(self.fetch_cache_dir)
+                    if self.fetch_cache_dir
+                    # Not the build cache, which is a temporary directory by default
+                    else Path(self.manager.cache_dir) / "xeus" / "fetch",
+                    timeout=self.fetch_timeout,
+                    offline=self.offline,
+                    log=self.log,
                 )
+                self.file_filters_config = yaml.safe_load(empack_config_content)
             else:
-                pack_kwargs["file_filters"] = pkg_file_filter_from_yaml(empack_config)
+                self.file_filters_config = yaml.safe_load(Path(empack_config).read_text(**UTF8))
         else:
-            pack_kwargs["file_filters"] = pkg_file_filter_from_yaml(DEFAULT_CONFIG_PATH)
+            self.file_filters_config = yaml.safe_load(Path(DEFAULT_CONFIG_PATH).read_text(**UTF8))
 
-        if self.package_url_factory is not None:
-            pack_kwargs["package_url_factory"] = self.package_url_factory
+        # The config is kept along with the filters, to describe them in the pack cache keys
+        self.file_filters = PkgFileFilter(**self.file_filters_config)
+        return self.file_filters
 
-        pack_env(
-            env_prefix=prefix,
-            relocate_prefix="/",
-            outdir=out_path,
-            use_cache=False,
-            **pack_kwargs,
-        )
+    def pack_prefix(self, env_name, prefix):
+        env_dir = self.xeus_output_dir / env_name
+        packages_dir = env_dir / "kernel_packages"
 
-        # Pack user defined mount points
-        for mount_index, mount in enumerate(self.mounts):
-            if mount.count(":") != 1:
-                raise ValueError(
-                    f"invalid mount {mount}, must be <host_path>:<mount_path>"
-                )
+        out_path = Path(self.cwd_name) / "packed_env" / env_name
+        # Start from scratch, packages from a previous build may be outdated
+        if out_path.exists():
+            shutil.rmtree(out_path)
+        out_path.mkdir(parents=True)
 
-            host_path, mount_path = mount.split(":")
-            host_path = Path(host_path)
-            mount_path = Path(mount_path)
+        pack_kwargs = {}
 
-            if not mount_path.is_absolute() or (
-                os.name == "nt" and mount_path.anchor != "\\"
-            ):
-                raise ValueError(f"mount_path {mount_path} needs to be absolute")
+        pack_kwargs["file_filters"] = self.get_file_filters()
+        pack_kwargs["file_filters_config"] = self.file_filters_config
 
-            if str(mount_path).startswith("/files"):
-                raise ValueError(
-                    f"Mount point '/files' is reserved for jupyterlite content. Cannot mount {mount}"
-                )
+        if self.package_url_factory is not None:
+            pack_kwargs["package_url_factory"] = self.package_url_factory
+            pack_kwargs["external"] = self.external_packages
 
-            outname = f"mount_{mount_index}.tar.gz"
+        if self.pack_cache_dir is not None:
+            pack_kwargs["cache"] = PackCache(
+                self.lite_path(self.pack_cache_dir), self.pack_cache_size_limit, log=self.log
+            )
 
-            if host_path.is_dir():
-                pack_directory(
-                    host_dir=host_path,
-                    mount_dir=mount_path,
-                    outname=outname,
-                    outdir=out_path,
-                )
-            elif host_path.is_file():
-                pack_file(
-                    host_file=host_path,
-                    mount_dir=mount_path,
-                    outname=outname,
-                    outdir=out_path,
-                )
+        if self.prune_imports:
+            pack_kwargs["exclude"] = self.plan_pruning(env_name, prefix)
+
+        if self.compile_bytecode:
+            python_version = self.prefix_index(prefix)["python_version"]
+            if python_version is None:
+                self.log.info(f"[xeus] {env_name}: Python is not installed, not compiling bytecode")
             else:
-                raise ValueError(
-                    f"host_path {host_path} needs to be a file or a directory"
+                pack_kwargs["bytecode"] = BytecodeCompiler(
+                    python_version,
+                    optimization=self.bytecode_optimization,
+                    keep_sources=self.bytecode_keep_sources,
+                    python=self.bytecode_python,
                 )
 
-            add_tarfile_to_env_meta(
-                env_meta_filename=out_path / EMPACK_ENV_META, tarfile=out_path / outname
+        with self.report.phase("pack_env", env_name) as record:
+            cache_hits = pack_env(
+                env_prefix=prefix,
+                relocate_prefix="/",
+                outdir=out_path,
+                **pack_kwargs,
+            )
+            record["packages"] = {
+                filename: dict(size=path_size(out_path / filename), cached=cached)
+                for filename, cached in cache_hits.items()
+            }
+            record["bytes_written"] = sum(
+                package["size"] for package in record["packages"].values()
             )
 
-        # Pack JupyterLite content if enabled
-        # If we only build a voici output, mount jupyterlite content into the kernel by default
-        if self.mount_jupyterlite_content or (
-            list(self.manager.apps) == ["voici"]
-            and self.mount_jupyterlite_content is None
-        ):
-            contents_dir = self.manager.output_dir / "files"
+        if self.external_packages and self.external_packages_mirror is not None:
+            self.verify_external_packages(env_name, out_path)
 
-            outname = f"mount_{len(self.mounts)}.tar.gz"
+        if self.package_tiers:
+            self.assign_tiers(env_name, prefix, out_path)
 
-            pack_directory(
-                host_dir=contents_dir,
-                mount_dir="/files",
-                outname=outname,
-                outdir=out_path,
+        if self.pack_cache_dir is not None:
+            self.log.info(
+                f"[xeus] {env_name}: reused {sum(cache_hits.values())} of {len(cache_hits)} packed packages from the cache"
             )
+            pack_kwargs["cache"].evict()
+
+        with self.report.phase("pack_mounts", env_name) as record:
+            # Cache entries of the packed mounts and whether they were reused, others are pruned
+            mount_cache = []
+            lazy_files = False
+
+            # Pack user defined mount points
+            for mount_index, mount in enumerate(self.mounts):
+                if mount.count(":") != 1:
+                    raise ValueError(
+                        f"invalid mount {mount}, must be <host_path>:<mount_path>"
+                    )
+
+                host_path, mount_path = mount.split(":")
+                host_path = Path(host_path)
+                mount_path = Path(mount_path)
+
+                if not mount_path.is_absolute() or (
+                    os.name == "nt" and mount_path.anchor != "\\"
+                ):
+                    raise ValueError(f"mount_path {mount_path} needs to be absolute")
+
+                if str(mount_path).startswith("/files"):
+                    raise ValueError(
+                        f"Mount point '/files' is reserved for jupyterlite content. Cannot mount {mount}"
+                    )
+
+                outname = f"mount_{mount_index}.tar.gz"
+
+                if not host_path.is_dir() and not host_path.is_file():
+                    raise ValueError(
+                        f"host_path {host_path} needs to be a file or a directory"
+                    )
+
+                mount_cache.append(
+                    self.pack_mount(env_name, host_path, mount_path, outname, out_path)
+                )
 
-            add_tarfile_to_env_meta(
-                env_meta_filename=out_path / EMPACK_ENV_META, tarfile=out_path / outname
+                add_tarfile_to_env_meta(
+                    env_meta_filename=out_path / EMPACK_ENV_META, tarfile=out_path / outname
+                )
+
+            # Pack JupyterLite content if enabled
+            # If we only build a voici output, mount jupyterlite content into the kernel by default
+            if self.mount_jupyterlite_content or (
+                list(self.manager.apps) == ["voici"]
+                and self.mount_jupyterlite_content is None
+            ):
+                contents_dir = self.manager.output_dir / "files"
+
+                if self.content_mount == "lazy" or (
+                    self.content_mount == "auto"
+                    and path_size(contents_dir) > self.lazy_content_threshold
+                ):
+                    self.index_content(contents_dir)
+                    lazy_files = True
+                else:
+                    outname = f"mount_{len(self.mounts)}.tar.gz"
+
+                    mount_cache.append(
+                        self.pack_mount(env_name, contents_dir, Path("/files"), outname, out_path)
+                    )
+
+                    add_tarfile_to_env_meta(
+                        env_meta_filename=out_path / EMPACK_ENV_META, tarfile=out_path / outname
+                    )
+
+            record["bytes_written"] = sum(
+                path_size(mount) for mount in out_path.glob("mount_*.tar.gz")
             )
 
+            mount_cache_dir = Path(self.cwd_name) / "mounts" / env_name
+            used = {entry for entry, _ in mount_cache}
+            if mount_cache_dir.is_dir():
+                for cached in mount_cache_dir.iterdir():
+                    if cached not in used:
+                        cached.unlink()
+
+            record["reused_mounts"] = sum(reused for _, reused in mount_cache)
+            if mount_cache:
+                self.log.info(
+                    f"[xeus] {env_name}: reused {record['reused_mounts']} of {len(mount_cache)} mounts, unchanged since the previous build"
+                )
+
+        chunked_paths = set()
+        if self.chunk_threshold is not None:
+            chunked_paths = self.chunk_packages(env_name, out_path)
+
+        bundled_paths = set()
+        if self.bundle_threshold is not None:
+            bundled_paths = self.bundle_packages(env_name, out_path)
+
+        shared_paths = set()
+        if self.shared_packages:
+            shared_paths = yield from self.share_packages(out_path)
+
+        hashed_names = {}
+        if self.hashed_filenames:
+            hashed_names = self.hash_package_names(env_name, out_path)
+
         # copy all the packages to the packages dir
         # (this is shared between multiple kernels in the same environment)
-        for pkg_path in out_path.iterdir():
-            if pkg_path.name.endswith(".tar.gz"):
+        for pkg_path in sorted(out_path.iterdir()):
+            is_package = (
+                pkg_path.name.endswith(".tar.gz")
+                or ".tar.gz.part" in pkg_path.name
+                or pkg_path.name.startswith("bundle_")
+            )
+            if is_package and pkg_path not in shared_paths | chunked_paths | bundled_paths:
+                dest = packages_dir / hashed_names.get(pkg_path, pkg_path.name)
+                if self.hashed_filenames:
+                    self.immutable_assets.add(dest)
                 yield dict(
-                    name=f"xeus:{env_name}:copy:{pkg_path.name}",
-                    actions=[(self.copy_one, [pkg_path, packages_dir / pkg_path.name])],
+                    name=f"xeus:{env_name}:copy:{dest.name}",
+                    file_dep=[pkg_path],
+                    targets=[dest],
+                    actions=[(self.materialize_one, [pkg_path, dest])],
                 )
 
         # write specs to empack_env_meta.json
+        env_meta_data = {"specs": self.specs[env_name], "channels": self.channels[env_name]}
+        if lazy_files:
+            # Relative to the jupyterlite base URL
+            env_meta_data["lazy_files"] = f"xeus/{LAZY_FILES_INDEX}"
         yield dict(
             name=f"xeus:{env_name}:update_env_file:{EMPACK_ENV_META}",
+            # The packed file is updated in place, so it can't be a file_dep
+            uptodate=[
+                config_changed(
+                    dict(
+                        env_meta=(out_path / EMPACK_ENV_META).read_text(**UTF8),
+                        **env_meta_data,
+                    )
+                )
+            ],
+            targets=[env_dir / EMPACK_ENV_META],
             actions=[
                 (
                     self.update_empack_meta,
                     [
                         out_path / EMPACK_ENV_META,
-                        {"specs": self.specs[env_name], "channels": self.channels[env_name]},
+                        env_meta_data,
                     ],
                 ),
                 (
@@ -544,60 +1388,259 @@ class XeusAddon(FederatedExtensionAddon):
 
         )
 
-    def copy_jupyterlab_extensions_from_prefix(self, prefix):
-        federated_extensions = self.env_extensions(Path(prefix) / SHARE_LABEXTENSIONS)
+    def chunk_packages(self, env_name, out_path):
+        """Split the packed packages larger than the chunk threshold into chunks.
+
+        Returns the split tarballs, which are served as chunks only.
+        """
+        env_meta_file = out_path / EMPACK_ENV_META
+        env_meta = json.loads(env_meta_file.read_text(**UTF8))
+
+        chunked_paths = set()
+        with self.report.phase("chunk_packages", env_name) as record:
+            for pkg in env_meta["packages"]:
+                pkg_path = out_path / pkg["filename"]
+                if "url" in pkg or not pkg_path.is_file():
+                    continue
+                if pkg_path.stat().st_size <= self.chunk_threshold:
+                    continue
+
+                pkg["chunks"] = split_tarball(pkg_path, self.chunk_size)
+                chunked_paths.add(pkg_path)
+
+            record["chunked"] = sorted(path.name for path in chunked_paths)
+
+        if chunked_paths:
+            env_meta_file.write_text(json.dumps(env_meta, indent=4), **UTF8)
+            self.log.info(f"[xeus] {env_name}: split {len(chunked_paths)} packages into chunks")
+
+        return chunked_paths
+
+    def bundle_packages(self, env_name, out_path):
+        """Merge the packed packages smaller than the bundle threshold into bundles.
+
+        Returns the bundled tarballs, which are served from their bundle only.
+        """
+        env_meta_file = out_path / EMPACK_ENV_META
+        env_meta = json.loads(env_meta_file.read_text(**UTF8))
+
+        sizes = {}
+        for pkg in env_meta["packages"]:
+            pkg_path = out_path / pkg["filename"]
+            if "url" in pkg or "chunks" in pkg or not pkg_path.is_file():
+                continue
+            if pkg_path.stat().st_size < self.bundle_threshold:
+                sizes[pkg["name"]] = pkg_path.stat().st_size
+
+        bundled_paths = set()
+        with self.report.phase("bundle_packages", env_name) as record:
+            small_packages = [pkg for pkg in env_meta["packages"] if pkg["name"] in sizes]
+            bundles = [
+                bundle
+                for bundle in plan_bundles(small_packages, sizes, self.bundle_size)
+                # A bundle of one package would not save any request
+                if len(bundle) > 1
+            ]
+
+            for index, bundle in enumerate(bundles):
+                filename = f"bundle_{index}.bin"
+                paths = [out_path / pkg["filename"] for pkg in bundle]
+                slices = write_bundle(paths, out_path / filename)
+                for pkg, bundle_slice in zip(bundle, slices):
+                    pkg["bundle"] = dict(filename=filename, **bundle_slice)
+                bundled_paths.update(paths)
+
+            record["bundles"] = [[pkg["name"] for pkg in bundle] for bundle in bundles]
+
+        if bundles:
+            env_meta_file.write_text(json.dumps(env_meta, indent=4), **UTF8)
+            self.log.info(
+                f"[xeus] {env_name}: merged {len(bundled_paths)} packages into {len(bundles)} bundles"
+            )
+
+        return bundled_paths
+
+    def hash_package_names(self, env_name, out_path):
+        """Name the packed files after their content, in the env meta file.
+
+        Mounts, chunks and bundles are renamed in place. Packages keep their filename,
+        which identifies them, and get the URL of their hashed copy. Returns the hashed
+        names of these packages.
+        """
+        env_meta_file = out_path / EMPACK_ENV_META
+        env_meta = json.loads(env_meta_file.read_text(**UTF8))
+
+        def rename(filename):
+            path = out_path / filename
+            hashed_name = hashed_filename(filename, file_sha256(path)[:16])
+            os.replace(path, out_path / hashed_name)
+            return hashed_name
+
+        hashed_names = {}
+        bundle_names = {}
+        with self.report.phase("hash_filenames", env_name) as record:
+            for pkg in env_meta["packages"]:
+                if "chunks" in pkg:
+                    for chunk in pkg["chunks"]:
+                        chunk["filename"] = rename(chunk["filename"])
+                elif "bundle" in pkg:
+                    # Bundles hold several packages, they are only renamed once
+                    filename = pkg["bundle"]["filename"]
+                    if filename not in bundle_names:
+                        bundle_names[filename] = rename(filename)
+                    pkg["bundle"]["filename"] = bundle_names[filename]
+                elif "url" not in pkg:
+                    pkg_path = out_path / pkg["filename"]
+                    hashed_name = hashed_filename(pkg["filename"], file_sha256(pkg_path)[:16])
+                    hashed_names[pkg_path] = hashed_name
+                    # Relative to the jupyterlite base URL
+                    pkg["url"] = f"xeus/{env_name}/kernel_packages/{hashed_name}"
+
+            for mount in env_meta.get("mounts", []):
+                mount["filename"] = rename(mount["filename"])
+
+            record["hashed"] = len(hashed_names) + len(bundle_names) + len(env_meta.get("mounts", []))
+
+        env_meta_file.write_text(json.dumps(env_meta, indent=4), **UTF8)
+        return hashed_names
+
+    def share_packages(self, out_path):
+        """Reference the packed packages from the shared pool, under their content hash
+
+        Returns the packed files that are served from the pool.
+        """
+        packages_dir = self.xeus_output_dir / "packages"
+        env_meta_file = out_path / EMPACK_ENV_META
+        env_meta = json.loads(env_meta_file.read_text(**UTF8))
+
+        shared_paths = set()
+        for pkg in env_meta["packages"]:
+            # Packages loaded from an external host, in chunks or in bundles are left untouched
+            if "url" in pkg or "chunks" in pkg or "bundle" in pkg:
+                continue
+
+            pkg_path = out_path / pkg["filename"]
+            shared_name = f"{file_sha256(pkg_path)}.tar.gz"
+            shared_paths.add(pkg_path)
+            # Relative to the JupyterLite base URL, like the kernel binaries
+            pkg["url"] = f"xeus/packages/{shared_name}"
+
+            # Identical packages from other environments are only copied once
+            if shared_name in self.shared_package_hashes:
+                continue
+            self.shared_package_hashes.add(shared_name)
+            self.immutable_assets.add(packages_dir / shared_name)
+
+            yield dict(
+                name=f"xeus:packages:copy:{shared_name}",
+                file_dep=[pkg_path],
+                targets=[packages_dir / shared_name],
+                actions=[(self.materialize_one, [pkg_path, packages_dir / shared_name])],
+            )
+
+        env_meta_file.write_text(json.dumps(env_meta, indent=4), **UTF8)
 
-        # Find the federated extensions in the emscripten-env and install them
-        for pkg_json in federated_extensions:
-            yield from self.safe_copy_jupyterlab_extension(pkg_json)
+        return shared_paths
+
+    def copy_jupyterlab_extensions(self):
+        """Copy the federated extensions of all the prefixes, once per extension name"""
+        extensions = {}
+        for prefix in self.prefixes.values():
+            for pkg_json in self.prefix_index(prefix)["labextensions"]:
+                pkg_json = Path(prefix) / pkg_json
+                pkg_data = json.loads(pkg_json.read_text(**UTF8))
+                name = pkg_data["name"]
+                version = pkg_data.get("version")
+
+                if name in extensions and extensions[name][1] != version:
+                    self.log.warning(
+                        f"[xeus] {name} {extensions[name][1]} and {version} are both installed, "
+                        f"using {version} from {prefix}"
+                    )
+                # Like before deduplication, the last environment wins
+                extensions[name] = (pkg_json, version)
+
+        self.labextensions = [pkg_json for pkg_json, _ in extensions.values()]
+
+        for name, (pkg_json, version) in extensions.items():
+            for task in self.safe_copy_jupyterlab_extension(pkg_json, name, version):
+                yield self.instrument(task, "copy_labextensions")
+
+    def patch_jupyterlab_extensions(self):
+        """Patch the JupyterLite config and settings once, with the extensions of all the prefixes"""
+        federated_extensions = self.labextensions
 
         jupyterlite_json = self.manager.output_dir / JUPYTERLITE_JSON
 
-        yield dict(
-            name=f"patch:xeus:{prefix}",
+        task = dict(
+            name=f"patch:xeus:{JUPYTERLITE_JSON}",
             doc=f"ensure {JUPYTERLITE_JSON} includes the federated_extensions",
             file_dep=[*federated_extensions, jupyterlite_json],
             actions=[(self.patch_jupyterlite_json, [jupyterlite_json])],
         )
+        yield self.instrument(task, "patch_jupyterlite_json")
 
         app_schemas = self.manager.output_dir / "build" / "schemas"
         all_federated_json = app_schemas / ALL_FEDERATED_JSON
 
         if app_schemas.is_dir():
-            yield self.task(
-                name=f"patch:xeus:federated_settings:{prefix}",
+            task = self.task(
+                name="patch:xeus:federated_settings",
                 doc=f"ensure {ALL_FEDERATED_JSON} includes the settings of federated extensions",
                 file_dep=[*federated_extensions],
                 actions=[
                     (self.patch_federated_settings, [self.manager, federated_extensions, all_federated_json])
                 ],
             )
+            yield self.instrument(task, "patch_federated_settings")
 
     def patch_federated_settings(self, manager, lab_extensions, all_federated_json):
         """ensure settings from federated extensions are aggregated in a single file"""
         federated_settings = [
             setting for p in lab_extensions for setting in self.get_federated_settings(p.parent)
         ]
-        current_json = json.loads(all_federated_json.read_text())
-        current_json = current_json + federated_settings
-        all_federated_json.write_text(json.dumps(current_json), **UTF8)
+        # Settings of the same plugin are replaced, not repeated
+        settings = {
+            setting["id"]: setting
+            for setting in json.loads(all_federated_json.read_text()) + federated_settings
+        }
+        all_federated_json.write_text(json.dumps(list(settings.values())), **UTF8)
+
+    def extension_digest(self, pkg_path):
+        """Return a digest of the files of a labextension, from their paths, sizes and mtimes"""
+        entries = []
+        for root, dirs, files in os.walk(pkg_path):
+            dirs.sort()
+            for filename in sorted(files):
+                if self.is_ignored_sourcemap(filename):
+                    continue
+                path = Path(root) / filename
+                stat = path.stat()
+                entries.append(
+                    (path.relative_to(pkg_path).as_posix(), stat.st_size, stat.st_mtime_ns)
+                )
+        return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
 
-    def safe_copy_jupyterlab_extension(self, pkg_json):
+    def safe_copy_jupyterlab_extension(self, pkg_json, name, version=None):
         """Copy a labextension, and overwrite it
         if it's already in the output
         """
         pkg_path = pkg_json.parent
-        stem = json.loads(pkg_json.read_text(**UTF8))["name"]
-        dest = self.output_extensions / stem
-        file_dep = [
-            p
-            for p in pkg_path.rglob("*")
-            if not (p.is_dir() or self.is_ignored_sourcemap(p.name))
-        ]
+        dest = self.output_extensions / name
 
         yield dict(
-            name=f"xeus:copy:ext:{stem}",
-            file_dep=file_dep,
+            name=f"xeus:copy:ext:{name}",
+            # A digest of the extension files, rather than all of them as file_dep
+            uptodate=[
+                config_changed(
+                    dict(
+                        source=str(pkg_path),
+                        version=version,
+                        digest=self.extension_digest(pkg_path),
+                    )
+                )
+            ],
+            targets=[dest / "package.json"],
             actions=[(self.copy_one, [pkg_path, dest])],
         )
 
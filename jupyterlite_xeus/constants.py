@@ -3,3 +3,8 @@ from pathlib import Path
 DEFAULT_CHANNELS = ["https://prefix.dev/emscripten-forge-4x", "https://prefix.dev/conda-forge"]
 EXTENSION_NAME = "xeus"
 STATIC_DIR = Path("@jupyterlite") / EXTENSION_NAME / "static"
+EMPACK_ENV_META = "empack_env_meta.json"
+LAZY_FILES_INDEX = "files_index.json"
+ASSET_MANIFEST = "asset-manifest.json"
+# Modules imported by the kernels when they start, or dynamically by name
+KERNEL_MODULES = ["xeus_python_shell", "pyjs", "IPython", "comm", "ipykernel", "matplotlib_inline"]
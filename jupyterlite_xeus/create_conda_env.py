@@ -1,15 +1,22 @@
+import hashlib
+import json
 import shutil
 import sys
 from pathlib import Path
 from subprocess import run as subprocess_run
 import os
+import re
 
-from ._pip import _install_pip_dependencies
-from .constants import DEFAULT_CHANNELS
+from ._pip import _install_pip_dependencies, _normalize_name
+from ._report import path_size, phase
+from .constants import DEFAULT_CHANNELS, EMPACK_ENV_META
 
 MICROMAMBA_COMMAND = shutil.which("micromamba")
 PLATFORM = "emscripten-wasm32"
 
+# Written in the prefix once it's fully created, and compared on the next build
+FINGERPRINT_FILE = Path("conda-meta") / "jupyterlite-xeus-fingerprint"
+
 
 def _extract_specs(env_location, env_data):
     specs = []
@@ -30,7 +37,142 @@ def _extract_specs(env_location, env_data):
     return specs, pip_dependencies
 
 
-def create_conda_env_from_env_file(root_prefix, env_file_content, env_file_location):
+def _hash_directory(sha, directory):
+    for root, dirs, files in os.walk(directory):
+        # Skip build artifacts, they are not part of the package sources
+        dirs[:] = sorted(
+            d for d in dirs
+            if d not in ("__pycache__", ".git", "build", "dist") and not d.endswith(".egg-info")
+        )
+        for file in sorted(files):
+            path = Path(root) / file
+            sha.update(str(path.relative_to(directory)).encode())
+            sha.update(path.read_bytes())
+
+
+def _is_pip_package(pkg):
+    return pkg.get("build") == "pip" or str(pkg.get("channel", "")).lower() == "pypi"
+
+
+def _is_conda_url(url):
+    return bool(re.match(r"^[a-z][a-z\d+\-.]*://", url or "", re.I)) and url.endswith(
+        (".conda", ".tar.bz2")
+    )
+
+
+def _lock_file_args(lock_file, explicit_path):
+    """Return the micromamba arguments installing exactly the packages of ``lock_file``,
+    and the pinned pip requirements of the lock.
+
+    Explicit lock files (``@EXPLICIT``) and conda-lock files are passed to micromamba as is.
+    The ``empack_env_meta.json`` of a previous build is written to ``explicit_path`` as an
+    explicit lock file, from the URL and sha256 of its conda packages, so that nothing is solved.
+    """
+    lock_file = Path(lock_file)
+
+    if lock_file.name == EMPACK_ENV_META or lock_file.suffix == ".json":
+        env_meta = json.loads(lock_file.read_text())
+        lines = ["# platform: " + PLATFORM, "@EXPLICIT"]
+        pip_requirements = []
+        missing = []
+        for pkg in env_meta["packages"]:
+            if _is_pip_package(pkg):
+                pip_requirements.append(f"{pkg['name']}=={pkg['version']}")
+            elif _is_conda_url(pkg.get("url")):
+                sha256 = pkg.get("sha256")
+                lines.append(f"{pkg['url']}#sha256:{sha256}" if sha256 else pkg["url"])
+            else:
+                missing.append(pkg["name"])
+
+        if missing:
+            raise ValueError(
+                f"{lock_file} can't be used as a lock file, it has no download URL for {', '.join(sorted(missing))}. "
+                "Only packages loaded from an external host have one, use the explicit lock file written "
+                "with the lock_dir option instead"
+            )
+
+        explicit_path = Path(explicit_path)
+        explicit_path.parent.mkdir(parents=True, exist_ok=True)
+        explicit_path.write_text("\n".join(lines) + "\n")
+        return ["--file", str(explicit_path.resolve())], pip_requirements
+
+    return ["--file", str(lock_file.resolve())], []
+
+
+def _pin_pip_dependencies(pip_dependencies, pip_requirements):
+    """Replace the pip requirements of an environment file with the pinned ones of a lock.
+
+    Local packages are still installed from their directory.
+    """
+    local_packages = [dependency for dependency in pip_dependencies if isinstance(dependency, Path)]
+    local_names = {_normalize_name(path.name) for path in local_packages}
+    return local_packages + [
+        requirement
+        for requirement in pip_requirements
+        if _normalize_name(requirement.split("==")[0]) not in local_names
+    ]
+
+
+def write_explicit_lock(prefix_path, lock_path):
+    """Write an explicit lock file of the conda packages installed in ``prefix_path``"""
+    lines = ["# platform: " + PLATFORM, "@EXPLICIT"]
+    for meta_file in sorted((Path(prefix_path) / "conda-meta").glob("*.json")):
+        pkg_meta = json.loads(meta_file.read_text())
+        url = pkg_meta.get("url")
+        if not url:
+            continue
+        md5 = pkg_meta.get("md5")
+        lines.append(f"{url}#{md5}" if md5 else url)
+
+    lock_path = Path(lock_path)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    lock_path.write_text("\n".join(lines) + "\n")
+
+
+def get_env_file_fingerprint(env_file_content, env_file_location, lock_file=None):
+    """Return a hash of everything that goes into creating the environment"""
+    sha = hashlib.sha256()
+
+    channels = env_file_content.get("channels", DEFAULT_CHANNELS)
+    specs, pip_dependencies = _extract_specs(env_file_location, env_file_content)
+
+    sha.update(
+        json.dumps(
+            dict(
+                platform=PLATFORM,
+                channels=channels,
+                specs=specs,
+                pip_dependencies=[str(dependency) for dependency in pip_dependencies],
+            ),
+            sort_keys=True,
+        ).encode()
+    )
+
+    if lock_file is not None:
+        sha.update(Path(lock_file).read_bytes())
+
+    # Local pip packages are installed from their sources, which may change
+    for dependency in pip_dependencies:
+        if isinstance(dependency, Path):
+            _hash_directory(sha, dependency)
+
+    return sha.hexdigest()
+
+
+def is_prefix_up_to_date(prefix_path, fingerprint):
+    fingerprint_file = Path(prefix_path) / FINGERPRINT_FILE
+    return fingerprint_file.is_file() and fingerprint_file.read_text() == fingerprint
+
+
+def create_conda_env_from_env_file(
+    root_prefix,
+    env_file_content,
+    env_file_location,
+    report=None,
+    wheel_cache_dir=None,
+    wheelhouse=None,
+    lock_file=None,
+):
     # get the name of the environment
     env_name = env_file_content.get("name", "xeus-env")
 
@@ -48,6 +190,10 @@ def create_conda_env_from_env_file(root_prefix, env_file_content, env_file_locat
         specs=specs,
         channels=channels,
         pip_dependencies=pip_dependencies,
+        report=report,
+        wheel_cache_dir=wheel_cache_dir,
+        wheelhouse=wheelhouse,
+        lock_file=lock_file,
     )
 
 
@@ -57,18 +203,42 @@ def create_conda_env_from_specs(
     specs,
     channels,
     pip_dependencies=None,
+    report=None,
+    wheel_cache_dir=None,
+    wheelhouse=None,
+    lock_file=None,
 ):
-    _create_conda_env_from_specs_impl(
-        env_name=env_name,
-        root_prefix=root_prefix,
-        specs=specs,
-        channels=channels,
-    )
-    if pip_dependencies:
-        _install_pip_dependencies(
-            prefix_path=Path(root_prefix) / "envs" / env_name,
-            dependencies=pip_dependencies,
+    prefix_path = Path(root_prefix) / "envs" / env_name
+
+    # Without solving, the lock file already lists every package to install
+    if lock_file is not None:
+        specs, pip_requirements = _lock_file_args(
+            lock_file, Path(root_prefix) / f"{env_name}-explicit.txt"
+        )
+        if pip_requirements:
+            pip_dependencies = _pin_pip_dependencies(pip_dependencies or [], pip_requirements)
+
+    with phase(report, "solve", env_name) as record:
+        _create_conda_env_from_specs_impl(
+            env_name=env_name,
+            root_prefix=root_prefix,
+            specs=specs,
+            channels=channels,
         )
+        if report is not None:
+            prefix_size = path_size(prefix_path)
+            record["bytes_written"] = prefix_size
+
+    if pip_dependencies:
+        with phase(report, "pip_install", env_name) as record:
+            _install_pip_dependencies(
+                prefix_path=prefix_path,
+                dependencies=pip_dependencies,
+                wheel_cache_dir=wheel_cache_dir,
+                wheelhouse=wheelhouse,
+            )
+            if report is not None:
+                record["bytes_written"] = path_size(prefix_path) - prefix_size
 
 
 def _create_conda_env_from_specs_impl(env_name, root_prefix, specs, channels):
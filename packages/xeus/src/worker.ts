@@ -37,6 +37,202 @@ async function fetchJson(url: string): Promise<any> {
   return json;
 }
 
+/**
+ * Resolve the package URLs that are relative to the JupyterLite base URL,
+ * e.g. packages shared between environments under xeus/packages.
+ */
+function resolvePackageUrls(empackEnvMeta: IEmpackEnvMeta, baseUrl: string) {
+  for (const pkg of empackEnvMeta.packages) {
+    if (
+      pkg.url &&
+      !/^[a-z][a-z\d+\-.]*:/i.test(pkg.url) &&
+      !pkg.url.startsWith('/')
+    ) {
+      pkg.url = URLExt.join(baseUrl, pkg.url);
+    }
+  }
+}
+
+/**
+ * Split the packages of an environment into the ones to load before the kernel
+ * starts and the deferred ones, from the tiers assigned at build time.
+ */
+function splitTiers(empackEnvMeta: IEmpackEnvMeta): {
+  startup: IEmpackEnvMeta;
+  deferred: number;
+} {
+  const packages = empackEnvMeta.packages.filter(
+    pkg => (pkg as any).tier !== 'deferred'
+  );
+  return {
+    startup: { ...empackEnvMeta, packages },
+    deferred: empackEnvMeta.packages.length - packages.length
+  };
+}
+
+/**
+ * A chunk of a package split at build time
+ */
+interface IChunk {
+  filename: string;
+  size: number;
+}
+
+/**
+ * Reassemble the packages which were split into chunks, fetching their chunks concurrently.
+ * These packages are then loaded from an object URL of the reassembled tarball.
+ */
+async function fetchChunkedPackages(
+  packages: IEmpackEnvMeta['packages'],
+  pkgRootUrl: string
+) {
+  await Promise.all(
+    packages
+      .filter(pkg => (pkg as any).chunks && !pkg.url)
+      .map(async pkg => {
+        const chunks = (pkg as any).chunks as IChunk[];
+        const blobs = await Promise.all(
+          chunks.map(async chunk => {
+            const response = await fetch(
+              URLExt.join(pkgRootUrl, chunk.filename)
+            );
+            if (!response.ok) {
+              throw new Error(
+                `Failed to fetch ${chunk.filename}: ${response.status}`
+              );
+            }
+            return response.blob();
+          })
+        );
+        pkg.url = URL.createObjectURL(new Blob(blobs));
+      })
+  );
+}
+
+/**
+ * The location of a package in a bundle of small packages
+ */
+interface IBundleSlice {
+  filename: string;
+  offset: number;
+  size: number;
+}
+
+/**
+ * Fetch the bundles of the bundled packages, once per bundle.
+ * These packages are then loaded from an object URL of their slice of the bundle.
+ */
+async function fetchBundledPackages(
+  packages: IEmpackEnvMeta['packages'],
+  pkgRootUrl: string
+) {
+  const bundles = new Map<string, Promise<Blob>>();
+  const fetchBundle = (filename: string) => {
+    if (!bundles.has(filename)) {
+      bundles.set(
+        filename,
+        fetch(URLExt.join(pkgRootUrl, filename)).then(response => {
+          if (!response.ok) {
+            throw new Error(`Failed to fetch ${filename}: ${response.status}`);
+          }
+          return response.blob();
+        })
+      );
+    }
+    return bundles.get(filename)!;
+  };
+
+  await Promise.all(
+    packages
+      .filter(pkg => (pkg as any).bundle && !pkg.url)
+      .map(async pkg => {
+        const { filename, offset, size } = (pkg as any).bundle as IBundleSlice;
+        const bundle = await fetchBundle(filename);
+        pkg.url = URL.createObjectURL(bundle.slice(offset, offset + size));
+      })
+  );
+}
+
+/**
+ * Fetch the packages loaded from an external host, and check them against the
+ * sha256 of their conda package recorded at build time.
+ * These packages are then loaded from an object URL of the checked bytes.
+ */
+async function fetchExternalPackages(packages: IEmpackEnvMeta['packages']) {
+  await Promise.all(
+    packages
+      .filter(
+        pkg => (pkg as any).sha256 && pkg.url && !pkg.url.startsWith('blob:')
+      )
+      .map(async pkg => {
+        const response = await fetch(pkg.url!);
+        if (!response.ok) {
+          throw new Error(`Failed to fetch ${pkg.url}: ${response.status}`);
+        }
+        // Buffered in memory: the digest has to be checked before extracting the package
+        const data = await response.arrayBuffer();
+        const digest = await crypto.subtle.digest('SHA-256', data);
+        const sha256 = Array.from(new Uint8Array(digest))
+          .map(byte => byte.toString(16).padStart(2, '0'))
+          .join('');
+        if (sha256 !== (pkg as any).sha256) {
+          throw new Error(
+            `${pkg.url} does not match its sha256: expected ${(pkg as any).sha256}, got ${sha256}`
+          );
+        }
+        pkg.url = URL.createObjectURL(new Blob([data]));
+      })
+  );
+}
+
+/**
+ * Fetch the packages which are not served as one tarball each
+ */
+async function fetchPackageParts(
+  packages: IEmpackEnvMeta['packages'],
+  pkgRootUrl: string
+) {
+  await Promise.all([
+    fetchChunkedPackages(packages, pkgRootUrl),
+    fetchBundledPackages(packages, pkgRootUrl),
+    fetchExternalPackages(packages)
+  ]);
+}
+
+/**
+ * An entry of the index of lazily mounted files
+ */
+interface ILazyFile {
+  path: string;
+  size: number;
+  sha256: string;
+  url: string;
+}
+
+/**
+ * Create the files of a lazy files index in the Emscripten FS.
+ * Their content is only fetched, from their URL, on first access.
+ */
+async function mountLazyFiles(indexUrl: string, baseUrl: string, Module: any) {
+  const index = await fetchJson(indexUrl);
+  const mountPath: string = index.mount_path;
+
+  for (const file of index.files as ILazyFile[]) {
+    const path = `${mountPath}/${file.path}`;
+    const parent = path.substring(0, path.lastIndexOf('/'));
+    const name = path.substring(path.lastIndexOf('/') + 1);
+
+    Module.FS.mkdirTree(parent);
+    Module.FS.createLazyFile(
+      parent,
+      name,
+      URLExt.join(baseUrl, file.url),
+      true,
+      true
+    );
+  }
+}
+
 /**
  * A worker kernel that is backed by an empack environment
  */
@@ -57,6 +253,11 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
         ? kernelSpec.metadata.shared
         : {};
 
+    // Shared libraries stored in the pool shared by all environments, relative to the base URL
+    const sharedLibUrls: { [lib: string]: string } =
+      kernelSpec.metadata?.shared_urls ?? {};
+    const libxeusUrl: string | undefined = kernelSpec.metadata?.libxeus_url;
+
     // Save .so files the kernel links against
     Object.values(sharedLibs).forEach(lib => this._kernelSharedLibs.add(lib));
     this._kernelSharedLibs.add('lib/libxeus.so');
@@ -64,13 +265,19 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
     importScripts(binaryJS);
     return {
       locateFile: (file: string) => {
+        if (file in sharedLibUrls) {
+          return URLExt.join(baseUrl, sharedLibUrls[file]);
+        }
+
         if (file in sharedLibs) {
           return URLExt.join(kernelRootUrl, kernelSpec.name, file);
         }
 
         // Special case for libxeus
         if (['libxeus.so'].includes(file)) {
-          return URLExt.join(kernelRootUrl, file);
+          return libxeusUrl
+            ? URLExt.join(baseUrl, libxeusUrl)
+            : URLExt.join(kernelRootUrl, file);
         }
 
         if (file.endsWith('.wasm')) {
@@ -105,9 +312,22 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
       `xeus/${kernelSpec.envName}/kernel_packages`
     );
     const empackEnvMeta = (await fetchJson(packagesJsonUrl)) as IEmpackEnvMeta;
+    resolvePackageUrls(empackEnvMeta, baseUrl);
+
+    // Only bootstrap the startup packages, the deferred ones are loaded once the kernel runs
+    const { startup, deferred } = splitTiers(empackEnvMeta);
+    if (deferred) {
+      this._deferredEnvMeta = empackEnvMeta;
+    }
+
+    if (this.Module.FS !== undefined) {
+      // Chunked, bundled and external packages are fetched before the lock refers
+      // to them
+      await fetchPackageParts(startup.packages, this._pkgRootUrl);
+    }
 
     this._lock = empackLockToMambajsLock({
-      empackEnvMeta,
+      empackEnvMeta: startup,
       pkgRootUrl: this._pkgRootUrl
     });
 
@@ -121,7 +341,7 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
     this._prefix = empackEnvMeta.prefix;
 
     const bootstrapped = await bootstrapEmpackPackedEnvironment({
-      empackEnvMeta,
+      empackEnvMeta: startup,
       lock: this._lock,
       pkgRootUrl: this._pkgRootUrl,
       Module: this.Module,
@@ -132,6 +352,16 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
     this._paths = bootstrapped.paths;
     this._pythonVersion = bootstrapped.pythonVersion;
     this._sharedLibs = bootstrapped.sharedLibs;
+
+    // The jupyterlite content may be mounted lazily instead of being packed
+    const lazyFiles = (empackEnvMeta as any).lazy_files;
+    if (lazyFiles) {
+      await mountLazyFiles(
+        URLExt.join(baseUrl, lazyFiles),
+        baseUrl,
+        this.Module
+      );
+    }
   }
 
   /**
@@ -170,6 +400,66 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
         logger: this.logger
       });
     }
+
+    if (this._deferredEnvMeta) {
+      const empackEnvMeta = this._deferredEnvMeta;
+      this._deferredEnvMeta = undefined;
+      this.logger.log('Loading the deferred packages in the background');
+      const modules = (empackEnvMeta as any).deferred_modules;
+      this._deferredModules = Array.isArray(modules) ? new Set(modules) : null;
+      this._deferredPending = true;
+      this._deferredPackages = this._loadDeferredPackages(empackEnvMeta)
+        .catch(error => {
+          console.error('Failed to load the deferred packages', error);
+        })
+        .finally(() => {
+          this._deferredPending = false;
+        });
+    }
+  }
+
+  /**
+   * Wait for the deferred packages before running code which may import them
+   * @param code the code of the cell
+   */
+  protected async processMagics(code: string) {
+    const run = await super.processMagics(code);
+    if (this._deferredPending && this._usesDeferredModules(run)) {
+      this.logger.log('Waiting for the deferred packages');
+      await this._deferredPackages;
+    }
+    return run;
+  }
+
+  /**
+   * Whether some code mentions the modules of the deferred packages.
+   * Without the list of these modules, all code is assumed to use them.
+   * @param code the code to run
+   */
+  private _usesDeferredModules(code: string): boolean {
+    if (!this._deferredModules) {
+      return true;
+    }
+    for (const name of code.match(/[A-Za-z_][A-Za-z0-9_]*/g) ?? []) {
+      if (this._deferredModules.has(name)) {
+        return true;
+      }
+    }
+    return false;
+  }
+
+  /**
+   * Load the packages of the environment which were not bootstrapped
+   * @param empackEnvMeta the full environment
+   */
+  private async _loadDeferredPackages(empackEnvMeta: IEmpackEnvMeta) {
+    await fetchPackageParts(empackEnvMeta.packages, this._pkgRootUrl);
+    await this._reloadPackagesInFS(
+      empackLockToMambajsLock({
+        empackEnvMeta,
+        pkgRootUrl: this._pkgRootUrl
+      })
+    );
   }
 
   get emscriptenMajorVersion(): number {
@@ -198,6 +488,9 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
    * @param options
    */
   protected async install(options: IInstallationCommandOptions) {
+    // Packages are resolved against the full environment
+    await this._deferredPackages;
+
     let env: ILock;
 
     switch (options.type) {
@@ -226,6 +519,8 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
   protected async uninstall(
     options: IUninstallationCommandOptions
   ): Promise<void> {
+    await this._deferredPackages;
+
     let env: ILock;
 
     switch (options.type) {
@@ -246,7 +541,11 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
    * Process %conda list or %pip list commands
    * @param options
    */
-  protected listInstalledPackages(options: IListCommandOptions): Promise<void> {
+  protected async listInstalledPackages(
+    options: IListCommandOptions
+  ): Promise<void> {
+    await this._deferredPackages;
+
     if (options.type === 'conda') {
       showPackagesList(
         {
@@ -258,8 +557,6 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
     } else {
       showPipPackagesList(this._lock.pipPackages, this.logger);
     }
-
-    return Promise.resolve();
   }
 
   private async _reloadPackagesInFS(newLock: ILock) {
@@ -312,6 +609,10 @@ export abstract class EmpackedXeusRemoteKernel extends XeusRemoteKernelBase {
   private _sharedLibs: TSharedLibsMap;
   private _kernelSharedLibs = new Set<string>();
   private _lock: ILock;
+  private _deferredEnvMeta: IEmpackEnvMeta | undefined = undefined;
+  private _deferredPackages: Promise<void> = Promise.resolve();
+  private _deferredPending = false;
+  private _deferredModules: Set<string> | null = null;
   private _paths = {};
 }
 
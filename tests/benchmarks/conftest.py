@@ -0,0 +1,100 @@
+"""A minimal benchmark harness, running fully offline on synthetic prefixes.
+
+Run with ``python -m pytest tests/benchmarks``, they are deselected from other test runs.
+Results can be saved with ``--xeus-bench-json=results.json`` and later used as a baseline
+with ``--xeus-bench-baseline=results.json``, as CI does with the results of the main branch.
+Timings of shared runners vary a lot, so runs only fail when the minimum time of a
+benchmark is more than ``1 + --xeus-bench-tolerance`` times that of the baseline, 3 times
+by default: the comparison of every benchmark is reported in the summary.
+"""
+
+import json
+from pathlib import Path
+import statistics
+import time
+
+import pytest
+
+from synthetic import make_prefix
+
+RESULTS = {}
+
+
+class Benchmark:
+    def __init__(self, name, rounds, baseline, tolerance):
+        self.name = name
+        self.rounds = rounds
+        self.baseline = baseline
+        self.tolerance = tolerance
+
+    def __call__(self, func, *args, setup=None, **kwargs):
+        """Time ``func``, calling ``setup`` before each round, and return its last result"""
+        timings = []
+        for _ in range(self.rounds):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            timings.append(time.perf_counter() - start)
+
+        stats = dict(
+            min=min(timings),
+            median=statistics.median(timings),
+            mean=statistics.mean(timings),
+            rounds=self.rounds,
+        )
+        RESULTS[self.name] = stats
+
+        if self.baseline is not None and self.name in self.baseline:
+            stats["baseline"] = self.baseline[self.name]["min"]
+            limit = stats["baseline"] * (1 + self.tolerance)
+            if stats["min"] > limit:
+                pytest.fail(
+                    f"{self.name} regressed: minimum {stats['min']:.3f}s > {limit:.3f}s allowed"
+                )
+
+        return result
+
+
+@pytest.fixture
+def xeus_benchmark(request):
+    config = request.config
+    baseline_path = config.getoption("--xeus-bench-baseline")
+    baseline = json.loads(Path(baseline_path).read_text()) if baseline_path else None
+    return Benchmark(
+        request.node.name,
+        config.getoption("--xeus-bench-rounds"),
+        baseline,
+        config.getoption("--xeus-bench-tolerance"),
+    )
+
+
+@pytest.fixture(scope="session")
+def prefix_factory(tmp_path_factory):
+    """Build synthetic prefixes once per session, keyed by their parameters"""
+    prefixes = {}
+
+    def factory(name, **kwargs):
+        key = (name, *sorted(kwargs.items()))
+        if key not in prefixes:
+            prefixes[key] = make_prefix(tmp_path_factory.mktemp("envs"), name, **kwargs)
+        return prefixes[key]
+
+    return factory
+
+
+def pytest_sessionfinish(session):
+    output = session.config.getoption("--xeus-bench-json")
+    if output and RESULTS:
+        Path(output).write_text(json.dumps(RESULTS, indent=2, sort_keys=True))
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not RESULTS:
+        return
+    terminalreporter.section("xeus benchmarks")
+    for name, stats in sorted(RESULTS.items()):
+        line = f"{name:<60} median {stats['median']:8.4f}s  min {stats['min']:8.4f}s"
+        if "baseline" in stats:
+            line += f"  {stats['min'] / stats['baseline']:5.2f}x baseline"
+        terminalreporter.write_line(line)
@@ -0,0 +1,157 @@
+"""Benchmarks of the xeus build pipeline on synthetic prefixes, without network."""
+
+import json
+import os
+from pathlib import Path
+import shutil
+
+import pytest
+
+from jupyterlite_core.constants import JUPYTER_CONFIG_DATA, JUPYTERLITE_JSON
+
+from jupyterlite_xeus._prefix_index import parse_history
+from jupyterlite_xeus._report import BuildReport
+from jupyterlite_xeus.add_on import XeusAddon
+
+from synthetic import make_package
+
+pytestmark = pytest.mark.xeus_benchmark
+
+
+def run_tasks(tasks):
+    """Execute the doit tasks directly, in order"""
+    for task in tasks:
+        for action, args in task["actions"]:
+            action(*args)
+
+
+@pytest.fixture
+def addon(lite_manager):
+    lite_manager.output_dir.mkdir(parents=True, exist_ok=True)
+    (lite_manager.output_dir / JUPYTERLITE_JSON).write_text(json.dumps({JUPYTER_CONFIG_DATA: {}}))
+    return XeusAddon(lite_manager)
+
+
+def prepare_pack(addon, prefix):
+    """Set up the state that post_build would set up before packing"""
+    env_name = prefix.name
+    addon.specs = {env_name: addon.get_environment_specs(str(prefix))}
+    addon.channels = {env_name: addon.get_environment_channels(str(prefix))}
+    addon.shared_package_hashes = set()
+    addon.report = BuildReport()
+    return env_name
+
+
+@pytest.mark.parametrize("n_lines", [100, 10_000])
+def test_history_parsers(xeus_benchmark, tmp_path, n_lines):
+    prefix = tmp_path / "history-env"
+    (prefix / "conda-meta").mkdir(parents=True)
+    with open(prefix / "conda-meta" / "history", "w") as history:
+        for index in range(n_lines):
+            history.write(f"==> 2024-01-01 00:00:{index % 60:02d} <==\n")
+            history.write(
+                f"# cmd: micromamba install --prefix /env -c https://prefix.dev/channel-{index % 3} pkg{index}\n"
+            )
+            history.write(f"# update specs: ['pkg{index}>=1.0', 'other{index}']\n")
+            history.write(f"+https://prefix.dev/channel/emscripten-wasm32::pkg{index}-1.0-h0_0\n")
+
+    # The addon memoizes the prefix index, time the parsing itself
+    specs, channels = xeus_benchmark(parse_history, prefix / "conda-meta" / "history")
+    assert len(specs) == 2 * n_lines
+    assert len(channels) == n_lines
+
+
+@pytest.mark.parametrize("n_packages,files_per_package", [(10, 10), (100, 10), (100, 200)])
+def test_pack_prefix(xeus_benchmark, addon, prefix_factory, n_packages, files_per_package):
+    prefix = prefix_factory("pack-env", n_packages=n_packages, files_per_package=files_per_package)
+    env_name = prepare_pack(addon, prefix)
+
+    tasks = xeus_benchmark(lambda: list(addon.pack_prefix(env_name, str(prefix))))
+    assert len(tasks) == n_packages + 3
+
+
+@pytest.mark.parametrize("n_packages", [10, 100])
+def test_pack_prefix_cached(xeus_benchmark, addon, prefix_factory, tmp_path, n_packages):
+    prefix = prefix_factory("pack-env", n_packages=n_packages, files_per_package=10)
+    env_name = prepare_pack(addon, prefix)
+    addon.pack_cache_dir = str(tmp_path / "pack-cache")
+
+    # Warm up the cache
+    list(addon.pack_prefix(env_name, str(prefix)))
+
+    tasks = xeus_benchmark(lambda: list(addon.pack_prefix(env_name, str(prefix))))
+    assert len(tasks) == n_packages + 3
+
+
+@pytest.mark.parametrize("n_files", [100, 2000])
+def test_pack_mounts(xeus_benchmark, addon, prefix_factory, tmp_path, n_files):
+    prefix = prefix_factory("mount-env", n_packages=1)
+    env_name = prepare_pack(addon, prefix)
+
+    data = tmp_path / "data"
+    for index in range(n_files):
+        path = data / f"dir{index % 20}" / f"file{index}.csv"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"{index}," * 1000)
+    addon.mounts = [f"{data}:/data"]
+
+    xeus_benchmark(lambda: list(addon.pack_prefix(env_name, str(prefix))))
+
+
+@pytest.mark.parametrize("n_kernels,kernel_size", [(1, 1024), (4, 16 * 1024**2)])
+def test_copy_kernels_from_prefix(xeus_benchmark, addon, prefix_factory, n_kernels, kernel_size):
+    prefix = prefix_factory(
+        "kernels-env",
+        n_packages=5,
+        kernels=tuple(f"kernel{index}" for index in range(n_kernels)),
+        kernel_size=kernel_size,
+    )
+    env_name = prepare_pack(addon, prefix)
+
+    def copy_kernels():
+        tasks = list(addon.copy_kernels_from_prefix(env_name, str(prefix)))
+        run_tasks(tasks)
+        return tasks
+
+    xeus_benchmark(
+        copy_kernels, setup=lambda: shutil.rmtree(addon.xeus_output_dir, ignore_errors=True)
+    )
+
+    for index in range(n_kernels):
+        wasm = addon.xeus_output_dir / env_name / "bin" / f"kernel{index}.wasm"
+        assert os.path.getsize(wasm) == kernel_size + 4
+
+
+@pytest.mark.parametrize("n_envs", [1, 4])
+def test_post_build(xeus_benchmark, addon, prefix_factory, n_envs):
+    prefixes = [
+        prefix_factory(f"env{index}", n_packages=50, files_per_package=20)
+        for index in range(n_envs)
+    ]
+    # Every environment ships the same labextension
+    for prefix in prefixes:
+        make_package(
+            prefix,
+            "widgets-extension",
+            files={
+                "share/jupyter/labextensions/widgets-extension/package.json": json.dumps(
+                    dict(
+                        name="widgets-extension",
+                        version="1.0.0",
+                        jupyterlab=dict(_build=dict(load="static/remoteEntry.js")),
+                    )
+                ),
+                "share/jupyter/labextensions/widgets-extension/static/remoteEntry.js": "// entry\n",
+            },
+        )
+    addon.prefix = [str(prefix) for prefix in prefixes]
+
+    def post_build():
+        tasks = list(addon.post_build(addon.manager))
+        run_tasks(tasks)
+        return tasks
+
+    xeus_benchmark(post_build)
+
+    kernels = json.loads(Path(addon.xeus_output_dir / "kernels.json").read_text())
+    assert len(kernels) == n_envs
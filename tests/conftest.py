@@ -0,0 +1,85 @@
+"""Shared fixtures building synthetic wasm prefixes, so that tests can run without network."""
+
+from pathlib import Path
+
+import pytest
+
+from jupyterlite_core.app import LiteStatusApp
+
+from jupyterlite_xeus.add_on import XeusAddon
+
+from synthetic import make_prefix
+
+
+@pytest.fixture
+def synthetic_prefix(tmp_path):
+    return make_prefix(tmp_path / "envs", "xeus-synthetic")
+
+
+@pytest.fixture
+def lite_manager(tmp_path, monkeypatch):
+    lite_dir = tmp_path / "lite"
+    lite_dir.mkdir()
+    monkeypatch.chdir(lite_dir)
+
+    app = LiteStatusApp(log_level="DEBUG")
+    app.initialize(argv=[])
+    return app.lite_manager
+
+
+@pytest.fixture
+def xeus_build(lite_manager):
+    """Run the post_build of a new addon with the given traits, and return the addon and
+    its steps by name
+    """
+
+    def build(**traits):
+        addon = XeusAddon(lite_manager)
+        for name, value in traits.items():
+            setattr(addon, name, value)
+        steps = {step["name"]: step for step in addon.post_build(lite_manager)}
+        return addon, steps
+
+    return build
+
+
+BENCHMARKS_DIR = Path(__file__).parent / "benchmarks"
+
+
+# Registered here rather than in benchmarks/conftest.py, so that they are known at startup
+# whatever the selected tests
+def pytest_addoption(parser):
+    # Prefixed, not to clash with the options of pytest-benchmark when it is installed
+    group = parser.getgroup("xeus benchmarks")
+    group.addoption(
+        "--xeus-bench-rounds", type=int, default=3, help="Number of timed rounds per benchmark"
+    )
+    group.addoption("--xeus-bench-json", default=None, help="Where to write the benchmark results")
+    group.addoption("--xeus-bench-baseline", default=None, help="Results to compare against")
+    group.addoption(
+        "--xeus-bench-tolerance",
+        type=float,
+        default=2.0,
+        help="Relative slowdown of the minimum time allowed compared to the baseline",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "xeus_benchmark: slow benchmarks, only run when selected"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    # The benchmarks are slow, they only run when selected with -m or their directory
+    selected = config.getoption("markexpr") or any(
+        BENCHMARKS_DIR == path or BENCHMARKS_DIR in path.parents
+        for path in (Path(arg.split("::")[0]).resolve() for arg in config.args)
+    )
+    if selected:
+        return
+
+    deselected = [item for item in items if item.get_closest_marker("xeus_benchmark")]
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = [item for item in items if not item.get_closest_marker("xeus_benchmark")]
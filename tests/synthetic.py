@@ -0,0 +1,124 @@
+"""Builders of synthetic wasm prefixes, so that tests and benchmarks can run without network."""
+
+import json
+from pathlib import Path
+import zipfile
+
+
+def make_package(prefix, name, version="1.0.0", build="h0_0", files=None, depends=None, channel="https://prefix.dev/emscripten-forge-4x"):
+    """Install a fake conda package in ``prefix``, ``files`` maps relative paths to their content"""
+    prefix = Path(prefix)
+    files = files if files is not None else {f"share/{name}/data.txt": f"{name} {version}\n"}
+
+    for relative_path, content in files.items():
+        path = prefix / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(content, bytes):
+            path.write_bytes(content)
+        else:
+            path.write_text(content)
+
+    pkg_meta = dict(
+        name=name,
+        version=version,
+        build=build,
+        build_number=0,
+        channel=channel,
+        subdir="emscripten-wasm32",
+        depends=depends or [],
+        files=sorted(files),
+        url=f"{channel}/emscripten-wasm32/{name}-{version}-{build}.tar.bz2",
+        sha256=f"{name}-{version}-{build}".encode().hex(),
+        md5=f"{name}-{version}-{build}".encode().hex()[:32],
+    )
+    conda_meta = prefix / "conda-meta"
+    conda_meta.mkdir(parents=True, exist_ok=True)
+    (conda_meta / f"{name}-{version}-{build}.json").write_text(json.dumps(pkg_meta))
+    return pkg_meta
+
+
+def make_kernel(prefix, name, binary=None, data=False, shared=None, size=1024):
+    """Install a fake kernelspec and its wasm binaries in ``prefix``"""
+    prefix = Path(prefix)
+    binary = binary or name
+    files = {
+        f"bin/{binary}.js": f"// {binary}\n",
+        f"bin/{binary}.wasm": b"\0asm" + bytes(size),
+        f"share/jupyter/kernels/{name}/logo-32x32.png": b"\x89PNG",
+    }
+    if data:
+        files[f"bin/{binary}.data"] = bytes(size)
+    for filename, location in (shared or {}).items():
+        files[location] = b"\x7fELF" + filename.encode()
+
+    kernel_spec = dict(
+        display_name=name,
+        argv=[str(prefix / "bin" / binary), "-f", "{connection_file}"],
+        language=name,
+    )
+    if shared:
+        kernel_spec["metadata"] = {"shared": shared}
+    files[f"share/jupyter/kernels/{name}/kernel.json"] = json.dumps(kernel_spec)
+
+    return make_package(prefix, name, files=files)
+
+
+def make_prefix(
+    root,
+    name,
+    n_packages=3,
+    files_per_package=2,
+    kernels=("xpython",),
+    kernel_size=1024,
+    python_version="3.13.1",
+):
+    """Create a synthetic wasm prefix as micromamba would"""
+    prefix = Path(root) / name
+    (prefix / "conda-meta").mkdir(parents=True, exist_ok=True)
+    (prefix / "conda-meta" / "history").write_text(
+        "==> 2024-01-01 00:00:00 <==\n"
+        "# cmd: micromamba create --prefix {prefix} -c https://prefix.dev/emscripten-forge-4x -c https://prefix.dev/conda-forge\n"
+        f"# update specs: {list(kernels) + ['python']}\n"
+    )
+
+    python_lib = "lib/python" + ".".join(python_version.split(".")[:2])
+    make_package(
+        prefix,
+        "python",
+        version=python_version,
+        files={
+            f"{python_lib}/os.py": "import sys\n",
+            f"{python_lib}/site-packages/README.txt": "site-packages\n",
+        },
+    )
+    for index in range(n_packages):
+        make_package(
+            prefix,
+            f"pkg{index}",
+            files={
+                f"{python_lib}/site-packages/pkg{index}/mod{file_index}.py": f"value = {index * file_index}\n"
+                for file_index in range(files_per_package)
+            },
+            depends=["python"],
+        )
+    for kernel in kernels:
+        make_kernel(prefix, kernel, size=kernel_size)
+
+    return prefix
+
+
+def make_wheel(wheelhouse, name, version="1.0", files=None):
+    """Build a fake wheel in ``wheelhouse``, ``files`` maps paths inside the wheel to their content"""
+    wheel_path = Path(wheelhouse) / f"{name}-{version}-py3-none-any.whl"
+    wheel_path.parent.mkdir(parents=True, exist_ok=True)
+    files = files if files is not None else {f"{name}/__init__.py": "value = 1\n"}
+    dist_info = f"{name}-{version}.dist-info"
+
+    with zipfile.ZipFile(wheel_path, "w") as wheel:
+        for path, content in files.items():
+            wheel.writestr(path, content)
+        wheel.writestr(f"{dist_info}/METADATA", f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n")
+        wheel.writestr(f"{dist_info}/WHEEL", "Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any\n")
+        wheel.writestr(f"{dist_info}/RECORD", "")
+
+    return wheel_path
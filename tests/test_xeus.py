@@ -1,15 +1,40 @@
 """Test creating Python envs for jupyterlite-xeus-python."""
 
+import gzip
+import hashlib
+import json
 import os
-from tempfile import TemporaryDirectory
-from pathlib import Path
+import re
+import shutil
+import sys
 import tarfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
 
 import pytest
+from empack.file_patterns import PkgFileFilter
 
 from jupyterlite_core.app import LiteStatusApp
 
+import jupyterlite_xeus._compress
+import jupyterlite_xeus._pip
+import jupyterlite_xeus.add_on
+import jupyterlite_xeus.create_conda_env
+from jupyterlite_xeus import _prefix_index
+from jupyterlite_xeus._analyze import classify
+from jupyterlite_xeus._fetch import fetch_cached
+from jupyterlite_xeus._materialize import materialize
+from jupyterlite_xeus._pack import PackCache, pack_env
+from jupyterlite_xeus._pip import _install_pip_dependencies
+from jupyterlite_xeus._prune import find_site_packages
+from jupyterlite_xeus._utils import file_sha256
 from jupyterlite_xeus.add_on import XeusAddon
+from jupyterlite_xeus.create_conda_env import create_conda_env_from_specs, write_explicit_lock
+
+from synthetic import make_kernel, make_package, make_prefix, make_wheel
 
 
 def test_python_env_from_file_1():
@@ -236,3 +261,1030 @@ def test_multiple_envs():
         filename = match[0].split(':')[-1]  # e.g. xeus-cpp-0.6.0-h18da88b_1.tar.gz
         action = steps[match[0]]["actions"][0][1]
         assert action[1] == target_path / env_name_cpp / "kernel_packages" / filename
+
+
+def test_synthetic_prefix(lite_manager, synthetic_prefix):
+    addon = XeusAddon(lite_manager)
+    addon.prefix = [str(synthetic_prefix)]
+
+    steps = {step["name"]: step for step in addon.post_build(lite_manager)}
+
+    env_name = synthetic_prefix.name
+    assert f"copy:{env_name}:xpython:binaries" in steps
+    assert f"xeus:{env_name}:copy:pkg0-1.0.0-h0_0.tar.gz" in steps
+    assert addon.specs[env_name] == ["xpython", "python"]
+    assert addon.channels[env_name] == [
+        "https://prefix.dev/emscripten-forge-4x",
+        "https://prefix.dev/conda-forge",
+    ]
+
+
+def test_pack_cache(lite_manager, synthetic_prefix, tmp_path):
+    config = dict(default={"exclude_patterns": [{"pattern": "*.txt"}]})
+    cache = PackCache(tmp_path / "cache")
+
+    def pack(outdir):
+        outdir.mkdir()
+        return pack_env(
+            synthetic_prefix,
+            "/",
+            PkgFileFilter(**config),
+            outdir,
+            cache=cache,
+            file_filters_config=config,
+        )
+
+    for outdir, expected_hit in [(tmp_path / "out1", False), (tmp_path / "out2", True)]:
+        cache_hits = pack(outdir)
+        assert set(cache_hits.values()) == {expected_hit}
+        with tarfile.open(outdir / "pkg0-1.0.0-h0_0.tar.gz", "r") as fobj:
+            assert "lib/python3.13/site-packages/pkg0/mod1.py" in fobj.getnames()
+        with tarfile.open(outdir / "python-3.13.1-h0_0.tar.gz", "r") as fobj:
+            assert "lib/python3.13/site-packages/README.txt" not in fobj.getnames()
+
+    # Changing the filters for a package only invalidates that package
+    config = dict(packages={"pkg0": config["default"]}, default={})
+    cache_hits = pack(tmp_path / "out3")
+    assert cache_hits["pkg0-1.0.0-h0_0.tar.gz"]
+    assert not cache_hits["python-3.13.1-h0_0.tar.gz"]
+
+    # Changing a regex pattern invalidates the packages it applies to
+    config = dict(packages=config["packages"], default={"exclude_patterns": [{"regex": r".*\.md"}]})
+    cache_hits = pack(tmp_path / "out4")
+    assert cache_hits["pkg0-1.0.0-h0_0.tar.gz"]
+    assert not cache_hits["python-3.13.1-h0_0.tar.gz"]
+
+    # The filters can't be described without their config
+    with pytest.raises(ValueError, match="needs the empack config"):
+        pack_env(synthetic_prefix, "/", PkgFileFilter(**config), tmp_path / "out5", cache=cache)
+
+    # Eviction keeps the cache under the size limit
+    cache.max_size = 1
+    cache.evict()
+    assert list(cache.cache_dir.glob("*/*.tar.gz")) == []
+
+
+def test_pack_cache_addon(xeus_build, synthetic_prefix, tmp_path):
+    def cached():
+        addon, _ = xeus_build(prefix=[str(synthetic_prefix)], pack_cache_dir=str(tmp_path / "cache"))
+        record = next(r for r in addon.report.records if r["phase"] == "pack_env")
+        return {filename: package["cached"] for filename, package in record["packages"].items()}
+
+    assert set(cached().values()) == {False}
+    assert len(list((tmp_path / "cache").glob("*/*.tar.gz"))) == 5
+    assert set(cached().values()) == {True}
+
+
+def test_parallel_environment_creation(lite_manager, xeus_build, monkeypatch):
+    # Both environments must be in creation at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout=10)
+
+    def create_conda_env_from_env_file(root_prefix, env_file_content, env_file_location, **kwargs):
+        barrier.wait()
+        make_prefix(root_prefix / "envs", env_file_content["name"])
+
+    monkeypatch.setattr(
+        jupyterlite_xeus.add_on, "create_conda_env_from_env_file", create_conda_env_from_env_file
+    )
+
+    for env_name in ["env-a", "env-b"]:
+        Path(f"{env_name}.yml").write_text(f"name: {env_name}\ndependencies:\n  - xeus-python\n")
+
+    addon = XeusAddon(lite_manager)
+    addon.environment_file = ["env-a.yml", "env-b.yml"]
+    addon.environment_workers = 2
+
+    for step in addon.post_build(lite_manager):
+        pass
+
+    assert list(addon.prefixes) == ["env-a", "env-b"]
+    assert addon.specs["env-b"] == ["xeus-python"]
+
+    # A failure doesn't wait for the environments being created
+    release = threading.Event()
+    finished = []
+
+    def create_conda_env_from_env_file(root_prefix, env_file_content, env_file_location, **kwargs):
+        if env_file_content["name"] == "env-a":
+            raise RuntimeError("solve failed")
+        release.wait(timeout=10)
+        finished.append(env_file_content["name"])
+
+    monkeypatch.setattr(
+        jupyterlite_xeus.add_on, "create_conda_env_from_env_file", create_conda_env_from_env_file
+    )
+    Path("env-a.yml").write_text("name: env-a\ndependencies:\n  - xeus-python\n")
+    Path("env-b.yml").write_text("name: env-b\ndependencies:\n  - xeus-lua\n")
+
+    try:
+        with pytest.raises(RuntimeError, match="solve failed"):
+            xeus_build(environment_file=["env-a.yml", "env-b.yml"], environment_workers=2)
+        assert finished == []
+    finally:
+        release.set()
+
+    # Duplicated names fail before creating anything
+    addon = XeusAddon(lite_manager)
+    addon.environment_file = ["env-a.yml", "env-a.yml"]
+    addon.environment_workers = 2
+    monkeypatch.setattr(jupyterlite_xeus.add_on, "create_conda_env_from_env_file", None)
+
+    with pytest.raises(ValueError, match="used more than once"):
+        for step in addon.post_build(lite_manager):
+            pass
+
+
+def test_incremental_environment_creation(lite_manager, xeus_build, monkeypatch, tmp_path):
+    created = []
+
+    def create_conda_env_from_env_file(root_prefix, env_file_content, env_file_location, **kwargs):
+        created.append(env_file_content["name"])
+        make_prefix(root_prefix / "envs", env_file_content["name"])
+
+    monkeypatch.setattr(
+        jupyterlite_xeus.add_on, "create_conda_env_from_env_file", create_conda_env_from_env_file
+    )
+
+    env_file = Path("environment.yml")
+    env_file.write_text("name: env-a\ndependencies:\n  - xeus-python\n")
+
+    def build():
+        return xeus_build(build_cache_dir=str(tmp_path / "build-cache"))[1]
+
+    build()
+    steps = build()
+    assert created == ["env-a"]
+
+    binaries = steps["copy:env-a:xpython:binaries"]
+    assert [path.name for path in binaries["file_dep"]] == ["xpython.js", "xpython.wasm"]
+    assert binaries["targets"][1] == lite_manager.output_dir / "xeus" / "env-a" / "bin" / "xpython.wasm"
+    assert steps["xeus:env-a:update_env_file:empack_env_meta.json"]["uptodate"]
+
+    env_file.write_text("name: env-a\ndependencies:\n  - xeus-python\n  - numpy\n")
+    build()
+    assert created == ["env-a", "env-a"]
+
+
+def test_shared_packages(xeus_build, tmp_path):
+    prefix_a = make_prefix(tmp_path / "envs", "env-a")
+    prefix_b = make_prefix(tmp_path / "envs", "env-b")
+    make_package(prefix_b, "only-in-b")
+
+    addon, steps = xeus_build(prefix=[str(prefix_a), str(prefix_b)], shared_packages=True)
+
+    shared_steps = [name for name in steps if name.startswith("xeus:packages:copy:")]
+    # python and pkg0-2 are identical in both environments, the xpython
+    # kernelspecs differ as they contain the prefix path
+    assert len(shared_steps) == 7
+    assert not [name for name in steps if name.startswith("xeus:env-a:copy:")]
+
+    urls = {}
+    for env_name in ["env-a", "env-b"]:
+        env_meta_file = Path(addon.cwd_name) / "packed_env" / env_name / "empack_env_meta.json"
+        env_meta = json.loads(env_meta_file.read_text())
+        urls[env_name] = {pkg["name"]: pkg["url"] for pkg in env_meta["packages"]}
+
+    assert urls["env-a"]["pkg0"] == urls["env-b"]["pkg0"]
+    assert urls["env-a"]["pkg0"].startswith("xeus/packages/")
+    assert {*urls["env-a"].values(), *urls["env-b"].values()} == {
+        f"xeus/packages/{name.split(':')[-1]}" for name in shared_steps
+    }
+
+
+def test_materialization(lite_manager, xeus_build, synthetic_prefix, tmp_path):
+    src = synthetic_prefix / "bin" / "xpython.wasm"
+
+    assert materialize(src, tmp_path / "hardlink.wasm", "hardlink") == "hardlink"
+    assert (tmp_path / "hardlink.wasm").stat().st_ino == src.stat().st_ino
+
+    assert materialize(src, tmp_path / "symlink.wasm", "symlink") == "symlink"
+    assert (tmp_path / "symlink.wasm").resolve() == src.resolve()
+
+    # Falls back to a copy on filesystems without copy-on-write support
+    assert materialize(src, tmp_path / "reflink.wasm", "reflink") in ["reflink", "copy"]
+    assert (tmp_path / "reflink.wasm").read_bytes() == src.read_bytes()
+
+    _, steps = xeus_build(prefix=[str(synthetic_prefix)], materialization="symlink")
+    for step_name in ["copy:xeus-synthetic:xpython:binaries", "xeus:xeus-synthetic:copy:pkg0-1.0.0-h0_0.tar.gz"]:
+        for action, args in steps[step_name]["actions"]:
+            action(*args)
+
+    output = lite_manager.output_dir / "xeus" / "xeus-synthetic"
+    assert (output / "bin" / "xpython.wasm").resolve() == src.resolve()
+    # Packed packages live in a temporary directory, they are hardlinked instead
+    packed = output / "kernel_packages" / "pkg0-1.0.0-h0_0.tar.gz"
+    assert not packed.is_symlink()
+    assert packed.stat().st_nlink == 2
+
+
+def test_build_report(lite_manager, synthetic_prefix):
+    addon = XeusAddon(lite_manager)
+    addon.prefix = [str(synthetic_prefix)]
+    addon.build_report = "report.json"
+
+    for step in addon.post_build(lite_manager):
+        if step["name"] in ["copy:xeus-synthetic:xpython:binaries", "report"]:
+            for action, args in step["actions"]:
+                action(*args)
+
+    report = json.loads((lite_manager.lite_dir / "report.json").read_text())
+
+    assert set(report["phases"]) == {"prefix_index", "pack_env", "pack_mounts", "copy_kernels"}
+    copy_kernels = report["phases"]["copy_kernels"]
+    assert copy_kernels["count"] == 2
+    assert copy_kernels["bytes_written"] == sum(
+        (synthetic_prefix / "bin" / f"xpython.{ext}").stat().st_size for ext in ["js", "wasm"]
+    )
+
+    pack_record = next(record for record in report["records"] if record["phase"] == "pack_env")
+    assert pack_record["env_name"] == "xeus-synthetic"
+    assert len(pack_record["packages"]) == 5
+    assert pack_record["wall_time"] >= 0 and pack_record["cpu_time"] >= 0
+
+
+def test_pip_wheel_install(synthetic_prefix, tmp_path):
+    wheelhouse = tmp_path / "wheelhouse"
+    make_wheel(
+        wheelhouse,
+        "mypkg",
+        files={
+            "mypkg/__init__.py": "value = 1\n",
+            "mypkg-1.0.data/data/share/jupyter/labextensions/mypkg/package.json": "{}",
+        },
+    )
+    make_wheel(wheelhouse, "otherpkg", version="2.0")
+
+    # Pinned dependencies found in the wheelhouse are installed without pip
+    _install_pip_dependencies(
+        synthetic_prefix, ["mypkg==1.0", "otherpkg==2.0"], wheelhouse=str(wheelhouse)
+    )
+
+    site_packages = synthetic_prefix / "lib/python3.13/site-packages"
+    assert (site_packages / "mypkg/__init__.py").read_text() == "value = 1\n"
+    assert (site_packages / "otherpkg/__init__.py").is_file()
+    assert (synthetic_prefix / "share/jupyter/labextensions/mypkg/package.json").is_file()
+
+    dist_info = site_packages / "mypkg-1.0.dist-info"
+    assert (dist_info / "INSTALLER").read_text() == "pip\n"
+    record = (dist_info / "RECORD").read_text()
+    assert "mypkg/__init__.py,sha256=" in record
+    assert "../../../share/jupyter/labextensions/mypkg/package.json,sha256=" in record
+
+
+def test_pip_binary_wheel_raises(synthetic_prefix, tmp_path):
+    make_wheel(tmp_path, "binpkg", files={"binpkg/_ext.so": b"\x7fELF"})
+
+    with pytest.raises(RuntimeError, match="Cannot install binary PyPI package"):
+        _install_pip_dependencies(synthetic_prefix, [str(tmp_path / "binpkg-1.0-py3-none-any.whl")])
+
+    assert not (synthetic_prefix / "lib/python3.13/site-packages/binpkg").exists()
+
+
+def test_pip_local_package_sources_untouched(synthetic_prefix, tmp_path, monkeypatch):
+    sources = tmp_path / "localpkg"
+    shutil.copytree(Path(__file__).parent / "test_package", sources, ignore=shutil.ignore_patterns("build"))
+
+    def pip_wheel(command, check):
+        # Like pip, build in the source directory
+        wheel_dir = command[command.index("--wheel-dir") + 1]
+        for source in command[command.index("wheel") + 1 : command.index("--wheel-dir")]:
+            (Path(source) / "build" / "lib").mkdir(parents=True)
+            make_wheel(wheel_dir, "localpkg")
+
+    monkeypatch.setattr(jupyterlite_xeus._pip, "subprocess_run", pip_wheel)
+    _install_pip_dependencies(synthetic_prefix, [sources])
+
+    assert (synthetic_prefix / "lib/python3.13/site-packages/localpkg").is_dir()
+    assert not (sources / "build").exists()
+
+
+def test_lock_files(synthetic_prefix, tmp_path, monkeypatch):
+    lock_path = tmp_path / "xeus-synthetic-explicit.txt"
+    write_explicit_lock(synthetic_prefix, lock_path)
+    lines = lock_path.read_text().splitlines()
+    assert "@EXPLICIT" in lines
+    pkg0 = json.loads((synthetic_prefix / "conda-meta/pkg0-1.0.0-h0_0.json").read_text())
+    assert f"{pkg0['url']}#{pkg0['md5']}" in lines
+
+    commands = []
+    monkeypatch.setattr(jupyterlite_xeus.create_conda_env, "MICROMAMBA_COMMAND", "micromamba")
+    monkeypatch.setattr(
+        jupyterlite_xeus.create_conda_env,
+        "subprocess_run",
+        lambda command, check: commands.append([str(arg) for arg in command]),
+    )
+
+    # An explicit lock is installed as is, the specs are not solved
+    create_conda_env_from_specs(
+        "env", tmp_path / "root", ["xeus-python"], ["channel"], lock_file=lock_path
+    )
+    assert commands[-1][-2:] == ["--file", str(lock_path)]
+    assert "xeus-python" not in commands[-1]
+
+    # The env meta of a previous build is turned into an explicit lock file, and its
+    # pip packages are installed with the pip step
+    installed = []
+    monkeypatch.setattr(
+        jupyterlite_xeus.create_conda_env,
+        "_install_pip_dependencies",
+        lambda prefix_path, dependencies, **kwargs: installed.extend(dependencies),
+    )
+    numpy_url = "https://prefix.dev/emscripten-forge-4x/emscripten-wasm32/numpy-2.0.0-h0_0.tar.bz2"
+    packages = [
+        dict(name="numpy", version="2.0.0", build="h0_0", url=numpy_url, sha256="ab" * 32),
+        dict(name="mypkg", version="1.0", build="pip", channel="PyPi"),
+    ]
+    env_meta = tmp_path / "empack_env_meta.json"
+    env_meta.write_text(json.dumps(dict(packages=packages)))
+    create_conda_env_from_specs(
+        "env", tmp_path / "root", ["numpy"], ["channel"], pip_dependencies=["mypkg"], lock_file=env_meta
+    )
+    explicit_path = tmp_path / "root" / "env-explicit.txt"
+    assert commands[-1][-2:] == ["--file", str(explicit_path)]
+    assert f"{numpy_url}#sha256:{'ab' * 32}" in explicit_path.read_text().splitlines()
+    assert not any("PyPi" in arg for arg in commands[-1])
+    assert installed == ["mypkg==1.0"]
+
+    # Packages packed in the build have no URL to download them from
+    del packages[0]["url"]
+    env_meta.write_text(json.dumps(dict(packages=packages)))
+    with pytest.raises(ValueError, match="no download URL for numpy"):
+        create_conda_env_from_specs("env", tmp_path / "root", ["numpy"], ["channel"], lock_file=env_meta)
+
+
+def test_lock_files_addon(lite_manager, monkeypatch, tmp_path):
+    locks = []
+
+    def create_conda_env_from_env_file(root_prefix, env_file_content, env_file_location, lock_file=None, **kwargs):
+        locks.append(lock_file)
+        make_prefix(root_prefix / "envs", env_file_content["name"])
+
+    monkeypatch.setattr(
+        jupyterlite_xeus.add_on, "create_conda_env_from_env_file", create_conda_env_from_env_file
+    )
+
+    Path("environment.yml").write_text("name: env-a\ndependencies:\n  - xeus-python\n")
+    Path("env-a.lock").write_text("@EXPLICIT\n")
+
+    addon = XeusAddon(lite_manager)
+    addon.lock_file = ["env-a.lock", "env-b.lock"]
+    with pytest.raises(ValueError, match="one per environment file"):
+        for step in addon.post_build(lite_manager):
+            pass
+
+    addon = XeusAddon(lite_manager)
+    addon.lock_file = ["env-a.lock"]
+    addon.lock_dir = "locks"
+    steps = {step["name"]: step for step in addon.post_build(lite_manager)}
+    assert locks == [lite_manager.lite_dir / "env-a.lock"]
+
+    for action, args in steps["lock:env-a"]["actions"]:
+        action(*args)
+    assert "@EXPLICIT" in (lite_manager.lite_dir / "locks" / "env-a-explicit.txt").read_text()
+
+
+def test_precompress(lite_manager, xeus_build, synthetic_prefix, monkeypatch):
+    lite_manager.output_dir.mkdir()
+    (lite_manager.output_dir / "jupyter-lite.json").write_text('{"jupyter-config-data": {}}')
+
+    addon, steps = xeus_build(prefix=[str(synthetic_prefix)], precompress=["gzip"])
+    assert list(steps)[-2:] == ["precompress", "report"]
+    for step in steps.values():
+        for action, args in step["actions"]:
+            action(*args)
+
+    bin_dir = lite_manager.output_dir / "xeus" / "xeus-synthetic" / "bin"
+    wasm = bin_dir / "xpython.wasm"
+    assert gzip.decompress((bin_dir / "xpython.wasm.gz").read_bytes()) == wasm.read_bytes()
+    assert (bin_dir.parent / "empack_env_meta.json.gz").is_file()
+    # Too small to compress well
+    assert not (bin_dir / "xpython.js.gz").exists()
+    assert not list((lite_manager.output_dir / "xeus").rglob("*.tar.gz.gz"))
+
+    # Up-to-date siblings are not compressed again
+    mtime = (bin_dir / "xpython.wasm.gz").stat().st_mtime_ns
+    addon.precompress_outputs()
+    assert (bin_dir / "xpython.wasm.gz").stat().st_mtime_ns == mtime
+
+    # An upgraded file is compressed again, even when it is older than its sibling,
+    # like a copy of an environment file keeping its archive timestamp
+    upgraded = b"\0asm upgraded kernel" * 1000
+    wasm.write_bytes(upgraded)
+    os.utime(wasm, ns=(mtime - 10**9, mtime - 10**9))
+    addon.precompress_outputs()
+    assert gzip.decompress((bin_dir / "xpython.wasm.gz").read_bytes()) == upgraded
+
+    monkeypatch.setattr(jupyterlite_xeus._compress, "brotli", None)
+    with pytest.raises(RuntimeError, match="brotli"):
+        xeus_build(prefix=[str(synthetic_prefix)], precompress=["br"])
+
+
+def test_incremental_mounts(xeus_build, synthetic_prefix, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "a.csv").write_text("a\n")
+    config = tmp_path / "config.json"
+    config.write_text("{}")
+
+    def build():
+        addon, _ = xeus_build(
+            prefix=[str(synthetic_prefix)],
+            build_cache_dir=str(tmp_path / "build-cache"),
+            mounts=[f"{data}:/data", f"{config}:/etc/app"],
+        )
+        record = next(r for r in addon.report.records if r["phase"] == "pack_mounts")
+        out_path = Path(addon.cwd_name) / "packed_env" / synthetic_prefix.name
+        return record["reused_mounts"], out_path
+
+    assert build()[0] == 0
+    reused, out_path = build()
+    assert reused == 2
+    with tarfile.open(out_path / "mount_0.tar.gz") as tar:
+        assert tar.getnames() == ["data/a.csv"]
+
+    # Only the changed mount is repacked
+    (data / "b.csv").write_text("b\n")
+    reused, out_path = build()
+    assert reused == 1
+    with tarfile.open(out_path / "mount_0.tar.gz") as tar:
+        assert sorted(tar.getnames()) == ["data/a.csv", "data/b.csv"]
+
+    # Outdated tarballs are pruned
+    assert len(os.listdir(tmp_path / "build-cache" / "mounts" / synthetic_prefix.name)) == 2
+
+
+def test_lazy_content_mount(lite_manager, xeus_build, synthetic_prefix):
+    files = lite_manager.output_dir / "files"
+    (files / "data").mkdir(parents=True)
+    (files / "notebook.ipynb").write_text("{}")
+    (files / "data" / "big table.csv").write_text("a,b\n" * 1000)
+
+    def build(content_mount):
+        addon, steps = xeus_build(
+            prefix=[str(synthetic_prefix)],
+            mount_jupyterlite_content=True,
+            content_mount=content_mount,
+            lazy_content_threshold=1000,
+        )
+        out_path = Path(addon.cwd_name) / "packed_env" / synthetic_prefix.name
+        return addon, steps, out_path
+
+    addon, steps, out_path = build("lazy")
+    assert not list(out_path.glob("mount_*.tar.gz"))
+    meta_task = steps[f"xeus:{synthetic_prefix.name}:update_env_file:empack_env_meta.json"]
+    assert meta_task["actions"][0][1][1]["lazy_files"] == "xeus/files_index.json"
+
+    assert steps["copy:files_index.json"]["targets"] == [addon.xeus_output_dir / "files_index.json"]
+    index = json.loads(addon.content_index.read_text())
+    assert index["mount_path"] == "/files"
+    assert [(f["path"], f["size"], f["url"]) for f in index["files"]] == [
+        ("notebook.ipynb", 2, "files/notebook.ipynb"),
+        ("data/big table.csv", 4000, "files/data/big%20table.csv"),
+    ]
+
+    # Larger than the threshold
+    addon, steps, out_path = build("auto")
+    assert "copy:files_index.json" in steps
+
+    addon, steps, out_path = build("tarball")
+    assert "copy:files_index.json" not in steps
+    assert (out_path / "mount_0.tar.gz").is_file()
+
+
+def test_bundle_analysis(xeus_build, synthetic_prefix):
+    assert classify("lib/python3.13/site-packages/pkg/tests/test_a.py") == "tests"
+    assert classify("include/python3.13/Python.h") == "headers"
+    assert classify("lib/python3.13/site-packages/pkg/__pycache__/a.cpython-313.pyc") == "bytecode"
+    assert classify("lib/libfoo.so.1") == "binaries"
+
+    make_package(
+        synthetic_prefix,
+        "bigpkg",
+        files={
+            "lib/python3.13/site-packages/bigpkg/__init__.py": "x = 1\n" * 100,
+            "lib/python3.13/site-packages/bigpkg/tests/test_big.py": "assert True\n" * 100,
+            "lib/python3.13/site-packages/bigpkg/data.bin": os.urandom(10000),
+        },
+    )
+
+    def build(**kwargs):
+        return xeus_build(prefix=[str(synthetic_prefix)], **kwargs)[0]
+
+    addon = build(analyze_bundle=True)
+    record = next(r for r in addon.report.records if r["phase"] == "analyze_bundle")
+    bundle = record["bundle"]
+
+    bigpkg = bundle["packages"]["bigpkg"]
+    assert bigpkg["classes"]["data"] == 10000
+    assert bigpkg["classes"]["python"] == 600
+    # Tests are filtered out by the default empack config
+    assert bigpkg["classes"]["tests"] == 0
+    assert bigpkg["filtered"] == 1200
+    assert bundle["kernels"]["xpython"] == sum(
+        (synthetic_prefix / "bin" / f"xpython.{ext}").stat().st_size for ext in ["js", "wasm"]
+    )
+    assert bundle["total"] > 10000
+
+    # Within budget
+    build(size_budgets={"*": bundle["total"]})
+
+    with pytest.raises(RuntimeError, match="over its size budget"):
+        build(size_budgets={"xeus-synthetic": 10000})
+
+    build(size_budgets={"xeus-synthetic": 10000}, size_budget_action="warn")
+
+
+def test_prune_imports(lite_manager, xeus_build, synthetic_prefix):
+    site_packages = "lib/python3.13/site-packages"
+    packages = {
+        "usedpkg": {
+            "usedpkg/__init__.py": "from . import core\nimport helperpkg\n",
+            "usedpkg/core.py": "import importlib\nimportlib.import_module('.plugin', __name__)\n",
+            "usedpkg/unused.py": "import unusedpkg\n",
+            "usedpkg/__pycache__/unused.cpython-313.pyc": b"\0",
+            "usedpkg/data.json": "{}",
+        },
+        "helperpkg": {"helperpkg/__init__.py": ""},
+        "unusedpkg": {"unusedpkg/__init__.py": "", "unusedpkg/data.txt": "data"},
+        "compiledpkg": {
+            "compiledpkg/__init__.py": "from ._ext import f\n",
+            "compiledpkg/_ext.cpython-313-wasm32-emscripten.so": b"\0asm",
+            "compiledpkg/extra.py": "",
+        },
+        "lazypkg": {"lazypkg/__init__.py": "", "lazypkg/linalg.py": "", "lazypkg/fft.py": ""},
+        "dynpkg": {"dynpkg/__init__.py": ""},
+    }
+    for name, files in packages.items():
+        make_package(
+            synthetic_prefix,
+            name,
+            files={f"{site_packages}/{path}": content for path, content in files.items()},
+        )
+
+    files = lite_manager.output_dir / "files"
+    files.mkdir(parents=True)
+    cells = ["%matplotlib inline\nimport usedpkg", "import compiledpkg\nimport lazypkg as lp\nlp.linalg.inv()"]
+    (files / "notebook.ipynb").write_text(
+        json.dumps(dict(cells=[dict(cell_type="code", source=cell) for cell in cells]))
+    )
+
+    addon, _ = xeus_build(prefix=[str(synthetic_prefix)], prune_imports=True, prune_keep=["dynpkg"])
+
+    out_path = Path(addon.cwd_name) / "packed_env" / synthetic_prefix.name
+
+    def packed(name):
+        with tarfile.open(out_path / f"{name}-1.0.0-h0_0.tar.gz") as tar:
+            return sorted(
+                name.removeprefix(f"{site_packages}/")
+                for name in tar.getnames()
+                if name.startswith(site_packages)
+            )
+
+    assert packed("usedpkg") == ["usedpkg/__init__.py", "usedpkg/core.py", "usedpkg/data.json"]
+    assert packed("helperpkg") == ["helperpkg/__init__.py"]
+    assert packed("unusedpkg") == []
+    assert len(packed("compiledpkg")) == 3
+    assert packed("lazypkg") == ["lazypkg/__init__.py", "lazypkg/linalg.py"]
+    assert packed("dynpkg") == ["dynpkg/__init__.py"]
+    assert packed("pkg0") == []
+
+    record = next(r for r in addon.report.records if r["phase"] == "prune_imports")
+    assert record["pruned"]["unusedpkg"]["files"] == 2
+
+
+def test_compile_bytecode(xeus_build, tmp_path):
+    version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    prefix = make_prefix(tmp_path / "envs", "env-bytecode", python_version=f"{version}.0")
+    site_packages = f"lib/python{version}/site-packages"
+
+    def build(**kwargs):
+        addon, _ = xeus_build(
+            prefix=[str(prefix)], compile_bytecode=True, bytecode_python=sys.executable, **kwargs
+        )
+
+        packed = Path(addon.cwd_name) / "packed_env" / "env-bytecode" / "pkg0-1.0.0-h0_0.tar.gz"
+        with tarfile.open(packed) as tar:
+            return {
+                name.removeprefix(f"{site_packages}/pkg0/"): tar.extractfile(name).read()
+                for name in tar.getnames()
+                if name.startswith(f"{site_packages}/pkg0/")
+            }
+
+    tag = f"cpython-{sys.version_info.major}{sys.version_info.minor}"
+    files = build()
+    assert sorted(files) == [
+        f"__pycache__/mod0.{tag}.pyc",
+        f"__pycache__/mod1.{tag}.pyc",
+        "mod0.py",
+        "mod1.py",
+    ]
+    # Unchecked hash-based pyc, valid whatever the source timestamps
+    assert int.from_bytes(files[f"__pycache__/mod0.{tag}.pyc"][4:8], "little") == 0b01
+
+    files = build(bytecode_keep_sources=False, bytecode_optimization=2)
+    assert sorted(files) == ["mod0.pyc", "mod1.pyc"]
+
+    prefix = make_prefix(tmp_path / "envs", "env-other-python", python_version="3.99.0")
+    with pytest.raises(RuntimeError, match="but the environment has Python 3.99"):
+        xeus_build(prefix=[str(prefix)], compile_bytecode=True, bytecode_python=sys.executable)
+
+
+def test_package_tiers(xeus_build, synthetic_prefix, tmp_path):
+    site_packages = "lib/python3.13/site-packages"
+    make_package(
+        synthetic_prefix,
+        "ipython",
+        files={f"{site_packages}/IPython/__init__.py": "from pkg0 import mod0\n"},
+        depends=["python >=3.13", "traitlets"],
+    )
+    make_package(
+        synthetic_prefix, "traitlets", files={f"{site_packages}/traitlets/__init__.py": ""}
+    )
+    make_package(synthetic_prefix, "libfoo", files={"lib/libfoo.so": b"\0asm"})
+    # A package whose modules are not named after it
+    make_package(
+        synthetic_prefix,
+        "py-foo",
+        files={
+            f"{site_packages}/foo/__init__.py": "",
+            f"{site_packages}/_foo_ext.cpython-313-wasm32-emscripten.so": b"\0asm",
+            f"{site_packages}/py_foo-1.0.0.dist-info/METADATA": "",
+        },
+    )
+    # The compatibility lib/python3.1 of Python 3.1x prefixes, without any module
+    (synthetic_prefix / "lib" / "python3.1" / "site-packages").mkdir(parents=True)
+    assert find_site_packages(synthetic_prefix) == synthetic_prefix / site_packages
+
+    boot_trace = tmp_path / "boot_trace.json"
+    boot_trace.write_text(json.dumps(["/lib/python3.13/site-packages/pkg2/mod1.py", "/bin/sh"]))
+
+    def tiers(**kwargs):
+        addon, _ = xeus_build(prefix=[str(synthetic_prefix)], package_tiers=True, **kwargs)
+
+        env_meta = Path(addon.cwd_name) / "packed_env" / synthetic_prefix.name / "empack_env_meta.json"
+        env_meta = json.loads(env_meta.read_text())
+        deferred = sorted(pkg["name"] for pkg in env_meta["packages"] if pkg["tier"] == "deferred")
+        return deferred, env_meta["deferred_modules"]
+
+    # Kernels wait for the deferred packages before running cells using these modules
+    assert tiers() == (["pkg1", "pkg2", "py-foo"], ["_foo_ext", "foo", "pkg1", "pkg2"])
+    assert tiers(startup_imports=["pkg1.mod0", "foo"]) == (["pkg2"], ["pkg2"])
+    assert tiers(boot_traces=[str(boot_trace)]) == (["pkg1", "py-foo"], ["_foo_ext", "foo", "pkg1"])
+
+
+def test_prefix_index(lite_manager, synthetic_prefix, monkeypatch, tmp_path):
+    builds = []
+    build_prefix_index = _prefix_index.build_prefix_index
+    monkeypatch.setattr(
+        _prefix_index,
+        "build_prefix_index",
+        lambda *args: builds.append(args) or build_prefix_index(*args),
+    )
+
+    def index():
+        addon = XeusAddon(lite_manager)
+        addon.build_cache_dir = str(tmp_path / "build-cache")
+        return addon.prefix_index(str(synthetic_prefix))
+
+    first = index()
+    assert first["python_version"] == "3.13"
+    assert first["channels"] == [
+        "https://prefix.dev/emscripten-forge-4x",
+        "https://prefix.dev/conda-forge",
+    ]
+    assert [kernel["name"] for kernel in first["kernels"]] == ["xpython"]
+    assert len(builds) == 1
+
+    # Reused from the disk cache by the next builds
+    assert index() == first
+    assert len(builds) == 1
+
+    make_package(synthetic_prefix, "newpkg")
+    assert "newpkg" in [pkg["name"] for pkg in index()["packages"]]
+    assert len(builds) == 2
+
+    # pip packages do not touch conda-meta, but may come with a labextension
+    site_packages = synthetic_prefix / "lib/python3.13/site-packages"
+    (site_packages / "pipext-1.0.dist-info").mkdir()
+    pipext = synthetic_prefix / "share/jupyter/labextensions/pipext"
+    pipext.mkdir(parents=True)
+    pkg_json = dict(name="pipext", version="1.0.0", jupyterlab=dict(_build=dict(load="static/remoteEntry.js")))
+    (pipext / "package.json").write_text(json.dumps(pkg_json))
+    assert "share/jupyter/labextensions/pipext/package.json" in index()["labextensions"]
+    assert len(builds) == 3
+
+    # Kernel metadata is part of the index
+    kernel_json = synthetic_prefix / "share/jupyter/kernels/xpython/kernel.json"
+    kernel_spec = json.loads(kernel_json.read_text())
+    kernel_spec.setdefault("metadata", {})["shared"] = {"libfoo.so": "lib/libfoo.so"}
+    kernel_json.write_text(json.dumps(kernel_spec))
+    assert index()["kernels"][0]["shared"] == {"libfoo.so": "lib/libfoo.so"}
+    assert len(builds) == 4
+
+
+def test_labextensions_dedupe(xeus_build, tmp_path, caplog):
+    def make_extension(prefix, version):
+        pkg_json = dict(
+            name="@jupyter-widgets/jupyterlab-manager",
+            version=version,
+            jupyterlab=dict(_build=dict(load="static/remoteEntry.js")),
+        )
+        root = "share/jupyter/labextensions/@jupyter-widgets/jupyterlab-manager"
+        make_package(
+            prefix,
+            "jupyterlab_widgets",
+            version=version,
+            files={
+                f"{root}/package.json": json.dumps(pkg_json),
+                f"{root}/static/remoteEntry.js": "// entry\n",
+            },
+        )
+
+    prefixes = [make_prefix(tmp_path / "envs", f"env-{index}") for index in range(3)]
+    for prefix, version in zip(prefixes, ["3.0.0", "3.0.0", "3.0.1"]):
+        make_extension(prefix, version)
+
+    _, steps = xeus_build(prefix=[str(prefix) for prefix in prefixes])
+    tasks = [task for name, task in steps.items() if name.startswith("xeus:copy:ext:")]
+
+    assert [task["name"] for task in tasks] == ["xeus:copy:ext:@jupyter-widgets/jupyterlab-manager"]
+    (task,) = tasks
+    assert "file_dep" not in task
+    assert task["actions"][0][1][0] == prefixes[2] / "share/jupyter/labextensions/@jupyter-widgets/jupyterlab-manager"
+    assert "3.0.0 and 3.0.1 are both installed" in caplog.text
+
+
+def test_labextensions_single_patch(lite_manager, xeus_build, tmp_path):
+    prefixes = []
+    for index in range(2):
+        prefix = make_prefix(tmp_path / "envs", f"env-{index}")
+        for name in ["shared-ext", f"ext-{index}"]:
+            root = f"share/jupyter/labextensions/{name}"
+            pkg_json = dict(
+                name=name, version="1.0.0", jupyterlab=dict(_build=dict(load="static/remoteEntry.js"))
+            )
+            make_package(
+                prefix,
+                name,
+                files={
+                    f"{root}/package.json": json.dumps(pkg_json),
+                    f"{root}/static/remoteEntry.js": "// entry\n",
+                    f"{root}/schemas/{name}/plugin.json": "{}",
+                },
+            )
+        prefixes.append(prefix)
+
+    lite_manager.output_dir.mkdir(parents=True)
+    (lite_manager.output_dir / "jupyter-lite.json").write_text(
+        json.dumps({"jupyter-config-data": {"federated_extensions": []}})
+    )
+    all_federated_json = lite_manager.output_dir / "build" / "schemas" / "all_federated.json"
+    all_federated_json.parent.mkdir(parents=True)
+    all_federated_json.write_text(json.dumps([{"id": "shared-ext:plugin", "version": "0.1.0"}]))
+
+    _, steps = xeus_build(prefix=[str(prefix) for prefix in prefixes])
+    for name, task in steps.items():
+        if name.startswith(("xeus:copy:ext:", "patch:")):
+            for action, args in task["actions"]:
+                action(*args)
+
+    assert [name for name in steps if name.startswith("patch:")] == [
+        "patch:xeus:jupyter-lite.json",
+        "patch:xeus:federated_settings",
+    ]
+
+    settings = json.loads(all_federated_json.read_text())
+    assert sorted(setting["id"] for setting in settings) == [
+        "ext-0:plugin",
+        "ext-1:plugin",
+        "shared-ext:plugin",
+    ]
+
+    config = json.loads((lite_manager.output_dir / "jupyter-lite.json").read_text())
+    assert sorted(ext["name"] for ext in config["jupyter-config-data"]["federated_extensions"]) == [
+        "ext-0",
+        "ext-1",
+        "shared-ext",
+    ]
+
+
+def test_fetch_cached_empack_config(lite_manager, tmp_path):
+    served = tmp_path / "served"
+    served.mkdir()
+    (served / "empack_config.yaml").write_text("packages: {}\ndefault: {}\n")
+
+    statuses = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def log_request(self, code="-", size="-"):
+            statuses.append(int(code))
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=served))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/empack_config.yaml"
+    cache_dir = tmp_path / "fetch-cache"
+
+    try:
+        assert fetch_cached(url, cache_dir, timeout=5) == b"packages: {}\ndefault: {}\n"
+        # Revalidated, not downloaded again
+        assert fetch_cached(url, cache_dir, timeout=5) == b"packages: {}\ndefault: {}\n"
+        assert statuses == [200, 304]
+
+        addon = XeusAddon(lite_manager)
+        addon.empack_config = url
+        addon.fetch_cache_dir = str(cache_dir)
+        assert addon.get_file_filters() is addon.get_file_filters()
+        assert statuses == [200, 304, 304]
+
+        # Cached in the JupyterLite cache directory by default, which is kept between builds
+        addon = XeusAddon(lite_manager)
+        addon.empack_config = url
+        addon.get_file_filters()
+        assert list((lite_manager.cache_dir / "xeus" / "fetch").glob("*.data"))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # The server is gone, the cached copy is used
+    addon = XeusAddon(lite_manager)
+    addon.empack_config = url
+    addon.fetch_cache_dir = str(cache_dir)
+    addon.fetch_timeout = 1
+    assert addon.get_file_filters() is not None
+    assert fetch_cached(url, cache_dir, offline=True) == b"packages: {}\ndefault: {}\n"
+
+    with pytest.raises(RuntimeError, match="can't be used offline"):
+        fetch_cached(url + "?other", cache_dir, offline=True)
+
+    addon = XeusAddon(lite_manager)
+    addon.empack_config = url
+    addon.offline = True
+    assert addon.get_file_filters() is not None
+
+    # Relative directories are relative to the lite_dir
+    addon.build_cache_dir = "build-cache"
+    assert Path(addon.cwd_name) == Path(lite_manager.lite_dir) / "build-cache"
+
+
+def test_external_packages(xeus_build, synthetic_prefix, tmp_path):
+    conda_meta = synthetic_prefix / "conda-meta" / "pkg0-1.0.0-h0_0.json"
+    pkg_meta = json.loads(conda_meta.read_text())
+    pkg_meta["sha256"] = hashlib.sha256(b"pkg0 conda package").hexdigest()
+    conda_meta.write_text(json.dumps(pkg_meta))
+
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    (mirror / "pkg0-1.0.0-h0_0.tar.bz2").write_bytes(b"pkg0 conda package")
+
+    def build():
+        return xeus_build(
+            prefix=[str(synthetic_prefix)],
+            package_url_factory=lambda pkg, source_url: source_url if pkg["name"] == "pkg0" else None,
+            external_packages=True,
+            external_packages_mirror=str(mirror),
+        )
+
+    addon, tasks = build()
+    out_path = Path(addon.cwd_name) / "packed_env" / synthetic_prefix.name
+    packages = {
+        pkg["name"]: pkg
+        for pkg in json.loads((out_path / "empack_env_meta.json").read_text())["packages"]
+    }
+
+    assert packages["pkg0"]["url"] == pkg_meta["url"]
+    assert packages["pkg0"]["sha256"] == pkg_meta["sha256"]
+    assert not (out_path / "pkg0-1.0.0-h0_0.tar.gz").exists()
+    assert not any("pkg0" in task for task in tasks)
+    assert "sha256" not in packages["pkg1"]
+    assert (out_path / "pkg1-1.0.0-h0_0.tar.gz").is_file()
+
+    (mirror / "pkg0-1.0.0-h0_0.tar.bz2").write_bytes(b"tampered")
+    with pytest.raises(RuntimeError, match="does not match the sha256 of pkg0"):
+        build()
+
+    # The sha256 is the one of the conda package, not of a repacked empack tarball
+    with pytest.raises(ValueError, match="must be loaded from its conda package"):
+        xeus_build(
+            prefix=[str(synthetic_prefix)],
+            package_url_factory=lambda pkg, source_url: f"https://cdn.example/{pkg['filename']}",
+            external_packages=True,
+        )
+
+
+def test_chunked_packages(xeus_build, synthetic_prefix):
+    addon, tasks = xeus_build(prefix=[str(synthetic_prefix)], chunk_threshold=256, chunk_size=64)
+
+    out_path = Path(addon.cwd_name) / "packed_env" / synthetic_prefix.name
+    packages = json.loads((out_path / "empack_env_meta.json").read_text())["packages"]
+    chunked = [pkg for pkg in packages if "chunks" in pkg]
+    assert chunked
+
+    for pkg in packages:
+        tarball = (out_path / pkg["filename"]).read_bytes()
+        if "chunks" not in pkg:
+            assert len(tarball) <= 256
+            assert f"xeus:{synthetic_prefix.name}:copy:{pkg['filename']}" in tasks
+            continue
+
+        assert len(tarball) > 256
+        assert all(chunk["size"] <= 64 for chunk in pkg["chunks"])
+        assert b"".join((out_path / chunk["filename"]).read_bytes() for chunk in pkg["chunks"]) == tarball
+        assert f"xeus:{synthetic_prefix.name}:copy:{pkg['filename']}" not in tasks
+        for chunk in pkg["chunks"]:
+            assert f"xeus:{synthetic_prefix.name}:copy:{chunk['filename']}" in tasks
+
+
+def test_bundled_packages(xeus_build, synthetic_prefix):
+    make_package(synthetic_prefix, "base")
+    make_package(synthetic_prefix, "app", depends=["base >=1"])
+
+    addon, tasks = xeus_build(
+        prefix=[str(synthetic_prefix)], bundle_threshold=400, bundle_size=1024**2
+    )
+
+    out_path = Path(addon.cwd_name) / "packed_env" / synthetic_prefix.name
+    env_meta = json.loads((out_path / "empack_env_meta.json").read_text())
+    bundled = {pkg["name"]: pkg for pkg in env_meta["packages"] if "bundle" in pkg}
+    assert {"base", "app"} <= set(bundled)
+
+    for pkg in bundled.values():
+        bundle = (out_path / pkg["bundle"]["filename"]).read_bytes()
+        offset, size = pkg["bundle"]["offset"], pkg["bundle"]["size"]
+        assert bundle[offset : offset + size] == (out_path / pkg["filename"]).read_bytes()
+        assert f"xeus:{synthetic_prefix.name}:copy:{pkg['filename']}" not in tasks
+        assert f"xeus:{synthetic_prefix.name}:copy:{pkg['bundle']['filename']}" in tasks
+
+    assert {pkg["bundle"]["filename"] for pkg in bundled.values()} == {"bundle_0.bin"}
+    # Dependencies come first
+    assert bundled["base"]["bundle"]["offset"] < bundled["app"]["bundle"]["offset"]
+
+
+def test_shared_kernel_binaries(xeus_build, tmp_path):
+    prefixes = []
+    for index in range(2):
+        prefix = make_prefix(tmp_path / "envs", f"env-{index}", kernels=())
+        make_kernel(prefix, "xpython", shared={"libfoo.so": "lib/libfoo.so"})
+        make_package(prefix, "libxeus", files={"lib/libxeus.so": b"\0asm libxeus"})
+        prefixes.append(prefix)
+
+    _, steps = xeus_build(prefix=[str(prefix) for prefix in prefixes], shared_kernel_binaries=True)
+
+    copies = [name for name in steps if name.startswith("xeus:bin:copy:")]
+    # The kernel .js and .wasm, libfoo.so and libxeus.so, once for both environments
+    assert len(copies) == 4
+    assert not any(name.endswith(":binaries") for name in steps)
+
+    kernel_specs = []
+    for name, task in steps.items():
+        if name.endswith(":xpython:kernel.json"):
+            for action, args in task["actions"]:
+                action(*args)
+            kernel_specs.append(json.loads(args[1].read_text()))
+
+    assert len(kernel_specs) == 2
+    assert kernel_specs[0]["argv"][0] == kernel_specs[1]["argv"][0]
+    assert kernel_specs[0]["argv"][0].startswith("xeus/bin/")
+    assert kernel_specs[0]["metadata"]["shared_urls"] == kernel_specs[1]["metadata"]["shared_urls"]
+    assert kernel_specs[0]["metadata"]["libxeus_url"].endswith("/libxeus.so")
+
+
+def test_hashed_filenames(lite_manager, xeus_build, synthetic_prefix, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "a.txt").write_text("a")
+
+    lite_manager.output_dir.mkdir()
+    (lite_manager.output_dir / "jupyter-lite.json").write_text('{"jupyter-config-data": {}}')
+
+    _, steps = xeus_build(
+        prefix=[str(synthetic_prefix)], mounts=[f"{data}:/data"], hashed_filenames=True
+    )
+    assert list(steps)[-2:] == ["write:asset-manifest.json", "report"]
+    for step in steps.values():
+        for action, args in step["actions"]:
+            action(*args)
+
+    def content_hash(url):
+        return re.search(r"\.([0-9a-f]{16})\.tar\.gz$", url).group(1)
+
+    xeus_dir = lite_manager.output_dir / "xeus"
+    env_dir = xeus_dir / synthetic_prefix.name
+    env_meta = json.loads((env_dir / "empack_env_meta.json").read_text())
+    # Names change with the content of the files, and only then
+    for pkg in env_meta["packages"]:
+        assert content_hash(pkg["url"]) == file_sha256(lite_manager.output_dir / pkg["url"])[:16]
+    for mount in env_meta["mounts"]:
+        mounted = env_dir / "kernel_packages" / mount["filename"]
+        assert content_hash(mount["filename"]) == file_sha256(mounted)[:16]
+
+    kernel_spec = json.loads((env_dir / "xpython" / "kernel.json").read_text())
+    assert kernel_spec["argv"][0].startswith("xeus/bin/")
+
+    manifest = json.loads((xeus_dir / "asset-manifest.json").read_text())["assets"]
+    wasm = kernel_spec["argv"][0].removesuffix(".js") + ".wasm"
+    assert manifest[wasm]["immutable"]
+    assert manifest[wasm]["size"] == (lite_manager.output_dir / wasm).stat().st_size
+    assert manifest[env_meta["packages"][0]["url"]]["immutable"]
+    # The entry points keep their name, and can change between builds
+    assert not manifest[f"xeus/{synthetic_prefix.name}/empack_env_meta.json"]["immutable"]